@@ -0,0 +1,101 @@
+# answer_cache.py
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Cache câu trả lời của Chatling.ai trong xbk-rag_service.py, để câu hỏi gần như trùng với một câu hỏi vừa được trả lời
+# (cùng các đoạn văn ngữ cảnh) trả về ngay mà không tốn một lượt gọi LLM 2-20 giây.
+# Một câu trả lời chỉ được dùng lại khi tập ID chunk tìm được giống hệt (ngữ cảnh gửi cho LLM giống nhau) và
+# vector câu hỏi có cosine >= ANSWER_CACHE_MIN_COSINE với câu hỏi đã được trả lời; so khớp theo cosine chứ không theo văn bản,
+# nên "Năm sanh pháp là gì?" và "Năm sanh pháp là gì" dùng chung một câu trả lời.
+#   ANSWER_CACHE_SIZE=512 (0 = tắt),  ANSWER_CACHE_TTL=3600 (giây, 0 = không hết hạn),  ANSWER_CACHE_MIN_COSINE=0.98
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MIN_COSINE = float(os.getenv("ANSWER_CACHE_MIN_COSINE", "0.98"))
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời theo (vector câu hỏi, tập ID chunk), giới hạn capacity câu trả lời (loại bỏ theo LRU)
+    và ttl giây. Các câu trả lời được nhóm theo tập ID chunk nên mỗi lần tra chỉ so cosine với vài câu hỏi cùng ngữ cảnh.
+    Bên gọi quyết định câu trả lời nào được lưu (không lưu câu trả lời lỗi hay "không tìm thấy thông tin").
+    """
+
+    def __init__(self, capacity=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, min_cosine=ANSWER_CACHE_MIN_COSINE):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.min_cosine = min_cosine
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._entries = OrderedDict() # số thứ tự -> (vector câu hỏi đã chuẩn hóa, tập ID chunk, câu trả lời, thời điểm lưu)
+        self._by_chunks = {} # tập ID chunk -> tập số thứ tự các câu trả lời
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, entry_id):
+        _, chunk_ids, _, _ = self._entries.pop(entry_id)
+        group = self._by_chunks[chunk_ids]
+        group.discard(entry_id)
+        if not group:
+            del self._by_chunks[chunk_ids]
+
+    def get(self, query_embedding, chunk_ids):
+        """Câu trả lời đã lưu gần câu hỏi nhất (cosine >= min_cosine) với cùng tập chunk, hoặc None."""
+        if self.capacity <= 0:
+            return None
+        query = _unit(query_embedding)
+        chunk_ids = frozenset(chunk_ids)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_cosine = None, self.min_cosine
+            for entry_id in list(self._by_chunks.get(chunk_ids, ())):
+                vector, _, _, stored_at = self._entries[entry_id]
+                if self.ttl > 0 and now - stored_at > self.ttl:
+                    self._remove(entry_id)
+                    self.expired += 1
+                    continue
+                cosine = float(np.dot(query, vector))
+                if cosine >= best_cosine:
+                    best_id, best_cosine = entry_id, cosine
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def put(self, query_embedding, chunk_ids, answer):
+        if self.capacity <= 0:
+            return
+        chunk_ids = frozenset(chunk_ids)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (_unit(query_embedding), chunk_ids, answer, time.monotonic())
+            self._by_chunks.setdefault(chunk_ids, set()).add(entry_id)
+            while len(self._entries) > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_chunks.clear()
+
+    def format_stats(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return (f"Cache câu trả lời: {self.hits} trúng, {self.misses} trượt ({rate:.1f}% trúng), "
+                f"{self.expired} hết hạn, {len(self)}/{self.capacity} câu trả lời.")
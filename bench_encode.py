@@ -0,0 +1,73 @@
+# bench_encode.py
+import argparse
+import importlib.util
+import os
+import time
+
+import numpy as np
+
+# So sánh tốc độ encode (chunk/giây) trên CPU của vòng lặp hiện tại (lô 100 chunk theo thứ tự nguồn)
+# với encode theo nhóm độ dài token, trong tiến trình chính và song song trên nhiều tiến trình (parallel_encoder.py).
+# Các chunk được tạo từ kho JSON mẫu giống như xbk-preprocess_mongodb.py.
+#   python bench_encode.py [thư mục JSON] [--limit N] [--workers 1 2 4]
+
+DEFAULT_FOLDER = "data/Doc2JsonNormalized"
+LOOP_BATCH_SIZE = 100 # Kích thước lô của vòng lặp hiện tại trong xbk-embed_to_chroma.py
+
+
+def load_preprocess_module():
+    spec = importlib.util.spec_from_file_location("preprocess_mongodb", os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbk-preprocess_mongodb.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(label, texts, encode):
+    start = time.perf_counter()
+    embeddings = encode(texts)
+    elapsed = time.perf_counter() - start
+    print(f"[{label}] {len(texts)} chunk, {elapsed:.1f} s, {len(texts) / elapsed:,.1f} chunk/giây")
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh tốc độ encode trên CPU: vòng lặp hiện tại và encode theo nhóm độ dài, song song nhiều tiến trình")
+    parser.add_argument("folder", nargs="?", default=DEFAULT_FOLDER)
+    parser.add_argument("--limit", type=int, default=2000, help="Số chunk tối đa dùng để đo (0 = tất cả)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                        help="Số tiến trình encode cần đo")
+    args = parser.parse_args()
+
+    module = load_preprocess_module()
+    from embedding_backend import EMBEDDING_BACKEND, load_embedding_model
+    from parallel_encoder import ENCODE_BUCKET_SIZE, ParallelEncoder, token_lengths
+
+    texts = []
+    for _, docs in module.iter_file_chunk_documents(args.folder):
+        texts.extend(doc['content'] for doc in docs or [])
+    if args.limit:
+        texts = texts[:args.limit]
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-large")
+    model = load_embedding_model(model_name)
+    lengths = token_lengths(model, texts)
+    print(f"Đã tạo {len(texts)} chunk từ '{args.folder}' (token: trung bình {np.mean(lengths):.0f}, tối đa {max(lengths)}); "
+          f"mô hình {model_name} (backend {EMBEDDING_BACKEND}), nhóm {ENCODE_BUCKET_SIZE} chunk.")
+
+    def encode_loop(batch):
+        # Vòng lặp hiện tại: lô 100 chunk theo thứ tự nguồn, mỗi lô một lần model.encode
+        return np.concatenate([model.encode(batch[i:i + LOOP_BATCH_SIZE], show_progress_bar=False)
+                               for i in range(0, len(batch), LOOP_BATCH_SIZE)])
+
+    reference = run("hiện tại: lô 100 theo thứ tự nguồn", texts, encode_loop)
+    for workers in dict.fromkeys(args.workers):
+        with ParallelEncoder(model, model_name, num_workers=workers) as encoder:
+            if workers > 1:
+                encoder.encode(texts[:workers * ENCODE_BUCKET_SIZE]) # Khởi động tiến trình con (tải mô hình) trước khi đo
+            embeddings = run(f"nhóm độ dài, {workers} tiến trình", texts, encoder.encode)
+        cosine = np.sum(reference * embeddings, axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+        print(f"    cosine nhỏ nhất so với vòng lặp hiện tại: {cosine.min():.6f}")
+
+
+if __name__ == "__main__":
+    main()
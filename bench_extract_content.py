@@ -0,0 +1,175 @@
+# bench_extract_content.py
+import argparse
+import importlib.util
+import os
+import time
+import tracemalloc
+
+# So sánh thời gian và bộ nhớ đỉnh của extract_content_and_metadata bản cũ (đệ quy) và bản mới
+# (ngăn xếp tường minh, sinh lười) trong xbk-preprocess_mongodb.py.
+# Dùng chia chunk theo ký tự để chỉ đo phần duyệt cây JSON, không đo tokenizer.
+#   python bench_extract_content.py [thư mục JSON] [--nested-depth N]
+
+DEFAULT_FOLDER = "data/Doc2JsonNormalized"
+
+
+def load_preprocess_module():
+    spec = importlib.util.spec_from_file_location("preprocess_mongodb", os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbk-preprocess_mongodb.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- Bản cũ (đệ quy, sao chép metadata ở mọi cấp) của extract_content_and_metadata, giữ lại để so sánh ---
+def legacy_extract_content_and_metadata(data, file_name, chunker):
+    """
+    Trả về (contents, metadatas, paths): các chunk, metadata của chúng và đường dẫn của chunk trong tài liệu
+    (ví dụ "Noi_Dung/3/content/0/text#1"), dùng để tạo ID ổn định cho chunk.
+    Văn bản được gom thành các đơn vị (các đoạn văn liên tiếp cùng metadata) rồi chia chunk một lượt bằng chunker.
+    """
+    units = [] # (danh sách (số đoạn văn, đoạn văn), metadata, đường dẫn)
+    
+    allowed_types = ["van_xuoi", "paragraph", "tieu_de_pham", "tieu_de_chuong", "tieu_de_bai_kinh", "tụng"]
+
+    def extract_from_item(item, current_metadata, unique_texts, path):
+        if isinstance(item, dict):
+            new_metadata = current_metadata.copy()
+            for key, value in item.items():
+                if isinstance(value, (str, int, float, bool, type(None))):
+                    new_metadata[key] = value
+
+            text_to_extract = item.get("text") or item.get("tieu_de")
+            text_key = "text" if item.get("text") else "tieu_de"
+
+            if text_to_extract and item.get("type") in allowed_types and text_to_extract.strip():
+                text_to_extract = text_to_extract.strip()
+                if text_to_extract not in unique_texts:
+                    units.append(([(None, text_to_extract)], new_metadata, f"{path}/{text_key}"))
+                    unique_texts.add(text_to_extract)
+            
+            # Segment do process_docs_for_rag.py sinh ra: {"metadata": {...}, "noi_dung": ["đoạn văn", ...]}
+            if isinstance(item.get("metadata"), dict) and isinstance(item.get("noi_dung"), list):
+                for key, value in item["metadata"].items():
+                    if isinstance(value, (str, int, float, bool, type(None))):
+                        new_metadata[key] = value
+                paragraphs = []
+                for paragraph_idx, paragraph in enumerate(item["noi_dung"]):
+                    if not isinstance(paragraph, str) or not paragraph.strip():
+                        continue
+                    paragraph = paragraph.strip()
+                    if paragraph in unique_texts:
+                        continue
+                    paragraphs.append((paragraph_idx, paragraph))
+                    unique_texts.add(paragraph)
+                if paragraphs:
+                    units.append((paragraphs, new_metadata, f"{path}/noi_dung"))
+
+            if isinstance(item.get("content"), list):
+                for i, sub_item in enumerate(item["content"]):
+                    extract_from_item(sub_item, new_metadata, unique_texts, f"{path}/content/{i}")
+            elif isinstance(item.get("Noi_Dung"), list):
+                for i, sub_item in enumerate(item["Noi_Dung"]):
+                    extract_from_item(sub_item, new_metadata, unique_texts, f"{path}/Noi_Dung/{i}")
+
+    extracted_texts_set = set()
+    
+    initial_metadata = {"source_file": file_name}
+
+    if isinstance(data, dict):
+        if "Noi_Dung" in data and isinstance(data["Noi_Dung"], list):
+            for i, item in enumerate(data["Noi_Dung"]):
+                extract_from_item(item, initial_metadata, extracted_texts_set, f"Noi_Dung/{i}")
+        else:
+            extract_from_item(data, initial_metadata, extracted_texts_set, "")
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            extract_from_item(item, initial_metadata, extracted_texts_set, str(i))
+    else:
+        print(f"Cảnh báo: Dữ liệu trong '{file_name}' không phải là dictionary hoặc list ở cấp cao nhất.")
+
+    contents = []
+    metadatas = []
+    paths = []
+    doan_so = 0 # Bộ đếm số đoạn văn
+    chunked_units = chunker.chunk_units([paragraphs for paragraphs, _, _ in units])
+    for (_, unit_metadata, unit_path), chunks in zip(units, chunked_units):
+        for chunk, path_suffix in chunks:
+            doan_so += 1
+            contents.append(chunk)
+            meta_for_chunk = unit_metadata.copy()
+            meta_for_chunk['doan_so'] = doan_so # Gán số đoạn tăng dần
+            metadatas.append(meta_for_chunk)
+            paths.append(unit_path + path_suffix)
+
+    return contents, metadatas, paths
+
+
+def nest_document(data, depth):
+    """Biến một segment {"metadata", "noi_dung"} thành cây Noi_Dung/content lồng nhau depth cấp (mô phỏng kinh nhiều tầng)."""
+    paragraphs = data.get("noi_dung", []) if isinstance(data, dict) else []
+    items = [{"type": "paragraph", "text": paragraph, "stt": i} for i, paragraph in enumerate(paragraphs)]
+    for level in range(depth):
+        items = [{"type": "nhom", "cap": level, "tieu_de_nhom": f"Nhóm {level}.{i}", "content": items[i:i + 4]}
+                 for i in range(0, len(items), 4)]
+    meta = data.get("metadata", {}) if isinstance(data, dict) else {}
+    return {**meta, "Noi_Dung": items}
+
+
+def run(label, documents, extract, repeat=3):
+    """Thời gian tốt nhất của `repeat` lượt (không bật tracemalloc), rồi bộ nhớ đỉnh của một lượt riêng."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = extract(documents)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    extract(documents)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"[{label}] {chunks} chunk, {best * 1000:.1f} ms, bộ nhớ đỉnh {peak / 1024:.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", nargs="?", default=DEFAULT_FOLDER)
+    parser.add_argument("--nested-depth", type=int, default=0, help="Lồng mỗi tài liệu thành cây N cấp trước khi đo")
+    args = parser.parse_args()
+
+    module = load_preprocess_module()
+    from token_chunker import CharChunker
+
+    documents = []
+    for file_name in sorted(f for f in os.listdir(args.folder) if f.endswith(".json")):
+        data = module.load_normalized_json(os.path.join(args.folder, file_name))
+        documents.append((file_name, nest_document(data, args.nested_depth) if args.nested_depth else data))
+    print(f"Đã nạp {len(documents)} tài liệu từ '{args.folder}' (lồng {args.nested_depth} cấp).")
+
+    def extract_legacy(docs):
+        # Bản cũ giữ toàn bộ chunk và metadata của từng tài liệu trong danh sách
+        chunker = CharChunker(module.chunk_text)
+        total = 0
+        for file_name, data in docs:
+            contents, _, _ = legacy_extract_content_and_metadata(data, file_name, chunker)
+            total += len(contents)
+        return total
+
+    def extract_streaming(docs):
+        chunker = CharChunker(module.chunk_text)
+        total = 0
+        for file_name, data in docs:
+            for _ in module.iter_content_chunks(data, file_name, chunker):
+                total += 1
+        return total
+
+    # Kiểm tra hai bản cho cùng kết quả trước khi đo
+    for file_name, data in documents:
+        chunker = CharChunker(module.chunk_text)
+        if legacy_extract_content_and_metadata(data, file_name, chunker) != module.extract_content_and_metadata(data, file_name, chunker):
+            print(f"Cảnh báo: Kết quả khác nhau ở '{file_name}'.")
+
+    run("cũ: đệ quy + copy()", documents, extract_legacy)
+    run("mới: ngăn xếp + ChainMap", documents, extract_streaming)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# chroma_generations.py
+import json
+import os
+from datetime import datetime
+
+# Dựng lại index theo kiểu blue/green: mỗi lần dựng lại toàn bộ tạo một collection mới "<COLLECTION_NAME_CHROMA>__g<thời điểm>"
+# (một "thế hệ"), rồi chỉ khi thế hệ mới đã được kiểm tra mới đổi con trỏ sang nó. Con trỏ là file
+# <CHROMA_PERSIST_DIR>/active_collection.json, được ghi nguyên tử (file tạm + os.replace); rag_service đọc lại
+# con trỏ khi file đổi nên chuyển sang thế hệ mới mà không cần khởi động lại.
+# Khi chưa có con trỏ, collection đang dùng chính là COLLECTION_NAME_CHROMA (như trước).
+
+POINTER_FILENAME = "active_collection.json"
+GENERATION_SEPARATOR = "__g"
+KEEP_PREVIOUS_GENERATIONS = int(os.getenv("KEEP_PREVIOUS_GENERATIONS", "1")) # Số thế hệ cũ giữ lại để quay lui
+
+
+def pointer_path(persist_dir):
+    return os.path.join(persist_dir or ".", POINTER_FILENAME)
+
+
+def read_pointer(persist_dir):
+    """Nội dung file con trỏ ({"collection", "base", "count", "activated_at"}), hoặc None nếu chưa có."""
+    try:
+        with open(pointer_path(persist_dir), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def active_collection_name(persist_dir, base_name):
+    """Tên collection đang phục vụ cho base_name (theo con trỏ, hoặc chính base_name)."""
+    pointer = read_pointer(persist_dir)
+    if pointer and pointer.get("base") == base_name and pointer.get("collection"):
+        return pointer["collection"]
+    return base_name
+
+
+def new_generation_name(base_name):
+    return f"{base_name}{GENERATION_SEPARATOR}{datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+
+def is_generation_of(name, base_name):
+    return name == base_name or name.startswith(base_name + GENERATION_SEPARATOR)
+
+
+def activate_generation(persist_dir, base_name, collection_name, count):
+    """Đổi con trỏ sang collection_name một cách nguyên tử."""
+    path = pointer_path(persist_dir)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"base": base_name, "collection": collection_name, "count": count,
+                   "activated_at": datetime.now().isoformat(timespec="seconds")}, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def verify_generation(collection, expected_count, encode_query, spot_checks=20, n_results=5):
+    """
+    Kiểm tra thế hệ mới trước khi đổi con trỏ: số vector phải bằng expected_count, và với một số đoạn văn lấy mẫu
+    đều khắp collection, truy vấn bằng chính nội dung của nó phải trả lại nó (hoặc một đoạn văn trùng nội dung) trong n_results.
+    encode_query(texts) -> danh sách vector. Trả về (đạt hay không, thông báo).
+    """
+    count = collection.count()
+    if count != expected_count:
+        return False, f"số vector {count} khác số chunk trong kho {expected_count}"
+    if count == 0:
+        return False, "collection rỗng"
+
+    step = max(1, count // spot_checks)
+    samples = {"ids": [], "documents": []}
+    for offset in range(0, count, step)[:spot_checks]:
+        result = collection.get(limit=1, offset=offset, include=["documents"])
+        samples["ids"] += result["ids"]
+        samples["documents"] += result["documents"]
+    results = collection.query(query_embeddings=encode_query(samples["documents"]), n_results=n_results,
+                               include=["documents"])
+    misses = [sample_id for sample_id, document, ids, documents
+              in zip(samples["ids"], samples["documents"], results["ids"], results["documents"])
+              if sample_id not in ids and document not in documents]
+    if misses:
+        return False, f"{len(misses)}/{len(samples['ids'])} đoạn văn mẫu không tìm lại được: {misses[:5]}"
+    return True, f"{count} vector, {len(samples['ids'])} đoạn văn mẫu đều tìm lại được"
+
+
+def cleanup_generations(client, persist_dir, base_name, keep=KEEP_PREVIOUS_GENERATIONS):
+    """
+    Xóa các thế hệ cũ của base_name, trừ thế hệ đang phục vụ và `keep` thế hệ gần nhất trước nó.
+    Trả về danh sách tên collection đã xóa.
+    """
+    active = active_collection_name(persist_dir, base_name)
+    names = sorted((c if isinstance(c, str) else c.name) for c in client.list_collections())
+    # Tên thế hệ tăng theo thời gian nên thứ tự chuỗi là thứ tự tạo (base_name đứng trước mọi thế hệ)
+    older = [name for name in names if is_generation_of(name, base_name) and name < active]
+    removed = older[:max(0, len(older) - keep)]
+    for name in removed:
+        client.delete_collection(name)
+    return removed
@@ -0,0 +1,202 @@
+# chunk_store.py
+import abc
+import datetime
+import json
+import os
+import sqlite3
+
+# Kho chunk dùng chung giữa xbk-preprocess_mongodb.py (ghi) và xbk-embed_to_chroma.py (đọc).
+# CHUNK_STORE_BACKEND="mongo" (mặc định) dùng MongoDB; "sqlite" dùng một file SQLite nhúng,
+# không cần MongoDB server (hợp cho triển khai một máy và máy test).
+#
+# Mỗi chunk là một dict: {'_id', 'content', 'metadata' (có 'source_file'), 'chunk_hash', 'last_updated' (datetime)}.
+
+CHUNK_STORE_BACKEND = os.getenv('CHUNK_STORE_BACKEND', 'mongo')
+CHUNK_STORE_PATH = os.getenv('CHUNK_STORE_PATH', 'data/chunk_store.sqlite3')
+SCAN_BATCH_SIZE = 1000 # Số chunk mỗi lượt quét theo khóa
+
+
+class ChunkStore(abc.ABC):
+    """
+    Giao diện kho chunk. Các hàm ghi nhận danh sách theo lô; iter_chunks quét theo khoảng _id tăng dần.
+    Backend thiếu hàm nào sẽ lỗi ngay khi khởi tạo, không phải giữa chừng một lần chạy.
+    """
+
+    @abc.abstractmethod
+    def get_source_hashes(self, source_file):
+        """{_id: chunk_hash} của các chunk đang có của một file nguồn."""
+
+    @abc.abstractmethod
+    def write_batch(self, inserts, replaces, delete_ids):
+        """Thêm/thay thế các chunk và xóa theo _id. Trả về số chunk (đã thêm, đã cập nhật, đã xóa)."""
+
+    @abc.abstractmethod
+    def delete_sources_except(self, source_files):
+        """Xóa chunk của mọi file nguồn không nằm trong source_files. Trả về số chunk đã xóa."""
+
+    @abc.abstractmethod
+    def iter_chunks(self, batch_size=SCAN_BATCH_SIZE, updated_after=None):
+        """Quét lười toàn bộ chunk theo _id tăng dần (tùy chọn chỉ các chunk có last_updated > updated_after)."""
+
+    @abc.abstractmethod
+    def count(self):
+        """Số chunk trong kho."""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MongoChunkStore(ChunkStore):
+    """Kho chunk trên một collection MongoDB (pymongo chỉ được import khi dùng backend này)."""
+
+    def __init__(self, mongo_uri, db_name, collection_name):
+        from pymongo import MongoClient
+        self.client = MongoClient(mongo_uri)
+        self.collection = self.client[db_name][collection_name]
+        self.name = f"MongoDB {db_name}.{collection_name}"
+        self.collection.create_index('metadata.source_file')
+        self.collection.create_index('last_updated')
+
+    def get_source_hashes(self, source_file):
+        return {doc['_id']: doc.get('chunk_hash')
+                for doc in self.collection.find({'metadata.source_file': source_file}, {'chunk_hash': 1})}
+
+    def write_batch(self, inserts, replaces, delete_ids):
+        from pymongo import InsertOne, ReplaceOne, DeleteMany
+        from pymongo.errors import BulkWriteError
+
+        operations = [InsertOne(doc) for doc in inserts]
+        operations += [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in replaces]
+        if delete_ids:
+            operations.append(DeleteMany({'_id': {'$in': list(delete_ids)}}))
+        if not operations:
+            return 0, 0, 0
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            return result.inserted_count, result.modified_count + result.upserted_count, result.deleted_count
+        except BulkWriteError as e:
+            # ordered=False: các thao tác hợp lệ vẫn được ghi, chỉ báo lỗi các thao tác hỏng
+            details = e.details or {}
+            print(f"Lỗi khi ghi {len(details.get('writeErrors', []))} document vào MongoDB: {details.get('writeErrors', [])[:3]}")
+            return details.get('nInserted', 0), details.get('nModified', 0) + details.get('nUpserted', 0), details.get('nRemoved', 0)
+
+    def delete_sources_except(self, source_files):
+        return self.collection.delete_many({'metadata.source_file': {'$nin': list(source_files)}}).deleted_count
+
+    def iter_chunks(self, batch_size=SCAN_BATCH_SIZE, updated_after=None):
+        query = {} if updated_after is None else {'last_updated': {'$gt': updated_after}}
+        projection = {'_id': 1, 'content': 1, 'metadata': 1, 'chunk_hash': 1, 'last_updated': 1}
+        last_id = None
+        while True:
+            page_query = dict(query, _id={'$gt': last_id}) if last_id is not None else query
+            batch = list(self.collection.find(page_query, projection).sort('_id', 1).limit(batch_size))
+            if not batch:
+                return
+            last_id = batch[-1]['_id']
+            for doc in batch:
+                doc['_id'] = str(doc['_id']) # ObjectId của dữ liệu cũ -> string để làm ID cho ChromaDB
+                yield doc
+
+    def count(self):
+        return self.collection.count_documents({})
+
+    def close(self):
+        self.client.close()
+
+
+class SqliteChunkStore(ChunkStore):
+    """
+    Kho chunk nhúng trong một file SQLite. Bảng chunks có khóa chính id và chỉ mục theo source_file, last_updated;
+    metadata được lưu dạng JSON. Có thể dùng từ luồng ghi riêng (check_same_thread=False, mỗi lần chỉ một luồng ghi).
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.name = f"SQLite {path}"
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT PRIMARY KEY,
+                    source_file TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    chunk_hash TEXT,
+                    last_updated TEXT NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source_file ON chunks(source_file)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_last_updated ON chunks(last_updated)")
+
+    @staticmethod
+    def _row(doc):
+        metadata = doc.get('metadata', {})
+        last_updated = doc.get('last_updated') or datetime.datetime.now()
+        return (doc['_id'], metadata.get('source_file', ''), doc.get('content', ''),
+                json.dumps(metadata, ensure_ascii=False, default=str), doc.get('chunk_hash'),
+                last_updated.isoformat(timespec='microseconds'))
+
+    def get_source_hashes(self, source_file):
+        rows = self.conn.execute("SELECT id, chunk_hash FROM chunks WHERE source_file = ?", (source_file,))
+        return dict(rows)
+
+    def write_batch(self, inserts, replaces, delete_ids):
+        with self.conn:
+            inserted = self.conn.executemany(
+                "INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?, ?, ?)", [self._row(doc) for doc in inserts]).rowcount
+            updated = self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)", [self._row(doc) for doc in replaces]).rowcount
+            deleted = self.conn.executemany(
+                "DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in delete_ids]).rowcount
+        return max(inserted, 0), max(updated, 0), max(deleted, 0)
+
+    def delete_sources_except(self, source_files):
+        with self.conn:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_sources (source_file TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM keep_sources")
+            self.conn.executemany("INSERT OR IGNORE INTO keep_sources VALUES (?)", [(name,) for name in source_files])
+            deleted = self.conn.execute(
+                "DELETE FROM chunks WHERE source_file NOT IN (SELECT source_file FROM keep_sources)").rowcount
+            self.conn.execute("DELETE FROM keep_sources")
+        return deleted
+
+    def iter_chunks(self, batch_size=SCAN_BATCH_SIZE, updated_after=None):
+        condition = "" if updated_after is None else " AND last_updated > ?"
+        extra = () if updated_after is None else (updated_after.isoformat(timespec='microseconds'),)
+        last_id = ""
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, content, metadata, chunk_hash, last_updated FROM chunks "
+                f"WHERE id > ?{condition} ORDER BY id LIMIT ?", (last_id, *extra, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            for chunk_id, content, metadata, chunk_hash, last_updated in rows:
+                yield {'_id': chunk_id, 'content': content, 'metadata': json.loads(metadata),
+                       'chunk_hash': chunk_hash, 'last_updated': datetime.datetime.fromisoformat(last_updated)}
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def open_chunk_store(backend=None, mongo_uri=None, db_name=None, collection_name=None, sqlite_path=None):
+    """Mở kho chunk theo backend (mặc định CHUNK_STORE_BACKEND)."""
+    backend = backend or CHUNK_STORE_BACKEND
+    if backend == "sqlite":
+        return SqliteChunkStore(sqlite_path or CHUNK_STORE_PATH)
+    if backend == "mongo":
+        return MongoChunkStore(mongo_uri, db_name, collection_name)
+    raise ValueError(f"CHUNK_STORE_BACKEND không hợp lệ: '{backend}' (chỉ hỗ trợ 'mongo' hoặc 'sqlite')")
@@ -0,0 +1,74 @@
+# docx_stream.py
+import zipfile
+import xml.etree.ElementTree as ET
+
+# Đọc DOCX theo kiểu streaming: phân tích word/document.xml dần dần bằng iterparse
+# và trả về từng đoạn văn ngay khi đọc xong, thay vì dựng toàn bộ docx.Document trong bộ nhớ.
+
+DOCUMENT_PART = "word/document.xml"
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_BODY = _W + "body"
+_P = _W + "p"
+_R = _W + "r"
+_T = _W + "t"
+# Các phần tử con của run được quy đổi thành ký tự (giống paragraph.text của python-docx)
+_RUN_SPECIAL_CHARS = {
+    _W + "tab": "\t",
+    _W + "ptab": "\t",
+    _W + "br": "\n",
+    _W + "cr": "\n",
+    _W + "noBreakHyphen": "-",
+}
+
+
+def iter_docx_paragraphs(docx_file_path):
+    """
+    Trả về iterator các chuỗi văn bản của từng đoạn văn cấp thân tài liệu (tương đương document.paragraphs).
+    File được mở ngay khi gọi hàm, nên lỗi file hỏng/không phải DOCX được ném ra tại đây.
+    """
+    archive = zipfile.ZipFile(docx_file_path)
+    try:
+        xml_file = archive.open(DOCUMENT_PART)
+    except KeyError:
+        archive.close()
+        raise
+    return _iter_paragraphs(archive, xml_file)
+
+
+def _iter_paragraphs(archive, xml_file):
+    with archive, xml_file:
+        stack = [] # Các thẻ đang mở, từ gốc tới phần tử hiện tại
+        body = None
+        parts = None # Các mảnh văn bản của đoạn văn cấp thân đang đọc (None nếu không ở trong đoạn)
+        open_paragraphs = 0 # Số thẻ w:p đang mở (đoạn lồng trong text box không được tính vào đoạn ngoài)
+
+        for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if tag == _BODY:
+                    body = elem
+                elif tag == _P:
+                    if stack and stack[-1] == _BODY:
+                        parts = []
+                    open_paragraphs += 1
+                stack.append(tag)
+                continue
+
+            stack.pop()
+            if tag == _P:
+                open_paragraphs -= 1
+
+            if parts is not None and open_paragraphs == 1:
+                if tag == _T:
+                    parts.append(elem.text or "")
+                elif tag in _RUN_SPECIAL_CHARS and stack[-1] == _R:
+                    parts.append(_RUN_SPECIAL_CHARS[tag])
+
+            if stack and stack[-1] == _BODY:
+                # Phần tử con trực tiếp của w:body đã đọc xong: giải phóng để bộ nhớ không tăng theo kích thước file
+                if tag == _P:
+                    yield "".join(parts)
+                    parts = None
+                elem.clear()
+                body.clear()
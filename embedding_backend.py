@@ -0,0 +1,138 @@
+# embedding_backend.py
+import argparse
+import importlib.util
+import os
+import re
+import time
+
+import numpy as np
+
+# Chọn backend suy luận cho mô hình embedding, dùng chung cho xbk-embed_to_chroma.py, xbk-rag_service.py và parallel_encoder.py.
+#   EMBEDDING_BACKEND="torch"      PyTorch FP32 như trước (mặc định)
+#   EMBEDDING_BACKEND="onnx"       đồ thị ONNX (onnxruntime trên CPU), xuất một lần vào EMBEDDING_ONNX_DIR
+#   EMBEDDING_BACKEND="onnx-int8"  đồ thị ONNX lượng tử hóa int8 động (EMBEDDING_QUANTIZATION: avx2 | avx512 | avx512_vnni | arm64)
+# Cần sentence-transformers >= 3.2 (và gói optimum[onnxruntime] cho backend ONNX).
+# Trước khi chuyển backend, chạy kiểm tra độ khớp với vector FP32:
+#   python embedding_backend.py --check [--backend onnx-int8] [thư mục JSON]
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "data/onnx_models")
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "avx2")
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+CHECK_MIN_COSINE = 0.99 # Ngưỡng cosine trung bình với vector FP32 để coi là đạt
+CHECK_MIN_RECALL = 0.95 # Ngưỡng recall@k trung bình so với kết quả tìm kiếm FP32
+
+
+def embedding_model_version(model_name, backend=EMBEDDING_BACKEND):
+    """Tên phiên bản vector (dùng trong sổ đồng bộ và cache): vector của các backend khác nhau không được trộn lẫn."""
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+
+def _onnx_dir(model_name):
+    return os.path.join(EMBEDDING_ONNX_DIR, re.sub(r"[^\w.-]+", "_", model_name))
+
+
+def load_embedding_model(model_name, backend=EMBEDDING_BACKEND):
+    """Tải SentenceTransformer với backend đã chọn; đồ thị ONNX (và bản int8) được xuất ở lần tải đầu tiên."""
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    if backend not in BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND không hợp lệ: '{backend}' (chỉ hỗ trợ {', '.join(BACKENDS)})")
+
+    local_dir = _onnx_dir(model_name)
+    if not os.path.exists(os.path.join(local_dir, "onnx", "model.onnx")):
+        print(f"Đang xuất mô hình '{model_name}' sang ONNX vào {local_dir}...")
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(local_dir)
+    if backend == "onnx":
+        return SentenceTransformer(local_dir, backend="onnx")
+
+    quantized_file = f"onnx/model_qint8_{EMBEDDING_QUANTIZATION}.onnx"
+    if not os.path.exists(os.path.join(local_dir, quantized_file)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        print(f"Đang lượng tử hóa int8 ({EMBEDDING_QUANTIZATION}) đồ thị ONNX của '{model_name}'...")
+        export_dynamic_quantized_onnx_model(SentenceTransformer(local_dir, backend="onnx"),
+                                            EMBEDDING_QUANTIZATION, local_dir)
+    return SentenceTransformer(local_dir, backend="onnx", model_kwargs={"file_name": quantized_file})
+
+
+# --- Kiểm tra độ khớp của một backend với vector FP32 ---
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def recall_at_k(reference_docs, reference_queries, candidate_docs, candidate_queries, k):
+    """Recall@k trung bình: tỉ lệ top-k (cosine) của backend thử nằm trong top-k của FP32, cho từng câu hỏi."""
+    k = min(k, len(reference_docs))
+    reference_top = np.argsort(-(reference_queries @ reference_docs.T), axis=1)[:, :k]
+    candidate_top = np.argsort(-(candidate_queries @ candidate_docs.T), axis=1)[:, :k]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(reference_top, candidate_top)]))
+
+
+def load_sample_texts(folder, limit):
+    """Chunk của kho JSON mẫu, tạo giống như xbk-preprocess_mongodb.py."""
+    spec = importlib.util.spec_from_file_location("preprocess_mongodb", os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbk-preprocess_mongodb.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    texts = []
+    for _, docs in module.iter_file_chunk_documents(folder):
+        texts.extend(doc['content'] for doc in docs or [])
+    return texts[:limit] if limit else texts
+
+
+def check_backend(model_name, backend, texts, queries, k=10):
+    """
+    Encode cùng tập chunk/câu hỏi bằng PyTorch FP32 và bằng backend thử; in cosine giữa hai bộ vector,
+    recall@k của tìm kiếm và tốc độ. Trả về True nếu đạt cả hai ngưỡng CHECK_MIN_COSINE, CHECK_MIN_RECALL.
+    """
+    results = {}
+    for name in ("torch", backend):
+        model = load_embedding_model(model_name, name)
+        start = time.perf_counter()
+        docs = _normalize(model.encode(texts, show_progress_bar=False))
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        query_vectors = _normalize(np.stack([model.encode(query, show_progress_bar=False) for query in queries]))
+        query_ms = 1000 * (time.perf_counter() - start) / len(queries)
+        print(f"[{name}] {len(texts) / elapsed:,.1f} chunk/giây, {query_ms:.1f} ms/câu hỏi")
+        results[name] = (docs, query_vectors)
+
+    (reference_docs, reference_queries), (candidate_docs, candidate_queries) = results["torch"], results[backend]
+    cosine = np.sum(reference_docs * candidate_docs, axis=1)
+    recall = recall_at_k(reference_docs, reference_queries, candidate_docs, candidate_queries, k)
+    passed = cosine.mean() >= CHECK_MIN_COSINE and recall >= CHECK_MIN_RECALL
+    print(f"Cosine với FP32: trung bình {cosine.mean():.5f}, nhỏ nhất {cosine.min():.5f}")
+    print(f"Recall@{k} so với FP32: {recall:.4f} trên {len(queries)} câu hỏi")
+    print(("ĐẠT" if passed else "KHÔNG ĐẠT") + f" (ngưỡng: cosine >= {CHECK_MIN_COSINE}, recall@{k} >= {CHECK_MIN_RECALL})")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra backend embedding so với PyTorch FP32")
+    parser.add_argument("folder", nargs="?", default="data/Doc2JsonNormalized")
+    parser.add_argument("--check", action="store_true", help="Chạy kiểm tra độ khớp (cosine, recall@k)")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND if EMBEDDING_BACKEND != "torch" else "onnx-int8", choices=BACKENDS)
+    parser.add_argument("--limit", type=int, default=1000, help="Số chunk tối đa (0 = tất cả)")
+    parser.add_argument("--queries", help="File câu hỏi (mỗi dòng một câu); mặc định dùng câu đầu của một số chunk")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+    if not args.check:
+        parser.print_help()
+        return
+
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-large")
+    texts = load_sample_texts(args.folder, args.limit)
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = [text[:120] for text in texts[::max(1, len(texts) // 100)]]
+    print(f"Kiểm tra backend '{args.backend}' của {model_name}: {len(texts)} chunk, {len(queries)} câu hỏi.")
+    raise SystemExit(0 if check_backend(model_name, args.backend, texts, queries, args.k) else 1)
+
+
+if __name__ == "__main__":
+    main()
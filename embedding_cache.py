@@ -0,0 +1,244 @@
+# embedding_cache.py
+import contextlib
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+import numpy as np
+
+from vector_compression import STORAGE_DTYPES, dequantize, quantize
+
+# Cache embedding theo nội dung, dùng chung cho xbk-embed_to_chroma.py (embed đoạn văn) và xbk-rag_service.py (embed câu hỏi).
+# Khóa là (tên mô hình, sha256 của văn bản đã chuẩn hóa): các đoạn văn trùng nhau (tiêu đề, kệ lặp lại, nhiều bản dịch)
+# chỉ được encode một lần, và lần dựng lại index sau không phải encode lại văn bản không đổi.
+# Mỗi mô hình có 2 file trong EMBEDDING_CACHE_DIR:
+#   <mô hình>.vectors        mảng (số ô x số chiều) được memory-map, mỗi vector một ô; kiểu lưu EMBEDDING_CACHE_DTYPE
+#                            float32 | float16 | int8 (int8 kèm file <mô hình>.scales chứa hệ số tỉ lệ float32 của từng ô)
+#   <mô hình>.index.sqlite3  bảng khóa -> ô và thời điểm dùng gần nhất (để loại bỏ theo LRU khi đầy)
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "data/embedding_cache") # Để trống để tắt cache
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "200000")) # Số vector tối đa của mỗi mô hình
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32") # Chỉ áp dụng khi tạo cache mới
+GROW_SLOTS = 4096 # File vector được nới dần theo bội số này, không cấp phát sẵn toàn bộ dung lượng
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Chuẩn hóa văn bản trước khi băm: Unicode NFC, gộp khoảng trắng, bỏ khoảng trắng hai đầu."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache vector của một mô hình. get_many/put_many làm việc theo lô; encode() là điểm vào chính:
+    lấy các vector đã có, chỉ gọi model.encode cho văn bản chưa có (mỗi văn bản khác nhau một lần) rồi lưu lại.
+    Dùng được từ nhiều luồng (có khóa) và nhiều tiến trình: việc cấp ô và ghi vector nằm trong một giao dịch
+    BEGIN IMMEDIATE của SQLite, nên các tiến trình ghi được xếp hàng; bên đọc map lại file khi tiến trình khác đã nới nó.
+    """
+
+    def __init__(self, directory, model_name, capacity=EMBEDDING_CACHE_SIZE, dtype=EMBEDDING_CACHE_DTYPE):
+        os.makedirs(directory, exist_ok=True)
+        safe_name = re.sub(r"[^\w.-]+", "_", model_name)
+        self.model_name = model_name
+        self.capacity = capacity
+        self.vectors_path = os.path.join(directory, safe_name + ".vectors")
+        self.scales_path = os.path.join(directory, safe_name + ".scales")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._scales = None
+        self.conn = sqlite3.connect(os.path.join(directory, safe_name + ".index.sqlite3"),
+                                    check_same_thread=False, isolation_level=None, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    slot INTEGER NOT NULL UNIQUE,
+                    last_used INTEGER NOT NULL
+                ) WITHOUT ROWID""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used)")
+        meta = dict(self.conn.execute("SELECT name, value FROM meta"))
+        if meta.get("model", model_name) != model_name:
+            raise ValueError(f"File cache '{self.vectors_path}' thuộc mô hình khác: {meta['model']}")
+        self.dtype = meta.get("dtype", dtype if "dim" not in meta else "float32") # Cache cũ (chưa ghi dtype) là float32
+        if self.dtype not in STORAGE_DTYPES:
+            raise ValueError(f"EMBEDDING_CACHE_DTYPE không hợp lệ: '{self.dtype}' (chỉ hỗ trợ {', '.join(STORAGE_DTYPES)})")
+        self.dim = None
+        self._slots = 0 # Số ô của file vector đang được map
+        self._remap()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Giao dịch ghi giữ khóa ghi của SQLite ngay từ đầu (xếp hàng các tiến trình ghi)."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _tick(self):
+        """Thời điểm LRU kế tiếp, lấy từ chính file chỉ mục (chung cho mọi tiến trình). Gọi trong _transaction()."""
+        return self.conn.execute("SELECT COALESCE(MAX(last_used), 0) + 1 FROM entries").fetchone()[0]
+
+    def _remap(self):
+        """Map lại file vector theo số ô ghi trong meta (có thể đã được tiến trình khác nới ra)."""
+        meta = dict(self.conn.execute("SELECT name, value FROM meta WHERE name IN ('dim', 'slots')"))
+        if "dim" not in meta:
+            return
+        self.dim = int(meta["dim"])
+        slots = int(meta.get("slots", 0))
+        if slots == self._slots:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+        self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(slots, self.dim)) if slots else None
+        if self.dtype == "int8":
+            self._scales = np.memmap(self.scales_path, dtype=np.float32, mode="r+", shape=(slots,)) if slots else None
+        self._slots = slots
+
+    def _grow(self, needed_slots):
+        """Nới file vector để có ít nhất needed_slots ô (không quá capacity). Gọi trong _transaction()."""
+        slots = min(self.capacity, -(-needed_slots // GROW_SLOTS) * GROW_SLOTS)
+        if slots <= self._slots:
+            return
+        files = [(self.vectors_path, slots * self.dim * np.dtype(self.dtype).itemsize)]
+        if self.dtype == "int8":
+            files.append((self.scales_path, slots * np.dtype(np.float32).itemsize))
+        for path, size in files:
+            with open(path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('slots', ?)", (str(slots),))
+        self._remap()
+
+    def get_many(self, keys):
+        """Vector (bản sao) của từng khóa, hoặc None nếu chưa có trong cache."""
+        results = [None] * len(keys)
+        if not keys:
+            return results
+        # Tra ô, đọc vector và cập nhật thời điểm dùng trong cùng một giao dịch ghi: tiến trình khác không thể
+        # loại bỏ khóa và ghi đè ô của nó giữa lúc tra và lúc đọc
+        with self._lock, self._transaction():
+            slots = {}
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                slots.update(self.conn.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch))
+            if not slots:
+                return results
+            if max(slots.values()) >= self._slots:
+                self._remap()
+            for i, key in enumerate(keys):
+                slot = slots.get(key)
+                if slot is not None:
+                    results[i] = dequantize(self._vectors[slot], self._scales[slot] if self._scales is not None else None)
+            clock = self._tick()
+            self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(clock, key) for key in slots])
+        return results
+
+    def put_many(self, keys, vectors):
+        """Lưu các vector mới; khi cache đầy, các vector lâu không dùng nhất bị ghi đè."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+        with self._lock, self._transaction():
+            self._remap()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                      [("model", self.model_name), ("dim", str(self.dim)), ("dtype", self.dtype)])
+            items = dict(zip(keys, vectors))
+            for i in range(0, len(keys), 500): # Bỏ các khóa tiến trình khác vừa lưu
+                batch = keys[i:i + 500]
+                for (key,) in self.conn.execute(f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch):
+                    items.pop(key, None)
+            items = list(items.items())[:self.capacity]
+            if not items:
+                return
+            next_slot = self.conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM entries").fetchone()[0]
+            free = max(0, self.capacity - next_slot)
+            self._grow(next_slot + min(free, len(items)))
+
+            slots = list(range(next_slot, next_slot + min(free, len(items))))
+            if len(slots) < len(items):
+                evicted = self.conn.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?",
+                                            (len(items) - len(slots),)).fetchall()
+                slots += [slot for _, slot in evicted]
+            else:
+                evicted = []
+
+            stored, scales = quantize(np.stack([vector for _, vector in items]), self.dtype)
+            for row, slot in enumerate(slots):
+                self._vectors[slot] = stored[row]
+                if scales is not None:
+                    self._scales[slot] = scales[row]
+            self._vectors.flush() # Vector phải nằm trên đĩa trước khi chỉ mục trỏ tới nó
+            if self._scales is not None:
+                self._scales.flush()
+            clock = self._tick()
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                  [(key, slot, clock) for (key, _), slot in zip(items, slots)])
+
+    def encode(self, model, texts, **encode_kwargs):
+        """Như model.encode(texts) (mảng numpy float32, một hàng mỗi văn bản) nhưng dùng lại vector đã có trong cache."""
+        keys = [text_key(text) for text in texts]
+        cached = self.get_many(keys)
+        missing = {}
+        for text, key, vector in zip(texts, keys, cached):
+            if vector is None:
+                missing.setdefault(key, text)
+        self.hits += len(texts) - len(missing) # Văn bản lặp lại trong cùng lô cũng không phải encode lại
+        self.misses += len(missing)
+        if missing:
+            encoded = np.asarray(model.encode(list(missing.values()), **encode_kwargs), dtype=np.float32)
+            self.put_many(list(missing), encoded)
+            fresh = dict(zip(missing, encoded))
+            cached = [fresh[key] if vector is None else vector for key, vector in zip(keys, cached)]
+        return np.stack(cached) if cached else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def format_stats(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return f"Cache embedding ({self.model_name}): {self.hits} trúng, {self.misses} trượt ({rate:.1f}% trúng), {len(self)} vector đã lưu."
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            if self._scales is not None:
+                self._scales.flush()
+                self._scales = None
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_embedding_cache(model_name, directory=EMBEDDING_CACHE_DIR, capacity=EMBEDDING_CACHE_SIZE, dtype=EMBEDDING_CACHE_DTYPE):
+    """Mở cache của mô hình, hoặc None nếu cache bị tắt (EMBEDDING_CACHE_DIR rỗng / EMBEDDING_CACHE_SIZE=0)."""
+    if not directory or capacity <= 0:
+        return None
+    return EmbeddingCache(directory, model_name, capacity, dtype)
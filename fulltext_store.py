@@ -0,0 +1,284 @@
+# fulltext_store.py
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import sys
+from array import array
+
+# Kho văn bản toàn bộ tài liệu: mỗi bộ kinh gồm 3 file cạnh nhau
+#   <tên>.txt         văn bản UTF-8 thuần, mỗi đoạn văn một dòng
+#   <tên>.offsets     mảng uint64 little-endian: byte bắt đầu của từng đoạn văn + byte kết thúc file (n + 1 phần tử)
+#   <tên>.index.json  metadata bộ kinh, số đoạn văn và ranh giới PHẨM/KINH (số đoạn văn của dòng tiêu đề, byte bắt đầu)
+# Bên đọc dùng mmap nên lấy một đoạn văn (và ngữ cảnh xung quanh) không cần đọc cả bộ kinh vào bộ nhớ.
+
+TEXT_SUFFIX = ".txt"
+OFFSETS_SUFFIX = ".offsets"
+INDEX_SUFFIX = ".index.json"
+FULL_TEXT_SUFFIXES = (TEXT_SUFFIX, OFFSETS_SUFFIX, INDEX_SUFFIX)
+
+CHUNK_PROBE_LENGTH = 80 # Số ký tự đầu của một chunk dùng để dò vị trí của nó trong văn bản
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FullTextWriter:
+    """
+    Ghi văn bản một bộ kinh theo kiểu streaming: mỗi dòng được ghi ngay ra file tạm cùng offset của nó.
+    close() trả về {tên file: sha256} của 3 file; nếu mọi file trùng với previous_digests thì file cũ được giữ nguyên.
+    """
+    def __init__(self, metadata, base_filename, output_dir, previous_digests=None):
+        self.metadata = metadata
+        self.base_path = os.path.join(output_dir, base_filename)
+        self.previous_digests = previous_digests or {}
+        self.boundaries = []
+        self.unchanged = False
+        self._offsets = array("Q")
+        self._position = 0
+        self._text = None # Chỉ mở file khi có dòng đầu tiên (tài liệu rỗng thì không ghi gì)
+
+    def write_line(self, line):
+        if self._text is None:
+            self._text = open(self.base_path + TEXT_SUFFIX + ".tmp", "wb")
+        data = line.encode("utf-8") + b"\n"
+        self._offsets.append(self._position)
+        self._text.write(data)
+        self._position += len(data)
+
+    def mark_boundary(self, kind, title, number):
+        """Đánh dấu dòng vừa ghi là tiêu đề PHẨM/KINH (kind: "pham" | "kinh")."""
+        self.boundaries.append({
+            "kind": kind,
+            "title": title,
+            "number": number,
+            "paragraph": len(self._offsets) - 1,
+            "byte": self._offsets[-1],
+        })
+
+    def close(self):
+        if self._text is None:
+            return {}
+        self._text.close()
+        self._text = None
+
+        offsets = array("Q", self._offsets)
+        offsets.append(self._position)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        with open(self.base_path + OFFSETS_SUFFIX + ".tmp", "wb") as f:
+            offsets.tofile(f)
+
+        index = {
+            "metadata": self.metadata,
+            "paragraph_count": len(self._offsets),
+            "boundaries": self.boundaries,
+        }
+        with open(self.base_path + INDEX_SUFFIX + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=4)
+
+        digests = {}
+        for suffix in FULL_TEXT_SUFFIXES:
+            digests[os.path.basename(self.base_path) + suffix] = _file_sha256(self.base_path + suffix + ".tmp")
+        unchanged = all(self.previous_digests.get(name) == digest and
+                        os.path.exists(os.path.join(os.path.dirname(self.base_path), name))
+                        for name, digest in digests.items())
+        for suffix in FULL_TEXT_SUFFIXES:
+            if unchanged:
+                os.remove(self.base_path + suffix + ".tmp")
+            else:
+                os.replace(self.base_path + suffix + ".tmp", self.base_path + suffix)
+        self.unchanged = unchanged
+        return digests
+
+    def abort(self):
+        """Hủy các file tạm khi quá trình trích xuất bị lỗi giữa chừng (gọi nhiều lần hoặc sau close() cũng không sao)."""
+        if self._text is not None:
+            self._text.close()
+            self._text = None
+        for suffix in FULL_TEXT_SUFFIXES:
+            if os.path.exists(self.base_path + suffix + ".tmp"):
+                os.remove(self.base_path + suffix + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+
+class FullTextReader:
+    """
+    Truy cập ngẫu nhiên vào văn bản một bộ kinh qua mmap.
+    Đoạn văn được đánh số từ 0 theo thứ tự trong tài liệu (kể cả dòng trống).
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        with open(base_path + INDEX_SUFFIX, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.metadata = index.get("metadata", {})
+        self.boundaries = index.get("boundaries", [])
+        self._boundary_paragraphs = [b["paragraph"] for b in self.boundaries]
+
+        self._text_file = open(base_path + TEXT_SUFFIX, "rb")
+        self._text = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets_file = open(base_path + OFFSETS_SUFFIX, "rb")
+        self._offsets_map = mmap.mmap(self._offsets_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder == "little":
+            self._offsets = memoryview(self._offsets_map).cast("Q")
+        else:
+            self._offsets = array("Q", self._offsets_map)
+            self._offsets.byteswap()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._offsets, memoryview):
+            self._offsets.release()
+        self._offsets_map.close()
+        self._offsets_file.close()
+        self._text.close()
+        self._text_file.close()
+
+    def span(self, number):
+        """Khoảng byte [bắt đầu, kết thúc) của đoạn văn (không gồm ký tự xuống dòng)."""
+        if not 0 <= number < len(self):
+            raise IndexError(number)
+        return self._offsets[number], self._offsets[number + 1] - 1
+
+    def paragraph(self, number):
+        start, end = self.span(number)
+        return self._text[start:end].decode("utf-8")
+
+    def paragraphs(self, start, stop):
+        """Các đoạn văn [start, stop), cắt theo biên tài liệu."""
+        # Giải mã từng đoạn theo offset (một đoạn văn có thể chứa ngắt dòng w:br)
+        return [self.paragraph(i) for i in range(max(start, 0), min(stop, len(self)))]
+
+    def paragraph_at_byte(self, byte_offset):
+        """Số thứ tự của đoạn văn chứa byte tại byte_offset."""
+        return bisect.bisect_right(self._offsets, byte_offset, 0, len(self)) - 1
+
+    def find(self, text, start_paragraph=0):
+        """Số thứ tự đoạn văn đầu tiên (từ start_paragraph) chứa chuỗi text, hoặc None."""
+        found = self.find_all(text, start_paragraph, limit=1)
+        return found[0] if found else None
+
+    def find_all(self, text, start_paragraph=0, stop_paragraph=None, limit=None):
+        """Số thứ tự các đoạn văn trong [start_paragraph, stop_paragraph) chứa chuỗi text, tối đa `limit` lần xuất hiện."""
+        stop_paragraph = len(self) if stop_paragraph is None else min(stop_paragraph, len(self))
+        start_paragraph = max(start_paragraph, 0)
+        if not text or start_paragraph >= stop_paragraph:
+            return []
+        needle = text.encode("utf-8")
+        position, end = self._offsets[start_paragraph], self._offsets[stop_paragraph]
+        found = []
+        while limit is None or len(found) < limit:
+            position = self._text.find(needle, position, end)
+            if position < 0:
+                break
+            found.append(self.paragraph_at_byte(position))
+            position += 1
+        return found
+
+    def section_at(self, number):
+        """Tiêu đề PHẨM và KINH gần nhất bao trùm đoạn văn: {"pham": {...} | None, "kinh": {...} | None}."""
+        section = {"pham": None, "kinh": None}
+        for i in range(bisect.bisect_right(self._boundary_paragraphs, number) - 1, -1, -1):
+            boundary = self.boundaries[i]
+            if section[boundary["kind"]] is None:
+                section[boundary["kind"]] = boundary
+            if boundary["kind"] == "pham" or all(section.values()):
+                break # Tiêu đề KINH trước PHẨM hiện tại thuộc về phẩm khác
+        return section
+
+    def section_spans(self, pham_title=None, kinh_title=None):
+        """
+        Các khoảng đoạn văn [bắt đầu, kết thúc) thuộc PHẨM pham_title và KINH kinh_title (so đúng với tiêu đề
+        đã ghi trong ranh giới; None = không lọc theo cấp đó). Một tiêu đề có thể lặp lại nên có thể có nhiều khoảng.
+        PHẨM kéo dài đến PHẨM kế tiếp, KINH kéo dài đến KINH hoặc PHẨM kế tiếp.
+        """
+        spans = [(0, len(self))]
+        for kind, title in (("pham", pham_title), ("kinh", kinh_title)):
+            if not title:
+                continue
+            narrowed = []
+            for i, boundary in enumerate(self.boundaries):
+                if boundary["kind"] != kind or boundary["title"] != title:
+                    continue
+                start = boundary["paragraph"]
+                stop = next((b["paragraph"] for b in self.boundaries[i + 1:] if b["kind"] in ("pham", kind)), len(self))
+                narrowed.extend((start, min(stop, span_stop)) for span_start, span_stop in spans
+                                if span_start <= start < span_stop)
+            spans = narrowed
+        return spans
+
+    def context(self, number, before=2, after=2):
+        """Đoạn văn cùng `before` đoạn trước và `after` đoạn sau nó (bỏ dòng trống)."""
+        return [p for p in self.paragraphs(number - before, number + after + 1) if p.strip()]
+
+    def context_for_chunk(self, chunk_text, before=2, after=2, metadata=None):
+        """
+        Ngữ cảnh xung quanh một chunk, dò theo các ký tự đầu của chunk. Với metadata của chunk ("Số Phẩm",
+        "Tên Kinh Nhỏ") chỉ dò trong phần PHẨM/KINH của nó, vì câu mở đầu lặp lại ("Tôi nghe như vầy...")
+        sẽ khớp ngay đoạn đầu bộ kinh. Trả về None (bên gọi giữ nguyên chunk) nếu không tìm thấy hoặc khớp nhiều chỗ.
+        """
+        probe = chunk_text.strip()[:CHUNK_PROBE_LENGTH]
+        metadata = metadata or {}
+        titles = [metadata.get(key) for key in ("Số Phẩm", "Tên Kinh Nhỏ")]
+        spans = self.section_spans(*(title if title != "Not_Available" else None for title in titles))
+        found = []
+        for start, stop in spans or [(0, len(self))]: # Tiêu đề không khớp ranh giới nào thì dò cả bộ kinh
+            found.extend(self.find_all(probe, start, stop, limit=2 - len(found)))
+            if len(found) > 1:
+                return None
+        return self.context(found[0], before, after) if found else None
+
+
+class FullTextLibrary:
+    """
+    Tập các kho văn bản trong một thư mục, mở lười theo nhu cầu.
+    for_source_file() tìm bộ kinh của một segment theo tiền tố tên file (tên segment bắt đầu bằng tên bộ kinh).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._readers = {}
+        self._base_names = sorted(
+            (name[:-len(INDEX_SUFFIX)] for name in os.listdir(directory) if name.endswith(INDEX_SUFFIX)),
+            key=len, reverse=True)
+
+    def __len__(self):
+        """Số bộ kinh có kho văn bản trong thư mục."""
+        return len(self._base_names)
+
+    def open(self, base_filename):
+        reader = self._readers.get(base_filename)
+        if reader is None:
+            reader = FullTextReader(os.path.join(self.directory, base_filename))
+            self._readers[base_filename] = reader
+        return reader
+
+    def for_source_file(self, source_file):
+        for base_filename in self._base_names:
+            if source_file.startswith(base_filename):
+                return self.open(base_filename)
+        return None
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
@@ -0,0 +1,179 @@
+# heading_grammar.py
+import glob
+import os
+import re
+import sys
+import time
+import unicodedata
+from collections import Counter, namedtuple
+
+# Bộ nhận diện tiêu đề cấu trúc (PHẨM/PHẦN/CHƯƠNG/KINH, dấu phân cách) dùng chung cho các script trích xuất DOCX.
+# Tất cả các mẫu của một bộ quy tắc được ghép thành MỘT regex duy nhất, nên mỗi đoạn văn chỉ cần một lần match.
+
+HeadingMatch = namedtuple("HeadingMatch", ["kind", "groups"])
+
+
+def _to_roman(n):
+    """Đổi số nguyên sang số La Mã (chỉ dùng để dựng bảng tra)."""
+    values = [(1000, "M"), (900, "CM"), (500, "D"), (400, "CD"), (100, "C"), (90, "XC"),
+              (50, "L"), (40, "XL"), (10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I")]
+    result = ""
+    for value, symbol in values:
+        while n >= value:
+            result += symbol
+            n -= value
+    return result
+
+# Bảng tra dựng sẵn: số La Mã và số đếm tiếng Việt thường gặp trong tiêu đề phẩm/phần
+ROMAN_NUMERALS = {_to_roman(n): n for n in range(1, 400)}
+VIETNAMESE_NUMERALS = {
+    "một": 1, "nhất": 1, "hai": 2, "nhì": 2, "ba": 3, "tam": 3, "bốn": 4, "tư": 4, "tứ": 4,
+    "năm": 5, "ngũ": 5, "sáu": 6, "lục": 6, "bảy": 7, "bẩy": 7, "thất": 7, "tám": 8, "bát": 8,
+    "chín": 9, "cửu": 9, "mười": 10, "thập": 10,
+}
+
+
+def parse_numeral(raw):
+    """Đổi số dạng chữ số, La Mã hoặc chữ tiếng Việt sang số nguyên; None nếu không nhận ra."""
+    s = raw.strip()
+    if s.isdigit():
+        return int(s)
+    value = ROMAN_NUMERALS.get(s.upper())
+    if value is not None:
+        return value
+    return VIETNAMESE_NUMERALS.get(unicodedata.normalize('NFC', s.lower()))
+
+
+class HeadingGrammar:
+    """
+    Ghép một danh sách quy tắc (loại, mẫu regex) thành một regex duy nhất, neo ở đầu đoạn văn.
+    Thứ tự quy tắc là thứ tự ưu tiên. Nhóm có tên trong từng mẫu được đổi tên nội bộ để không trùng nhau
+    và được trả lại qua HeadingMatch.groups.
+    """
+    _GROUP_NAME = re.compile(r'\(\?P<(\w+)>')
+
+    def __init__(self, rules, flags=re.IGNORECASE):
+        self._rules = []
+        alternatives = []
+        for i, (kind, pattern) in enumerate(rules):
+            names = self._GROUP_NAME.findall(pattern)
+            renamed = self._GROUP_NAME.sub(lambda m, i=i: f"(?P<r{i}_{m.group(1)}>", pattern)
+            alternatives.append(f"(?P<r{i}>{renamed})")
+            self._rules.append((kind, [(name, f"r{i}_{name}") for name in names]))
+        self._regex = re.compile("(?:" + "|".join(alternatives) + ")", flags)
+
+    def classify(self, text):
+        """Trả về HeadingMatch(loại, {tên nhóm: giá trị}) của quy tắc đầu tiên khớp, hoặc None."""
+        match = self._regex.match(text)
+        if match is None:
+            return None
+        kind, group_names = self._rules[int(match.lastgroup[1:])]
+        return HeadingMatch(kind, {name: match.group(inner) for name, inner in group_names})
+
+
+# Quy tắc cho process_docs_for_rag.py: dấu phân cách '---o0o---' (ở bất kỳ đâu), PHẨM/PHẦN/CHƯƠNG có số thứ tự, KINH
+SEGMENT_HEADING_RULES = [
+    ("delimiter", r"(?s:.*?)---o0o---"),
+    ("pham", r"(?P<type>PHẨM|PHẦN|CHƯƠNG)\s+(?:THỨ\s+)?(?P<num>[IVXLCDM\d]+|[A-ZĐ][a-zđÀ-Ỹ]+)\b\s*[:\.]?\s*(?P<name>.*)$"),
+    # Bắt buộc có chữ KINH viết hoa ("KINH ĐẠI BẢN DUYÊN", "02. KINH DU HÀNH", "KINH SỐ 03"): đoạn văn đánh số
+    # ("1. Bàn chân bằng phẳng...") hay câu văn bắt đầu bằng "Kinh điển..." không phải tiêu đề kinh
+    ("kinh", r"(?:\d+\.\s*)?(?-i:KINH)\s+(?P<title>.+)$"),
+]
+
+# Quy tắc cho xbk-extract_docx2json.py: "X. PHẨM Y", "PHẦN Z", "X. KINH Y", dấu phân cách "--- o0o ---"/"o0o"
+DOC2JSON_HEADING_RULES = [
+    ("pham", r"(?:\d{1,2}\.\s*)?PHẨM\s+(?P<name>.+)$"),
+    ("phan", r"PHẦN\s+(?P<num>\d+)$"),
+    ("kinh", r"(?P<num>\d{1,3})\.\s*KINH\s+(?P<name>.+)$"),
+    ("delimiter", r"(?-i:(?:-[ \t]*-[ \t]*-[ \t]*o[ \t]*0[ \t]*o[ \t]*-[ \t]*-[ \t]*-|o[ \t]*0[ \t]*o))$"),
+]
+
+SEGMENT_HEADING_GRAMMAR = HeadingGrammar(SEGMENT_HEADING_RULES)
+DOC2JSON_HEADING_GRAMMAR = HeadingGrammar(DOC2JSON_HEADING_RULES)
+
+
+# --- Đối chiếu với các regex riêng lẻ của bản trước khi gộp (chép nguyên văn, áp dụng theo đúng thứ tự cũ) ---
+# process_docs_for_rag.py: bản cũ dán nhầm '<span class="math-inline">' / '</span>' vào cuối mẫu PHẨM/KINH nên hai mẫu này
+# không bao giờ khớp: chỉ dấu phân cách được nhận ra, mọi segment mang tên/metadata "Không xác định".
+# SEGMENT_HEADING_RULES sửa lỗi đó, nên khác biệt ở đây là thay đổi đầu ra có chủ đích (được báo cáo, không coi là lỗi).
+_BASELINE_SEGMENT_REGEXES = [
+    ("delimiter", re.compile(r'---o0o---', re.IGNORECASE).search),
+    ("pham", re.compile(
+        r'^(PHẨM|PHẦN|CHƯƠNG)\s+(THỨ\s+)?([IVXLCDM\d]+|[A-ZĐ][a-zđÀ-Ỹ]+)\s*[:\.]?\s*(.*)<span class="math-inline">',
+        re.IGNORECASE).match),
+    ("kinh", re.compile(r'^((\d+(\.|\s+)?)|(KINH\s+))\s*(.+)</span>', re.IGNORECASE).match),
+]
+# xbk-extract_docx2json.py: bộ quy tắc gộp phải phân loại giống hệt các regex này
+_BASELINE_DOC2JSON_REGEXES = [
+    ("pham", re.compile(r"^(?:\d{1,2}\.\s*)?PHẨM\s+(.+)$", re.IGNORECASE).match),
+    ("phan", re.compile(r"^PHẦN\s+(\d+)$", re.IGNORECASE).match),
+    ("kinh", re.compile(r"^(\d{1,3})\.\s*KINH\s+(.+)$", re.IGNORECASE).match),
+    ("delimiter", lambda text: text.replace(" ", "").replace("\t", "") in ["---o0o---", "o0o"]),
+]
+
+
+def _baseline_kind(regexes, text):
+    return next((kind for kind, matcher in regexes if matcher(text)), None)
+
+
+def _read_paragraphs(docx_paths):
+    from docx_stream import iter_docx_paragraphs
+
+    paragraphs = []
+    for path in docx_paths:
+        paragraphs.extend(text.strip() for text in iter_docx_paragraphs(path) if text.strip())
+    print(f"Đã đọc {len(paragraphs)} đoạn văn từ {len(docx_paths)} file DOCX.")
+    return paragraphs
+
+
+def run_check(docx_paths):
+    """
+    Phân loại từng đoạn văn bằng bộ quy tắc gộp và bằng các regex của bản cũ, in số đoạn khác nhau theo từng cặp
+    (cũ -> mới) kèm ví dụ. DOC2JSON phải giống hệt bản cũ; SEGMENT khác có chủ đích (xem _BASELINE_SEGMENT_REGEXES).
+    Trả về True nếu DOC2JSON không có khác biệt nào.
+    """
+    paragraphs = _read_paragraphs(docx_paths)
+    passed = True
+    for name, grammar, baseline, must_match in (
+            ("SEGMENT", SEGMENT_HEADING_GRAMMAR, _BASELINE_SEGMENT_REGEXES, False),
+            ("DOC2JSON", DOC2JSON_HEADING_GRAMMAR, _BASELINE_DOC2JSON_REGEXES, True)):
+        changes = Counter()
+        examples = {}
+        for text in paragraphs:
+            old_kind = _baseline_kind(baseline, text) or "text"
+            kind = (grammar.classify(text) or HeadingMatch("text", {})).kind
+            if kind != old_kind:
+                changes[(old_kind, kind)] += 1
+                examples.setdefault((old_kind, kind), []).append(text[:60])
+        total = sum(changes.values())
+        print(f"[{name}] {total} đoạn phân loại khác bản cũ" + ("" if must_match else " (thay đổi có chủ đích)"))
+        for (old_kind, kind), count in changes.most_common():
+            print(f"    {old_kind} -> {kind}: {count}, ví dụ: {examples[(old_kind, kind)][:3]}")
+        if must_match and total:
+            passed = False
+    return passed
+
+
+# --- Micro-benchmark: số đoạn văn/giây trên các file .docx mẫu ---
+def run_benchmark(docx_paths, repeat=5):
+    paragraphs = _read_paragraphs(docx_paths)
+
+    for name, grammar in (("SEGMENT", SEGMENT_HEADING_GRAMMAR), ("DOC2JSON", DOC2JSON_HEADING_GRAMMAR)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            kinds = Counter((grammar.classify(text) or HeadingMatch("text", {})).kind for text in paragraphs)
+            best = min(best, time.perf_counter() - start)
+        print(f"[{name}] {len(paragraphs) / best:,.0f} đoạn/giây ({best * 1000:.1f} ms) - {dict(kinds)}")
+
+
+if __name__ == "__main__":
+    # python heading_grammar.py [--check] [file.docx ...]
+    check = "--check" in sys.argv[1:]
+    paths = [arg for arg in sys.argv[1:] if arg != "--check"] or sorted(glob.glob(os.path.join("input_docs", "*.docx")) + glob.glob(os.path.join("data", "*.docx")))
+    if not paths:
+        print("Không tìm thấy file .docx nào để benchmark.")
+        sys.exit(0)
+    if check:
+        sys.exit(0 if run_check(paths) else 1)
+    run_benchmark(paths)
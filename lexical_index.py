@@ -0,0 +1,227 @@
+# lexical_index.py
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+# Chỉ mục từ (BM25) của các chunk trong một collection ChromaDB, để tìm kiếm lai từ khóa + vector trong xbk-rag_service.py.
+# Tìm kiếm vector hay bỏ sót tên kinh, thuật ngữ Pali/Sanskrit ("Kỳ-xà-quật", "Bạt-kỳ") và các pháp số ("năm sanh pháp")
+# mà người dùng gõ có dấu hoặc không dấu. Mỗi âm tiết được đánh chỉ mục ở dạng có dấu và dạng bỏ dấu
+# ("pháp" -> "pháp", "phap"): câu hỏi không dấu khớp dạng bỏ dấu, câu hỏi có dấu khớp cả hai (khớp đúng dấu được cộng điểm).
+# Chữ Hán được tách thành từng chữ. Ngoài nội dung, các trường tên kinh trong metadata cũng được đánh chỉ mục.
+# Chỉ mục được dựng lúc embed (xbk-embed_to_chroma.py) trên cùng các ID chunk, lưu trong
+# <CHROMA_PERSIST_DIR>/<collection>.lexical.sqlite3 và bị xóa cùng thế hệ collection của nó.
+# Kết quả được trộn với kết quả vector bằng reciprocal rank fusion (RRF), mỗi tầng một hằng số k:
+#   LEXICAL_TOP_K=20 (số kết quả mỗi tầng trước khi trộn, 0 = chỉ tìm vector),  RRF_K_VECTOR=60,  RRF_K_LEXICAL=60
+
+LEXICAL_SUFFIX = ".lexical.sqlite3"
+LEXICAL_TOP_K = int(os.getenv("LEXICAL_TOP_K", "20"))
+RRF_K_VECTOR = int(os.getenv("RRF_K_VECTOR", "60"))
+RRF_K_LEXICAL = int(os.getenv("RRF_K_LEXICAL", "60"))
+LEXICAL_METADATA_FIELDS = ("Tên Kinh Đầy Đủ", "Tên Kinh Nhỏ", "Bộ", "Tên Tiếng Hán", "Số Phẩm")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Âm tiết có trong hơn tỉ lệ này số chunk ("của", "là", "người") gần như không phân biệt được chunk nào
+# mà danh sách chunk chứa nó lại dài nhất, nên bị bỏ qua khi câu hỏi còn từ khác hiếm hơn.
+MAX_DF_RATIO = 0.2
+LOOKUP_BATCH_SIZE = 500
+
+_TOKEN = re.compile(r"\w+")
+_HAN = re.compile(r"[\u3400-\u9fff]")
+
+
+def fold_token(token):
+    """Bỏ dấu tiếng Việt của một âm tiết đã viết thường: "pháp" -> "phap", "đế" -> "de"."""
+    token = unicodedata.normalize("NFD", token.replace("đ", "d"))
+    return unicodedata.normalize("NFC", "".join(c for c in token if unicodedata.category(c) != "Mn"))
+
+
+def tokenize(text):
+    """Các âm tiết (chữ thường, NFC) của văn bản; chuỗi chữ Hán được tách thành từng chữ."""
+    tokens = []
+    for token in _TOKEN.findall(unicodedata.normalize("NFC", text or "").lower()):
+        if _HAN.search(token):
+            tokens.extend(_TOKEN.findall(_HAN.sub(lambda m: f" {m.group()} ", token)))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def index_terms(tokens):
+    """Dạng được đánh chỉ mục của các âm tiết: chính nó, và thêm dạng bỏ dấu nếu khác."""
+    terms = []
+    for token in tokens:
+        terms.append(token)
+        folded = fold_token(token)
+        if folded != token:
+            terms.append(folded)
+    return terms
+
+
+def chunk_text(doc):
+    """Văn bản được đánh chỉ mục của một chunk: nội dung và các trường tên kinh trong metadata."""
+    metadata = doc.get('metadata') or {}
+    fields = [str(metadata[field]) for field in LEXICAL_METADATA_FIELDS if metadata.get(field)]
+    return "\n".join(fields + [doc.get('content') or ""])
+
+
+def reciprocal_rank_fusion(rankings):
+    """
+    rankings: [(danh sách ID theo thứ hạng, k của tầng đó)]. Điểm của một ID là tổng 1 / (k + hạng) trên các tầng
+    có nó (hạng bắt đầu từ 1). Trả về danh sách (ID, điểm) theo điểm giảm dần, hòa thì theo thứ tự tầng đầu tiên.
+    """
+    scores = {}
+    for ids, k in rankings:
+        for rank, chunk_id in enumerate(ids, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def lexical_index_path(persist_dir, collection_name):
+    return os.path.join(persist_dir or ".", collection_name + LEXICAL_SUFFIX)
+
+
+def remove_lexical_index(persist_dir, collection_name):
+    path = lexical_index_path(persist_dir, collection_name)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class LexicalIndex:
+    """
+    Chỉ mục BM25 trên một file SQLite: postings (âm tiết, ID chunk) -> số lần xuất hiện, df của từng âm tiết,
+    độ dài từng chunk, và tổng số chunk/tổng độ dài trong bảng meta. add()/remove() cập nhật theo lô trong
+    một giao dịch (chunk đã có được thay thế), nên chỉ mục theo kịp từng lô embed. Dùng được từ nhiều luồng (có khóa);
+    bên đọc (rag_service) và bên ghi (embed_to_chroma) có thể mở cùng file nhờ chế độ WAL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER NOT NULL) WITHOUT ROWID")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, id)
+                ) WITHOUT ROWID""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS postings_by_id ON postings (id)")
+
+    def count(self):
+        with self._lock:
+            return self._stat("docs")
+
+    def _stat(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _delete(self, ids):
+        for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            batch = ids[i:i + LOOKUP_BATCH_SIZE]
+            marks = ','.join('?' * len(batch))
+            old_terms = self.conn.execute(f"SELECT term FROM postings WHERE id IN ({marks})", batch).fetchall()
+            self.conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", old_terms)
+            self.conn.execute(f"DELETE FROM postings WHERE id IN ({marks})", batch)
+            self.conn.execute(f"DELETE FROM docs WHERE id IN ({marks})", batch)
+        self.conn.execute("DELETE FROM terms WHERE df <= 0")
+
+    def _update_stats(self):
+        docs, total_length = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [("docs", docs), ("total_length", total_length)])
+
+    def add(self, docs):
+        """Đánh chỉ mục (hoặc đánh lại) các chunk {'_id', 'content', 'metadata'}."""
+        docs = list({doc['_id']: doc for doc in docs}.values())
+        if not docs:
+            return
+        with self._lock, self.conn:
+            self._delete([doc['_id'] for doc in docs])
+            postings, lengths, df = [], [], Counter()
+            for doc in docs:
+                tokens = tokenize(chunk_text(doc))
+                counts = Counter(index_terms(tokens))
+                postings.extend((term, doc['_id'], tf) for term, tf in counts.items())
+                lengths.append((doc['_id'], len(tokens)))
+                df.update(counts.keys())
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            self.conn.executemany("INSERT INTO docs VALUES (?, ?)", lengths)
+            self.conn.executemany("INSERT INTO terms VALUES (?, ?) ON CONFLICT (term) DO UPDATE SET df = df + excluded.df",
+                                  list(df.items()))
+            self._update_stats()
+
+    def remove(self, ids):
+        with self._lock, self.conn:
+            self._delete(list(ids))
+            self._update_stats()
+
+    def clear(self):
+        with self._lock, self.conn:
+            for table in ("postings", "terms", "docs", "meta"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    def search(self, query, limit=LEXICAL_TOP_K):
+        """Tối đa `limit` chunk [(ID, điểm BM25)] theo điểm giảm dần."""
+        query_terms = list(dict.fromkeys(index_terms(tokenize(query))))
+        if not query_terms or limit <= 0:
+            return []
+        with self._lock:
+            total_docs = self._stat("docs")
+            if not total_docs:
+                return []
+            average_length = self._stat("total_length") / total_docs or 1.0
+            frequencies = {}
+            for i in range(0, len(query_terms), LOOKUP_BATCH_SIZE):
+                batch = query_terms[i:i + LOOKUP_BATCH_SIZE]
+                frequencies.update(self.conn.execute(
+                    f"SELECT term, df FROM terms WHERE term IN ({','.join('?' * len(batch))})", batch))
+            if not frequencies:
+                return []
+            rare = {term: df for term, df in frequencies.items() if df <= MAX_DF_RATIO * total_docs}
+            frequencies = rare or dict(sorted(frequencies.items(), key=lambda item: item[1])[:2])
+
+            postings = []
+            for term, df in frequencies.items():
+                idf = math.log(1.0 + (total_docs - df + 0.5) / (df + 0.5))
+                postings.extend((chunk_id, tf, idf) for chunk_id, tf in
+                                self.conn.execute("SELECT id, tf FROM postings WHERE term = ?", (term,)))
+            ids = list({chunk_id for chunk_id, _, _ in postings})
+            lengths = {}
+            for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                batch = ids[i:i + LOOKUP_BATCH_SIZE]
+                lengths.update(self.conn.execute(
+                    f"SELECT id, length FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch))
+
+        scores = Counter()
+        for chunk_id, tf, idf in postings:
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths.get(chunk_id, average_length) / average_length)
+            scores[chunk_id] += idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+        return scores.most_common(limit)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_lexical_index(persist_dir, collection_name, create=False):
+    """Chỉ mục từ của collection; với create=False trả về None nếu collection chưa có chỉ mục (chỉ tìm vector)."""
+    path = lexical_index_path(persist_dir, collection_name)
+    if not create and not os.path.exists(path):
+        return None
+    return LexicalIndex(path)
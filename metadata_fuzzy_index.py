@@ -0,0 +1,90 @@
+# metadata_fuzzy_index.py
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+# Chỉ mục tìm kiếm gần đúng (không phân biệt dấu) cho metadata các bộ kinh.
+# Dùng để khớp tên suy ra từ tên file (ví dụ "Kinh Truong A Ham HT Tue Sy Dich")
+# với một mục trong cache/metadata_index.json mà không cần gọi LLM.
+
+# Các trường tiêu đề được đưa vào chỉ mục (ngoài khóa của mục). Không gồm "Bộ": tên bộ ngắn như "Trường A Hàm"
+# nằm trọn trong tên file của mọi kinh thuộc bộ đó, nên sẽ đạt điểm chấp nhận cho cả kinh khác bộ kinh đã có trong cache.
+INDEXED_FIELDS = ("Tên Kinh Đầy Đủ", "Tên Kinh rút gọn", "Tên Tiếng Hán")
+
+MIN_CONFIDENT_SCORE = 0.85 # Điểm tối thiểu để chấp nhận một kết quả mà không cần hỏi LLM
+MIN_CONFIDENT_MARGIN = 0.1 # Khoảng cách tối thiểu với ứng viên tốt thứ hai (khác mục)
+
+
+def fold_text(s):
+    """
+    Chuẩn hóa chuỗi để so khớp: chữ thường, bỏ dấu tiếng Việt, chỉ giữ chữ/số Latin và chữ Hán.
+    Ví dụ: "Trường A Hàm" -> "truongaham", "長阿含經" -> "長阿含經".
+    """
+    if not isinstance(s, str):
+        return ""
+    s = unicodedata.normalize('NFD', s.lower().replace('đ', 'd'))
+    s = ''.join(c for c in s if unicodedata.category(c) != 'Mn') # Loại bỏ dấu
+    return re.sub(r'[^a-z0-9\u3400-\u9fff]', '', s)
+
+
+def trigrams(folded):
+    """Tập trigram ký tự của một chuỗi đã chuẩn hóa (chuỗi ngắn hơn 3 ký tự được coi là một gram)."""
+    if len(folded) < 3:
+        return {folded} if folded else set()
+    return {folded[i:i + 3] for i in range(len(folded) - 2)}
+
+
+class MetadataFuzzyIndex:
+    """
+    Chỉ mục trigram dựng sẵn trên khóa và các trường tiêu đề của từng mục metadata.
+    Điểm của một ứng viên = 0.75 * (tỷ lệ trigram của tiêu đề có trong truy vấn) + 0.25 * hệ số Dice,
+    nên tên file có thêm hậu tố (tên dịch giả, "HT-Tue-Sy-Dich"...) vẫn khớp đúng bộ kinh.
+    """
+    def __init__(self, metadata_entries):
+        self._postings = defaultdict(list) # trigram -> [mã tiêu đề]
+        self._titles = [] # mã tiêu đề -> (khóa mục, tên trường, số trigram)
+        for key, meta in metadata_entries.items():
+            self._add(key, "key", key)
+            if isinstance(meta, dict):
+                for field in INDEXED_FIELDS:
+                    self._add(key, field, meta.get(field))
+
+    def _add(self, key, field, title):
+        if title == "Not_Available":
+            return
+        grams = trigrams(fold_text(title))
+        if not grams:
+            return
+        title_id = len(self._titles)
+        self._titles.append((key, field, len(grams)))
+        for gram in grams:
+            self._postings[gram].append(title_id)
+
+    def __len__(self):
+        return len(self._titles)
+
+    def search(self, query, limit=5):
+        """Trả về tối đa `limit` ứng viên [(điểm, khóa mục, trường khớp)], mỗi mục một lần, điểm giảm dần."""
+        query_grams = trigrams(fold_text(query))
+        if not query_grams:
+            return []
+        hits = Counter()
+        for gram in query_grams:
+            hits.update(self._postings.get(gram, ()))
+
+        best_per_key = {}
+        for title_id, shared in hits.items():
+            key, field, title_size = self._titles[title_id]
+            score = 0.75 * shared / title_size + 0.25 * 2 * shared / (title_size + len(query_grams))
+            if score > best_per_key.get(key, (0.0,))[0]:
+                best_per_key[key] = (score, key, field)
+        return sorted(best_per_key.values(), key=lambda c: c[0], reverse=True)[:limit]
+
+    def best_match(self, query, min_score=MIN_CONFIDENT_SCORE, min_margin=MIN_CONFIDENT_MARGIN):
+        """Trả về khóa của mục khớp chắc chắn với truy vấn, hoặc None nếu không đủ tin cậy."""
+        candidates = self.search(query, limit=2)
+        if not candidates or candidates[0][0] < min_score:
+            return None
+        if len(candidates) > 1 and candidates[0][0] - candidates[1][0] < min_margin:
+            return None
+        return candidates[0][1]
@@ -0,0 +1,98 @@
+# parallel_encoder.py
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from embedding_backend import EMBEDDING_BACKEND
+
+# Encode trên CPU bằng nhiều tiến trình, theo các nhóm chunk có độ dài token gần nhau.
+# Một lô được sắp theo số token rồi cắt thành các nhóm ENCODE_BUCKET_SIZE chunk: mỗi nhóm chỉ phải pad tới chunk
+# dài nhất của chính nó (tiêu đề ngắn không bị pad tới độ dài đoạn kinh dài nhất). Các nhóm được chia cho
+# ENCODE_WORKERS tiến trình, mỗi tiến trình một bản mô hình, và kết quả được xếp lại đúng thứ tự ban đầu.
+
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "1")) # 1 = encode ngay trong tiến trình chính
+ENCODE_BUCKET_SIZE = int(os.getenv("ENCODE_BUCKET_SIZE", "32")) # Số chunk mỗi nhóm độ dài (mỗi lượt forward)
+
+_worker_model = None
+
+
+def _init_worker(model_name, backend, torch_threads):
+    """Chạy một lần trong mỗi tiến trình con: tải mô hình và chia đều số luồng CPU giữa các tiến trình."""
+    global _worker_model
+    import torch
+    from embedding_backend import load_embedding_model
+    torch.set_num_threads(torch_threads)
+    _worker_model = load_embedding_model(model_name, backend)
+
+
+def _encode_bucket(texts):
+    return np.asarray(_worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False), dtype=np.float32)
+
+
+def token_lengths(model, texts):
+    """Số token của từng văn bản theo tokenizer của mô hình (số ký tự nếu mô hình không có tokenizer)."""
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is not None:
+        try:
+            return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        except Exception:
+            pass
+    return [len(text) for text in texts]
+
+
+def length_buckets(lengths, bucket_size=ENCODE_BUCKET_SIZE):
+    """Chia các vị trí thành nhóm bucket_size phần tử có độ dài gần nhau, nhóm dài nhất trước (việc nặng được giao sớm)."""
+    order = sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True)
+    return [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+
+class ParallelEncoder:
+    """
+    Bọc mô hình với encode(texts) tương thích model.encode (trả về mảng float32, một hàng mỗi văn bản, đúng thứ tự),
+    nên dùng được thay cho mô hình trong pipeline embed và EmbeddingCache.encode.
+    num_workers > 1: các nhóm độ dài được encode trong ProcessPoolExecutor (tiến trình "spawn", không fork tiến trình
+    đang chạy luồng của PyTorch); num_workers = 1: encode lần lượt từng nhóm ngay trong tiến trình chính.
+    """
+
+    def __init__(self, model, model_name, num_workers=ENCODE_WORKERS, bucket_size=ENCODE_BUCKET_SIZE,
+                 backend=EMBEDDING_BACKEND):
+        self.model = model
+        self.bucket_size = bucket_size
+        self.pool = None
+        if num_workers > 1:
+            torch_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            self.pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker, initargs=(model_name, backend, torch_threads))
+
+    def encode(self, texts, **encode_kwargs):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        buckets = length_buckets(token_lengths(self.model, texts), self.bucket_size)
+        bucket_texts = [[texts[i] for i in bucket] for bucket in buckets]
+        if self.pool is not None:
+            results = self.pool.map(_encode_bucket, bucket_texts)
+        else:
+            encode_kwargs = dict(encode_kwargs, show_progress_bar=False)
+            results = (self.model.encode(batch, **dict(encode_kwargs, batch_size=len(batch))) for batch in bucket_texts)
+
+        embeddings = None
+        for bucket, vectors in zip(buckets, results):
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[bucket] = vectors
+        return embeddings
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
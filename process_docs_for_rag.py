@@ -1,11 +1,23 @@
-from docx import Document
+import asyncio
 import json
 import os
+import hashlib
+import contextlib
 import re
+import tempfile
 from unidecode import unidecode
 import google.generativeai as genai
 from tqdm import tqdm
 import time
+import multiprocessing
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from docx_stream import iter_docx_paragraphs
+from metadata_fuzzy_index import MetadataFuzzyIndex
+from heading_grammar import SEGMENT_HEADING_GRAMMAR, parse_numeral
+from segment_store import SegmentShardWriter
+from fulltext_store import FullTextWriter
 
 # --- Cấu hình ---
 # Đặt API Key của Google trực tiếp vào đây cho mục đích TEST.
@@ -20,6 +32,18 @@ INPUT_DIR = "input_docs" # Đặt các file .docx của bạn vào đây
 OUTPUT_DIR = "output_json_segments" # Các file JSON của từng chương/phẩm sẽ được lưu ở đây
 FULL_DOC_JSON_DIR = "output_full_doc_json" # Thư mục lưu JSON của toàn bộ file DOCX
 METADATA_CACHE_FILE = "metadata_dai_chanh.json" # File cache metadata chung cho các bộ kinh
+MANIFEST_FILE = "ingest_manifest.json" # Manifest: hash file nguồn -> các file JSON đã sinh ra (để chạy lại tăng dần)
+PARSER_VERSION = "4" # Tăng khi thay đổi logic trích xuất để buộc xử lý lại toàn bộ (4: nhận diện tiêu đề PHẨM/KINH)
+# Định dạng lưu segment: "json" (mỗi kinh nhỏ một file JSON) hoặc "jsonl"/"jsonl.gz" (mỗi bộ kinh một shard, xem segment_store.py)
+SEGMENT_OUTPUT_FORMAT = os.getenv("SEGMENT_OUTPUT_FORMAT", "json")
+# Định dạng lưu toàn bộ tài liệu: "json" (một chuỗi noi_dung_full_doc) hoặc "text" (.txt + chỉ mục offset, xem fulltext_store.py)
+FULL_DOC_OUTPUT_FORMAT = os.getenv("FULL_DOC_OUTPUT_FORMAT", "json")
+
+# Cấu hình xử lý song song và giới hạn tốc độ gọi Gemini
+NUM_WORKERS = int(os.getenv("NUM_WORKERS", os.cpu_count() or 1)) # Số tiến trình xử lý DOCX (1 = tuần tự)
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "30")) # Ngân sách số lần gọi Gemini mỗi phút
+LLM_BURST = 1 # Số lần gọi tối đa được phép dồn liền nhau
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8")) # Số truy vấn Gemini chạy đồng thời khi làm giàu metadata theo lô
 
 # Ánh xạ tên file DOCX tới tên kinh đầy đủ (nếu tên file không đủ rõ ràng để LLM nhận diện)
 FILE_TO_META_KEY = {
@@ -70,21 +94,101 @@ def load_metadata_cache(path):
     return {}
 
 def save_metadata_cache(data, path):
-    """Lưu cache metadata vào file JSON."""
+    """Lưu cache metadata vào file JSON (ghi ra file tạm rồi đổi tên, để file cache không bao giờ bị ghi dở)."""
+    tmp_path = path + ".tmp"
     try:
-        with open(path, "w", encoding="utf-8") as f:
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
         print_status(f"Đã lưu cache metadata vào '{path}'.", "OK")
     except IOError as e:
         print_status(f"Lỗi khi lưu cache metadata vào '{path}': {e}", "ERR")
 
+class TokenBucket:
+    """
+    Bộ giới hạn tốc độ kiểu token bucket, dùng chung được giữa nhiều tiến trình.
+    Mỗi lần gọi Gemini tiêu tốn 1 token; token được nạp lại theo `rate_per_minute`.
+    """
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = multiprocessing.Value('d', float(capacity)) # Value có sẵn lock dùng chung
+        self._last_refill = multiprocessing.Value('d', time.monotonic(), lock=False)
+
+    def try_acquire(self):
+        """Lấy 1 token nếu có. Trả về 0 khi thành công, ngược lại là số giây cần chờ."""
+        if self.rate <= 0:
+            return 0.0 # Không giới hạn tốc độ
+        with self._tokens.get_lock():
+            now = time.monotonic()
+            tokens = min(self.capacity, self._tokens.value + (now - self._last_refill.value) * self.rate)
+            self._last_refill.value = now
+            if tokens >= 1:
+                self._tokens.value = tokens - 1
+                return 0.0
+            self._tokens.value = tokens
+            return (1 - tokens) / self.rate
+
+    def acquire(self):
+        """Chờ (blocking) cho tới khi lấy được 1 token."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+# Bộ giới hạn tốc độ cho các lần gọi Gemini thật sự (cache hit không tốn token)
+LLM_RATE_LIMITER = TokenBucket(LLM_REQUESTS_PER_MINUTE, LLM_BURST)
+
+def file_sha256(path):
+    """Tính SHA-256 của một file (đọc theo từng khối)."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_manifest(path):
+    """Tải manifest xử lý tăng dần; trả về manifest rỗng nếu chưa có hoặc lỗi."""
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            print_status(f"Lỗi đọc manifest '{path}': {e}. Sẽ xử lý lại toàn bộ.", "WARN")
+    return {"documents": {}}
+
+def save_manifest(manifest, path):
+    """Lưu manifest (ghi ra file tạm rồi đổi tên để không bao giờ để lại file hỏng)."""
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except IOError as e:
+        print_status(f"Lỗi khi lưu manifest vào '{path}': {e}", "ERR")
+
+def write_json_if_changed(output_path, json_data, previous_digest=None):
+    """
+    Ghi json_data (indent=4) ra output_path nếu nội dung khác với lần ghi trước (previous_digest).
+    Trả về (sha256 của nội dung, có ghi file hay không).
+    """
+    json_text = json.dumps(json_data, indent=4, ensure_ascii=False)
+    digest = hashlib.sha256(json_text.encode("utf-8")).hexdigest()
+    if digest == previous_digest and os.path.exists(output_path):
+        return digest, False
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(json_text)
+    return digest, True
+
 ## Chức năng Làm giàu Metadata từ LLM (Gemini)
 
 
-def search_dai_chanh_metadata_online(ten_kinh_viet_nam):
+def search_dai_chanh_metadata_online(ten_kinh_viet_nam, use_rate_limiter=True):
     """
     Truy vấn LLM (Gemini) để lấy thông tin metadata chi tiết về bộ kinh.
     Trả về một dictionary chứa metadata hoặc một dictionary rỗng nếu lỗi/không tìm thấy.
+    use_rate_limiter=False khi nơi gọi đã tự giới hạn tốc độ (ví dụ MetadataEnricher).
     """
     print_status(f"Đang truy vấn Gemini LLM để tìm metadata cho '{ten_kinh_viet_nam}'...", "INFO")
     
@@ -116,6 +220,8 @@ def search_dai_chanh_metadata_online(ten_kinh_viet_nam):
     """
 
     try:
+        if use_rate_limiter:
+            LLM_RATE_LIMITER.acquire() # Chỉ giới hạn tốc độ khi thực sự gọi Gemini
         response = LLM_MODEL.generate_content(
             prompt,
             generation_config={"response_mime_type": "application/json"},
@@ -151,23 +257,116 @@ def search_dai_chanh_metadata_online(ten_kinh_viet_nam):
         return {}
 
 
+## Làm giàu metadata theo lô (bất đồng bộ)
+
+class MetadataEnricher:
+    """
+    Tra cứu metadata cho nhiều bộ kinh đồng thời bằng asyncio.
+    Các truy vấn trùng tên chuẩn hóa đang chạy được gộp thành một; tốc độ gọi tuân theo token bucket.
+    `fetch` là hàm (đồng bộ hoặc async) nhận tên kinh và trả về dict metadata, có thể thay bằng LLM giả khi test.
+    """
+    def __init__(self, fetch, rate_limiter, max_concurrency=LLM_MAX_CONCURRENCY):
+        self._fetch = fetch
+        self._rate_limiter = rate_limiter
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = {} # tên chuẩn hóa -> task đang (hoặc đã) truy vấn
+
+    async def lookup(self, ten_kinh):
+        """Trả về (tên chuẩn hóa, metadata); metadata rỗng nếu không tìm thấy."""
+        norm_name = normalize_text(ten_kinh)
+        task = self._in_flight.get(norm_name)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_one(ten_kinh))
+            self._in_flight[norm_name] = task
+        return norm_name, await task
+
+    async def _wait_for_token(self):
+        while True:
+            wait = self._rate_limiter.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _fetch_one(self, ten_kinh):
+        async with self._semaphore:
+            await self._wait_for_token()
+            try:
+                if asyncio.iscoroutinefunction(self._fetch):
+                    return await self._fetch(ten_kinh)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(None, self._fetch, ten_kinh)
+            except Exception as e:
+                print_status(f"Lỗi khi tra cứu metadata cho '{ten_kinh}': {e}", "ERR")
+                return {}
+
+def enrich_metadata_cache(book_names, metadata_index_cache, metadata_cache_filepath, fetch=None,
+                          requests_per_minute=None, max_concurrency=LLM_MAX_CONCURRENCY, metadata_fuzzy_index=None):
+    """
+    Tra cứu đồng thời metadata cho tất cả các bộ kinh chưa có trong cache (kể cả khớp gần đúng), rồi ghi cache một lần duy nhất.
+    Trả về dict {tên chuẩn hóa: metadata} của các mục mới tìm được.
+    """
+    misses = [name for name in book_names
+              if find_cached_metadata(name, metadata_index_cache, metadata_fuzzy_index) is None]
+    if not misses:
+        return {}
+
+    if fetch is None:
+        fetch = lambda name: search_dai_chanh_metadata_online(name, use_rate_limiter=False)
+    rate_limiter = LLM_RATE_LIMITER if requests_per_minute is None else TokenBucket(requests_per_minute, LLM_BURST)
+
+    async def run():
+        enricher = MetadataEnricher(fetch, rate_limiter, max_concurrency)
+        return await asyncio.gather(*(enricher.lookup(name) for name in misses))
+
+    print_status(f"Đang tra cứu metadata cho {len(misses)} bộ kinh chưa có trong cache...", "INFO")
+    found = {norm_name: meta for norm_name, meta in asyncio.run(run()) if meta}
+    if found:
+        metadata_index_cache.update(found)
+        if metadata_cache_filepath:
+            save_metadata_cache(metadata_index_cache, metadata_cache_filepath)
+    print_status(f"Đã bổ sung metadata cho {len(found)}/{len(set(map(normalize_text, misses)))} bộ kinh.", "OK")
+    return found
+
 ## Hàm lấy Metadata chung (kết hợp cache và LLM)
 
-def get_main_book_metadata(ten_kinh_day_du, metadata_index_cache, metadata_cache_filepath):
+def find_cached_metadata(ten_kinh_day_du, metadata_index_cache, metadata_fuzzy_index=None):
+    """
+    Tìm metadata trong cache: khớp chính xác theo tên chuẩn hóa, nếu không có thì dùng chỉ mục gần đúng
+    (chỉ chấp nhận kết quả đủ tin cậy). Trả về mục metadata hoặc None.
     """
-    Lấy metadata của bộ kinh chính. Ưu tiên cache cục bộ, sau đó đến LLM,
+    norm_name = normalize_text(ten_kinh_day_du)
+    if norm_name in metadata_index_cache:
+        return metadata_index_cache[norm_name]
+    if metadata_fuzzy_index is not None:
+        matched_key = metadata_fuzzy_index.best_match(ten_kinh_day_du)
+        if matched_key in metadata_index_cache:
+            print_status(f"Khớp gần đúng '{ten_kinh_day_du}' với metadata '{matched_key}'.", "INFO")
+            return metadata_index_cache[matched_key]
+    return None
+
+def get_meta_key(docx_file_path, base_filename):
+    """Tên bộ kinh dùng để tra metadata (cache/LLM) cho một file DOCX."""
+    return FILE_TO_META_KEY.get(os.path.basename(docx_file_path), base_filename.replace("_", " "))
+
+def get_main_book_metadata(ten_kinh_day_du, metadata_index_cache, metadata_cache_filepath, metadata_fuzzy_index=None,
+                           online_lookup=True):
+    """
+    Lấy metadata của bộ kinh chính. Ưu tiên cache cục bộ (khớp chính xác rồi khớp gần đúng), sau đó đến LLM,
     cuối cùng trả về template rỗng.
+    online_lookup=False: chỉ đọc cache (bộ kinh đã được tra theo lô bằng enrich_metadata_cache, tra thất bại thì không hỏi lại).
     """
     norm_name = normalize_text(ten_kinh_day_du)
     
-    if norm_name in metadata_index_cache:
+    cached_meta = find_cached_metadata(ten_kinh_day_du, metadata_index_cache, metadata_fuzzy_index)
+    if cached_meta is not None:
         print_status(f"Đã tìm thấy metadata cục bộ cho '{ten_kinh_day_du}'.", "INFO")
-        return {k: metadata_index_cache[norm_name].get(k, "Not_Available") for k in META_KEYS_TEMPLATE if k not in ["Tên Kinh Nhỏ", "Số Phẩm", "Chia Đoạn"]}
+        return {k: cached_meta.get(k, "Not_Available") for k in META_KEYS_TEMPLATE if k not in ["Tên Kinh Nhỏ", "Số Phẩm", "Chia Đoạn"]}
 
-    online_meta = search_dai_chanh_metadata_online(ten_kinh_day_du)
+    online_meta = search_dai_chanh_metadata_online(ten_kinh_day_du) if online_lookup else {}
     if online_meta:
         metadata_index_cache[norm_name] = online_meta
-        save_metadata_cache(metadata_index_cache, metadata_cache_filepath)
+        if metadata_cache_filepath: # Trong tiến trình con, cache được tiến trình chính ghi lại
+            save_metadata_cache(metadata_index_cache, metadata_cache_filepath)
         return {k: online_meta.get(k, "Not_Available") for k in META_KEYS_TEMPLATE if k not in ["Tên Kinh Nhỏ", "Số Phẩm", "Chia Đoạn"]}
     
     print_status(f"==> Không tìm thấy metadata cho '{ten_kinh_day_du}' ở bất kỳ đâu! Sử dụng template rỗng.", "WARN")
@@ -175,29 +374,23 @@ def get_main_book_metadata(ten_kinh_day_du, metadata_index_cache, metadata_cache
 
 # Hàm Lưu đoạn kinh thành JSON
 
-def save_kinh_segment(content_list, pham_title, pham_idx, kinh_title, kinh_idx,
-                       chia_doan, main_book_meta, base_filename, output_dir):
+def build_kinh_segment(content_list, pham_title, pham_idx, kinh_title, kinh_idx, base_filename):
     """
-    Lưu một đoạn kinh (kinh nhỏ/phẩm) thành file JSON.
-    Hợp nhất metadata chung với metadata chi tiết.
+    Làm sạch nội dung và dựng tên của một đoạn kinh (kinh nhỏ/phẩm).
+    Trả về (tên segment không có đuôi file, metadata riêng của segment, nội dung đã làm sạch) hoặc None nếu rỗng.
     """
     if not content_list:
-        return
+        return None
 
     cleaned_content = [line for line in content_list if line.strip() and not re.match(r'^(-+o0o-+|-+O0O-+)$', line.strip())]
 
     if not cleaned_content:
-        return
+        return None
 
-    segment_meta = main_book_meta.copy()
-    
-    segment_meta["Tên Kinh Nhỏ"] = kinh_title if kinh_title != "Không xác định" else "Not_Available"
-    segment_meta["Số Phẩm"] = pham_title if pham_title != "Không xác định" else "Not_Available"
-    segment_meta["Chia Đoạn"] = chia_doan
-
-    for key in META_KEYS_TEMPLATE:
-        if key not in segment_meta:
-            segment_meta[key] = "Not_Available"
+    segment_fields = {
+        "Tên Kinh Nhỏ": kinh_title if kinh_title != "Không xác định" else "Not_Available",
+        "Số Phẩm": pham_title if pham_title != "Không xác định" else "Not_Available",
+    }
 
     # Tạo tên file JSON khoa học, hợp lý
     # Ví dụ: Kinh_Truong_A_Ham_pham_01_kinh_001_Ten_Kinh_Nho.json
@@ -215,27 +408,57 @@ def save_kinh_segment(content_list, pham_title, pham_idx, kinh_title, kinh_idx,
             file_name_parts.append(f"{kinh_slug}")
     
     # Đảm bảo tên file không quá dài và hợp lệ
-    final_json_filename = "_".join(file_name_parts).replace("__", "_").replace(" ", "_")
-    final_json_filename = re.sub(r'[\\/:*?"<>|]', '_', final_json_filename)[:200] + ".json"
-    
+    segment_name = "_".join(file_name_parts).replace("__", "_").replace(" ", "_")
+    segment_name = re.sub(r'[\\/:*?"<>|]', '_', segment_name)[:200]
+    return segment_name, segment_fields, cleaned_content
+
+def save_kinh_segment(content_list, pham_title, pham_idx, kinh_title, kinh_idx,
+                       chia_doan, main_book_meta, base_filename, output_dir, previous_hashes=None):
+    """
+    Lưu một đoạn kinh (kinh nhỏ/phẩm) thành file JSON.
+    Hợp nhất metadata chung với metadata chi tiết. File không được ghi lại nếu nội dung trùng với
+    hash trong previous_hashes (tên file -> sha256). Trả về (đường dẫn file, sha256) hoặc None.
+    """
+    segment = build_kinh_segment(content_list, pham_title, pham_idx, kinh_title, kinh_idx, base_filename)
+    if segment is None:
+        return
+    segment_name, segment_fields, cleaned_content = segment
+
+    segment_meta = main_book_meta.copy()
+    segment_meta.update(segment_fields)
+    segment_meta["Chia Đoạn"] = chia_doan
+
+    for key in META_KEYS_TEMPLATE:
+        if key not in segment_meta:
+            segment_meta[key] = "Not_Available"
+
+    final_json_filename = segment_name + ".json"
     output_path = os.path.join(output_dir, final_json_filename)
 
     json_data = {"metadata": segment_meta, "noi_dung": cleaned_content}
 
     try:
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(json_data, f, indent=4, ensure_ascii=False)
-        print_status(f"Đã lưu file segment: {os.path.basename(output_path)}", "OK")
+        digest, written = write_json_if_changed(output_path, json_data, (previous_hashes or {}).get(final_json_filename))
+        if written:
+            print_status(f"Đã lưu file segment: {final_json_filename}", "OK")
+        else:
+            print_status(f"Segment không thay đổi, bỏ qua: {final_json_filename}", "INFO")
+        return output_path, digest
     except IOError as e:
         print_status(f"Lỗi khi lưu file segment '{output_path}': {e}", "ERR")
 
-def save_full_doc_json(full_content_list, main_book_meta, base_filename, output_dir):
-    """
-    Lưu toàn bộ nội dung DOCX và metadata chung vào một file JSON duy nhất.
-    """
-    if not full_content_list:
-        return
-    
+def get_chia_doan(found_pham_structure, found_kinh_structure):
+    """Xác định cách chia đoạn dựa trên các cấu trúc đã nhận diện được."""
+    if found_pham_structure and found_kinh_structure:
+        return "Theo phẩm, theo kinh nhỏ"
+    if found_pham_structure:
+        return "Theo phẩm"
+    if found_kinh_structure:
+        return "Theo kinh nhỏ"
+    return "Không xác định"
+
+def build_full_doc_metadata(main_book_meta):
+    """Metadata của file toàn bộ tài liệu: metadata chung, các trường riêng của segment là Not_Available."""
     # Hợp nhất metadata chung
     full_doc_meta = main_book_meta.copy()
     # Đảm bảo các trường segment-specific là Not_Available nếu không có
@@ -246,177 +469,338 @@ def save_full_doc_json(full_content_list, main_book_meta, base_filename, output_
     for key in META_KEYS_TEMPLATE:
         if key not in full_doc_meta:
             full_doc_meta[key] = "Not_Available"
+    return full_doc_meta
 
-    full_content_string = "\n".join(full_content_list)
-    
-    output_path = os.path.join(output_dir, f"{base_filename}.json")
-
-    json_data = {"metadata": full_doc_meta, "noi_dung_full_doc": full_content_string}
-
-    try:
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(json_data, f, indent=4, ensure_ascii=False)
-        print_status(f"Đã lưu file toàn bộ DOCX: {os.path.basename(output_path)}", "OK")
-    except IOError as e:
-        print_status(f"Lỗi khi lưu file toàn bộ DOCX '{output_path}': {e}", "ERR")
+class FullDocJsonWriter:
+    """
+    Ghi toàn bộ nội dung DOCX và metadata chung vào một file JSON duy nhất theo kiểu streaming:
+    từng dòng được mã hóa và ghi ngay ra file tạm, không giữ toàn bộ tài liệu trong bộ nhớ.
+    Kết quả giống hệt json.dump(..., indent=4) của {"metadata": ..., "noi_dung_full_doc": "\\n".join(lines)}.
+    Nếu nội dung trùng với previous_digest thì file cũ được giữ nguyên.
+    """
+    def __init__(self, main_book_meta, base_filename, output_dir, previous_digest=None):
+        self.metadata = build_full_doc_metadata(main_book_meta)
+        self.output_path = os.path.join(output_dir, f"{base_filename}.json")
+        self._tmp_path = self.output_path + ".tmp"
+        self._file = None # Chỉ mở file khi có dòng đầu tiên (tài liệu rỗng thì không ghi gì)
+        self._sha = hashlib.sha256()
+        self.previous_digest = previous_digest
+
+    def _write(self, text):
+        self._file.write(text)
+        self._sha.update(text.encode("utf-8"))
+
+    def write_line(self, line):
+        if self._file is None:
+            self._file = open(self._tmp_path, "w", encoding="utf-8")
+            meta_json = json.dumps(self.metadata, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+            self._write('{\n    "metadata": ' + meta_json + ',\n    "noi_dung_full_doc": "')
+        else:
+            self._write("\\n")
+        self._write(json.dumps(line, ensure_ascii=False)[1:-1])
+
+    def close(self):
+        """Hoàn tất file. Trả về sha256 của nội dung (hoặc None nếu không ghi gì)."""
+        if self._file is None:
+            return None
+        try:
+            self._write('"\n}')
+            self._file.close()
+            digest = self._sha.hexdigest()
+            if digest == self.previous_digest and os.path.exists(self.output_path):
+                os.remove(self._tmp_path)
+                print_status(f"File toàn bộ DOCX không thay đổi: {os.path.basename(self.output_path)}", "INFO")
+            else:
+                os.replace(self._tmp_path, self.output_path)
+                print_status(f"Đã lưu file toàn bộ DOCX: {os.path.basename(self.output_path)}", "OK")
+            return digest
+        except IOError as e:
+            print_status(f"Lỗi khi lưu file toàn bộ DOCX '{self.output_path}': {e}", "ERR")
+            return None
+        finally:
+            self._file = None
+
+    def mark_boundary(self, kind, title, number):
+        """File JSON không lưu ranh giới PHẨM/KINH (chỉ định dạng "text" dùng)."""
+
+    def abort(self):
+        """Hủy file tạm khi quá trình trích xuất bị lỗi giữa chừng (gọi nhiều lần hoặc sau close() cũng không sao)."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
 
 # Hàm Trích xuất dữ liệu chính từ DOCX
 def extract_data_from_docx(docx_file_path, base_filename, segment_output_dir, full_doc_output_dir,
-                           metadata_index_cache, metadata_cache_filepath):
+                           metadata_index_cache, metadata_cache_filepath, previous_outputs=None,
+                           metadata_fuzzy_index=None, segment_output_format=SEGMENT_OUTPUT_FORMAT,
+                           full_doc_output_format=FULL_DOC_OUTPUT_FORMAT, online_lookup=True):
     """
     Trích xuất dữ liệu từ file DOCX, chia thành các phân đoạn và làm giàu metadata.
+    Tài liệu được đọc streaming; mỗi segment được ghi ra đĩa ngay khi gặp dấu phân cách kết thúc nó,
+    nên bộ nhớ sử dụng không phụ thuộc vào kích thước tài liệu.
+    previous_outputs là các hash của lần xử lý trước (từ manifest); file có nội dung không đổi sẽ không bị ghi lại.
+    segment_output_format "jsonl"/"jsonl.gz": các segment được ghi vào một shard duy nhất cho cả bộ kinh.
+    full_doc_output_format "text": toàn bộ tài liệu được ghi thành văn bản thuần kèm chỉ mục offset thay vì JSON.
+    online_lookup=False: metadata chỉ lấy từ cache, không gọi Gemini (xem get_main_book_metadata).
+    Trả về {"segments": {tên file: sha256}, "full_doc": {tên file: sha256}} hoặc None nếu lỗi.
     """
     print_status(f"Đang xử lý file DOCX: {docx_file_path}", "INFO")
 
     try:
-        document = Document(docx_file_path)
+        paragraphs = iter_docx_paragraphs(docx_file_path)
     except Exception as e:
         print_status(f"Không thể mở file DOCX '{docx_file_path}': {e}", "ERR")
-        return
-
-    meta_key_for_llm = FILE_TO_META_KEY.get(os.path.basename(docx_file_path), base_filename.replace("_", " "))
-    main_book_meta = get_main_book_metadata(meta_key_for_llm, metadata_index_cache, metadata_cache_filepath)
-
-    all_segments_data = [] # List để lưu trữ tất cả các segment nhỏ
-    full_doc_content_lines = [] # List để lưu trữ toàn bộ nội dung DOCX
-
-    current_kinh_content = []
-    current_pham_title = "Không xác định"
-    current_pham_idx = 0
-    current_kinh_title = "Không xác định"
-    current_kinh_idx = 0
+        return None
+
+    meta_key_for_llm = get_meta_key(docx_file_path, base_filename)
+    main_book_meta = get_main_book_metadata(meta_key_for_llm, metadata_index_cache, metadata_cache_filepath,
+                                            metadata_fuzzy_index, online_lookup)
+
+    previous_outputs = previous_outputs or {}
+    previous_segments = dict(previous_outputs.get("segments", {}))
+    full_doc_filename = f"{base_filename}.json"
+    if full_doc_output_format == "text":
+        full_doc_writer = FullTextWriter(build_full_doc_metadata(main_book_meta), base_filename, full_doc_output_dir,
+                                         previous_outputs.get("full_doc"))
+    else:
+        full_doc_writer = FullDocJsonWriter(main_book_meta, base_filename, full_doc_output_dir,
+                                            previous_outputs.get("full_doc", {}).get(full_doc_filename))
+    segment_hashes = {} # tên file segment -> sha256
+
+    shard_writer = contextlib.nullcontext()
+    if segment_output_format != "json":
+        shard_filename = f"{base_filename}.{segment_output_format}"
+        shard_writer = SegmentShardWriter(os.path.join(segment_output_dir, shard_filename), base_filename,
+                                          previous_segments.get(shard_filename))
+
+    # Lỗi bất ngờ giữa chừng (không chỉ lỗi đọc DOCX) cũng không để lại file tạm trong thư mục đầu ra
+    with full_doc_writer, shard_writer as shard_writer:
+        current_kinh_content = []
+        current_pham_title = "Không xác định"
+        current_pham_idx = 0
+        current_kinh_title = "Không xác định"
+        current_kinh_idx = 0
     
-    processing_main_content = False
-
-    found_pham_structure = False
-    found_kinh_structure = False
-
-    regex_delimiter = re.compile(r'---o0o---', re.IGNORECASE)
-    regex_pham = re.compile(
-        r'^(PHẨM|PHẦN|CHƯƠNG)\s+(THỨ\s+)?([IVXLCDM\d]+|[A-ZĐ][a-zđÀ-Ỹ]+)\s*[:\.]?\s*(.*)<span class="math-inline">',
-        re.IGNORECASE
-    )
-    regex_kinh = re.compile(
-        r'^((\d+(\.|\s+)?)|(KINH\s+))\s*(.+)</span>',
-        re.IGNORECASE
-    )
-
-    for paragraph in document.paragraphs:
-        text = paragraph.text.strip()
-        full_doc_content_lines.append(text) # Luôn thêm vào full_doc_content
-
-        if not text:
-            continue
-
-        is_delimiter = bool(regex_delimiter.search(text))
-        match_pham = regex_pham.match(text)
-        match_kinh = regex_kinh.match(text)
+        processing_main_content = False
+
+        found_pham_structure = False
+        found_kinh_structure = False
+        # 'Chia Đoạn' (metadata cấp bộ kinh) chỉ chắc chắn khi đã gặp cả PHẨM lẫn KINH, hoặc khi hết tài liệu.
+        # Các segment JSON xong trước thời điểm đó được gác tạm ra file (không giữ trong bộ nhớ) rồi ghi một lần với giá trị cuối.
+        chia_doan = None
+        pending_segments = None
+
+        def write_segment(content, pham_title, pham_idx, kinh_title, kinh_idx):
+            result = save_kinh_segment(
+                content,
+                pham_title,
+                pham_idx,
+                kinh_title,
+                kinh_idx,
+                chia_doan,
+                main_book_meta,
+                base_filename,
+                segment_output_dir,
+                previous_segments
+            )
+            if result:
+                output_path, digest = result
+                segment_hashes[os.path.basename(output_path)] = digest
+                # Trùng tên file trong cùng lần chạy thì lần ghi sau phải ghi đè, không so với hash cũ nữa
+                previous_segments.pop(os.path.basename(output_path), None)
+
+        def flush_segment():
+            """Ghi segment hiện tại ra đĩa, hoặc gác tạm nếu 'Chia Đoạn' chưa xác định."""
+            nonlocal pending_segments
+            if shard_writer is not None:
+                # 'Chia Đoạn' là metadata cấp bộ kinh, được ghi một lần vào đầu shard khi đóng
+                segment = build_kinh_segment(current_kinh_content, current_pham_title, current_pham_idx,
+                                             current_kinh_title, current_kinh_idx, base_filename)
+                if segment is not None:
+                    shard_writer.add_segment(*segment)
+                return
+            segment_args = [current_kinh_content, current_pham_title, current_pham_idx, current_kinh_title, current_kinh_idx]
+            if chia_doan is not None:
+                write_segment(*segment_args)
+                return
+            if pending_segments is None:
+                pending_segments = tempfile.TemporaryFile("w+", encoding="utf-8")
+            pending_segments.write(json.dumps(segment_args, ensure_ascii=False) + "\n")
+
+        def resolve_chia_doan():
+            """Chốt 'Chia Đoạn' và ghi các segment đang gác tạm (theo đúng thứ tự)."""
+            nonlocal chia_doan, pending_segments
+            chia_doan = get_chia_doan(found_pham_structure, found_kinh_structure)
+            if pending_segments is not None:
+                pending_segments.seek(0)
+                for line in pending_segments:
+                    write_segment(*json.loads(line))
+                pending_segments.close()
+                pending_segments = None
 
-        if is_delimiter:
-            if not processing_main_content:
-                processing_main_content = True
-                print_status("Đã phát hiện dấu phân cách '---o0o---', bắt đầu xử lý nội dung chính.", "INFO")
+        try:
+            for paragraph_text in paragraphs:
+                text = paragraph_text.strip()
+                full_doc_writer.write_line(text) # Luôn thêm vào full_doc_content
+
+                if not text:
+                    continue
+
+                # Một lần match duy nhất cho mọi loại tiêu đề (dấu phân cách > PHẨM/PHẦN/CHƯƠNG > KINH)
+                heading = SEGMENT_HEADING_GRAMMAR.classify(text)
+                heading_kind = heading.kind if heading else None
+
+                if heading_kind == "delimiter":
+                    if not processing_main_content:
+                        processing_main_content = True
+                        print_status("Đã phát hiện dấu phân cách '---o0o---', bắt đầu xử lý nội dung chính.", "INFO")
+                
+                    if current_kinh_content:
+                        flush_segment()
+                    current_kinh_content = []
+                    continue
+
+                if not processing_main_content:
+                    # Bỏ qua các đoạn trước khi gặp dấu phân cách đầu tiên (ví dụ: mục lục)
+                    continue
             
-            if current_kinh_content:
-                all_segments_data.append({
-                    "content": current_kinh_content,
-                    "pham_title": current_pham_title,
-                    "pham_idx": current_pham_idx,
-                    "kinh_title": current_kinh_title,
-                    "kinh_idx": current_kinh_idx
-                })
-            current_kinh_content = []
-            continue
-
-        if not processing_main_content:
-            # Bỏ qua các đoạn trước khi gặp dấu phân cách đầu tiên (ví dụ: mục lục)
-            continue
-        
-        if match_pham:
-            pham_type = match_pham.group(1).upper()
-            pham_num_raw = match_pham.group(3)
-            pham_name = match_pham.group(5) if match_pham.group(5) else ""
-
-            try:
-                if re.match(r'^[IVXLCDM]+$', pham_num_raw, re.IGNORECASE):
-                    roman_map_simple = {'I':1, 'V':5, 'X':10, 'L':50, 'C':100, 'D':500, 'M':1000}
-                    def roman_to_int_val(s):
-                        res = 0
-                        for i in range(len(s)):
-                            val = roman_map_simple.get(s[i],0)
-                            if i + 1 < len(s) and val < roman_map_simple.get(s[i+1],0):
-                                res -= val
-                            else:
-                                res += val
-                        return res
-                    current_pham_idx = roman_to_int_val(pham_num_raw.upper())
-                else:
-                    current_pham_idx = int(pham_num_raw)
-            except ValueError:
-                current_pham_idx += 1
-
-            current_pham_title = f"{pham_type} {pham_num_raw.upper()}: {pham_name.strip()}" if pham_name else f"{pham_type} {pham_num_raw.upper()}"
-            print_status(f"Nhận diện {pham_type}: {current_pham_title}", "INFO")
-            found_pham_structure = True
-            current_kinh_title = "Không xác định"
-            current_kinh_idx = 0
-            current_kinh_content.append(text)
-            continue
-
-        if match_kinh:
-            current_kinh_idx += 1
-            current_kinh_title = text.strip()
-            print_status(f"Nhận diện KINH: {current_kinh_title}", "INFO")
-            found_kinh_structure = True
-            current_kinh_content.append(text)
-            continue
-
-        current_kinh_content.append(text)
-
-    # Lưu đoạn kinh cuối cùng sau khi đã duyệt hết tài liệu
-    if current_kinh_content:
-        all_segments_data.append({
-            "content": current_kinh_content,
-            "pham_title": current_pham_title,
-            "pham_idx": current_pham_idx,
-            "kinh_title": current_kinh_title,
-            "kinh_idx": current_kinh_idx
-        })
-
-    # Xác định cách chia đoạn cuối cùng cho toàn bộ file
-    if found_pham_structure and found_kinh_structure:
-        final_chia_doan = "Theo phẩm, theo kinh nhỏ"
-    elif found_pham_structure:
-        final_chia_doan = "Theo phẩm"
-    elif found_kinh_structure:
-        final_chia_doan = "Theo kinh nhỏ"
-    else:
-        final_chia_doan = "Không xác định"
-    
-    # Lưu các segment nhỏ
-    for segment in all_segments_data:
-        save_kinh_segment(
-            segment["content"],
-            segment["pham_title"],
-            segment["pham_idx"],
-            segment["kinh_title"],
-            segment["kinh_idx"],
-            final_chia_doan,
-            main_book_meta,
-            base_filename,
-            segment_output_dir
-        )
+                if heading_kind == "pham":
+                    pham_type = heading.groups["type"].upper()
+                    pham_num_raw = heading.groups["num"]
+                    pham_name = heading.groups["name"] or ""
+
+                    pham_number = parse_numeral(pham_num_raw) # Chữ số, số La Mã hoặc số đếm tiếng Việt
+                    current_pham_idx = pham_number if pham_number is not None else current_pham_idx + 1
+
+                    current_pham_title = f"{pham_type} {pham_num_raw.upper()}: {pham_name.strip()}" if pham_name else f"{pham_type} {pham_num_raw.upper()}"
+                    print_status(f"Nhận diện {pham_type}: {current_pham_title}", "INFO")
+                    full_doc_writer.mark_boundary("pham", current_pham_title, current_pham_idx)
+                    found_pham_structure = True
+                    if chia_doan is None and found_kinh_structure:
+                        resolve_chia_doan()
+                    current_kinh_title = "Không xác định"
+                    current_kinh_idx = 0
+                    current_kinh_content.append(text)
+                    continue
+
+                if heading_kind == "kinh":
+                    current_kinh_idx += 1
+                    current_kinh_title = text.strip()
+                    print_status(f"Nhận diện KINH: {current_kinh_title}", "INFO")
+                    full_doc_writer.mark_boundary("kinh", current_kinh_title, current_kinh_idx)
+                    found_kinh_structure = True
+                    if chia_doan is None and found_pham_structure:
+                        resolve_chia_doan()
+                    current_kinh_content.append(text)
+                    continue
+
+                current_kinh_content.append(text)
+        except (zipfile.BadZipFile, ET.ParseError) as e:
+            print_status(f"Lỗi khi đọc nội dung file DOCX '{docx_file_path}': {e}", "ERR")
+            full_doc_writer.abort()
+            if shard_writer is not None:
+                shard_writer.abort()
+            if pending_segments is not None:
+                pending_segments.close()
+            return None
+
+        # Lưu đoạn kinh cuối cùng sau khi đã duyệt hết tài liệu
+        if current_kinh_content:
+            flush_segment()
+        if chia_doan is None:
+            resolve_chia_doan()
+
+        if shard_writer is not None:
+            book_meta = main_book_meta.copy()
+            book_meta["Chia Đoạn"] = chia_doan
+            for key in META_KEYS_TEMPLATE:
+                if key not in book_meta and key not in ("Tên Kinh Nhỏ", "Số Phẩm"):
+                    book_meta[key] = "Not_Available"
+            shard_digest = shard_writer.close(book_meta)
+            if shard_digest:
+                segment_hashes[shard_filename] = shard_digest
+                print_status(f"Đã lưu shard {shard_filename} ({shard_writer.segment_count} segment).", "OK")
     
-    # Lưu toàn bộ DOCX
-    save_full_doc_json(full_doc_content_lines, main_book_meta, base_filename, full_doc_output_dir)
-
-    print_status(f"Đã hoàn thành xử lý file: {os.path.basename(docx_file_path)}", "OK")
+        # Hoàn tất file toàn bộ DOCX
+        if full_doc_output_format == "text":
+            full_doc_hashes = full_doc_writer.close()
+            if full_doc_hashes:
+                status = "không thay đổi" if full_doc_writer.unchanged else "đã lưu"
+                print_status(f"Kho văn bản toàn bộ DOCX {status}: {base_filename}.txt ({len(full_doc_writer.boundaries)} ranh giới PHẨM/KINH)", "OK")
+        else:
+            full_doc_digest = full_doc_writer.close()
+            full_doc_hashes = {full_doc_filename: full_doc_digest} if full_doc_digest else {}
+
+        print_status(f"Đã hoàn thành xử lý file: {os.path.basename(docx_file_path)}", "OK")
+        return {
+            "segments": segment_hashes,
+            "full_doc": full_doc_hashes,
+        }
 
 ## Hàm xử lý tất cả các file DOCX trong thư mục
 
-def process_all_docs_in_directory(input_dir, segment_output_dir, full_doc_output_dir, metadata_cache_filepath):
+def get_metadata_fingerprint(docx_file_path, base_filename, metadata_cache, metadata_fuzzy_index=None):
+    """Hash của metadata đang có trong cache cho file DOCX (None nếu chưa có), để phát hiện metadata thay đổi."""
+    cached = find_cached_metadata(get_meta_key(docx_file_path, base_filename), metadata_cache, metadata_fuzzy_index)
+    if cached is None:
+        return None
+    return hashlib.sha256(json.dumps(cached, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def is_document_unchanged(entry, source_sha256, metadata_fingerprint, segment_output_dir, full_doc_output_dir,
+                          output_formats):
+    """
+    Kiểm tra file DOCX đã được xử lý với cùng nội dung, cùng parser, cùng metadata và cùng định dạng đầu ra
+    (output_formats: {"segments": ..., "full_doc": ...}), và đầu ra vẫn còn đủ.
+    """
+    if not entry or entry.get("sha256") != source_sha256 or entry.get("parser_version") != PARSER_VERSION:
+        return False
+    # Đổi SEGMENT_OUTPUT_FORMAT/FULL_DOC_OUTPUT_FORMAT: file định dạng cũ vẫn còn trên đĩa nhưng không còn là đầu ra mong muốn
+    if entry.get("output_formats") != output_formats:
+        return False
+    # Chưa có metadata (tra cứu lần trước thất bại): xử lý lại để được tra cứu thêm lần nữa thay vì giữ Not_Available mãi
+    if metadata_fingerprint is None or entry.get("metadata_sha256") != metadata_fingerprint:
+        return False
+    outputs = [os.path.join(segment_output_dir, name) for name in entry.get("segments", {})]
+    outputs += [os.path.join(full_doc_output_dir, name) for name in entry.get("full_doc", {})]
+    return all(os.path.exists(path) for path in outputs)
+
+def remove_stale_outputs(previous_entry, outputs, segment_output_dir, full_doc_output_dir):
+    """Xóa các file JSON mà lần xử lý trước đã sinh ra nhưng lần này không còn nữa."""
+    if not previous_entry:
+        return
+    for key, output_dir in (("segments", segment_output_dir), ("full_doc", full_doc_output_dir)):
+        for name in set(previous_entry.get(key, {})) - set(outputs.get(key, {})):
+            path = os.path.join(output_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+                print_status(f"Đã xóa file không còn dùng: {name}", "INFO")
+
+def _extract_worker(docx_file_path, base_filename, segment_output_dir, full_doc_output_dir, metadata_cache,
+                    previous_outputs, metadata_fuzzy_index, output_formats):
+    """Chạy extract_data_from_docx trong tiến trình con (chỉ đọc cache metadata). Trả về kết quả trích xuất."""
+    return extract_data_from_docx(docx_file_path, base_filename, segment_output_dir, full_doc_output_dir,
+                                  metadata_cache, None, previous_outputs, metadata_fuzzy_index,
+                                  output_formats["segments"], output_formats["full_doc"], online_lookup=False)
+
+def process_all_docs_in_directory(input_dir, segment_output_dir, full_doc_output_dir, metadata_cache_filepath,
+                                  num_workers=NUM_WORKERS, manifest_filepath=MANIFEST_FILE,
+                                  segment_output_format=SEGMENT_OUTPUT_FORMAT, full_doc_output_format=FULL_DOC_OUTPUT_FORMAT):
     """
     Xử lý tất cả các file .docx trong thư mục đầu vào.
+    Với num_workers > 1, các file được trích xuất song song trên một process pool.
+    Metadata còn thiếu được tra theo lô một lần trước khi trích xuất; bước trích xuất chỉ đọc cache, nên bộ kinh
+    tra thất bại không bị hỏi Gemini thêm lần nữa trong cùng lần chạy.
+    File DOCX không đổi (cùng hash, cùng PARSER_VERSION, cùng metadata, cùng định dạng đầu ra) so với manifest sẽ được bỏ qua;
+    file chưa có metadata trong cache luôn được xử lý lại (và tra cứu lại metadata).
     """
     if not os.path.exists(segment_output_dir):
         os.makedirs(segment_output_dir)
@@ -426,8 +810,11 @@ def process_all_docs_in_directory(input_dir, segment_output_dir, full_doc_output
         print_status(f"Đã tạo thư mục đầu ra cho toàn bộ DOCX: '{full_doc_output_dir}'", "INFO")
 
     metadata_cache = load_metadata_cache(metadata_cache_filepath)
+    metadata_fuzzy_index = MetadataFuzzyIndex(metadata_cache)
+    manifest = load_manifest(manifest_filepath)
+    documents = manifest.setdefault("documents", {})
 
-    doc_files = [f for f in os.listdir(input_dir) if f.endswith(".docx")]
+    doc_files = sorted(f for f in os.listdir(input_dir) if f.endswith(".docx"))
     
     if not doc_files:
         print_status(f"Không tìm thấy file .docx nào trong thư mục '{input_dir}'.", "WARN")
@@ -435,14 +822,78 @@ def process_all_docs_in_directory(input_dir, segment_output_dir, full_doc_output
 
     print_status(f"Tìm thấy {len(doc_files)} file .docx để xử lý.", "INFO")
 
-    for filename in tqdm(doc_files, desc="Đang xử lý DOCX"):
+    output_formats = {"segments": segment_output_format, "full_doc": full_doc_output_format}
+    jobs = [] # (tên file, đường dẫn, base_filename, sha256 nguồn)
+    for filename in doc_files:
         docx_file_path = os.path.join(input_dir, filename)
         base_filename = os.path.splitext(filename)[0].replace(" ", "_")
-        
-        extract_data_from_docx(docx_file_path, base_filename, segment_output_dir, full_doc_output_dir,
-                               metadata_cache, metadata_cache_filepath)
-        print_status(f"Hoàn thành xử lý '{filename}'.", "INFO")
-        time.sleep(2) # Giữ độ trễ 2 giây cho Gemini để tránh vượt giới hạn tốc độ API
+        source_sha256 = file_sha256(docx_file_path)
+        fingerprint = get_metadata_fingerprint(docx_file_path, base_filename, metadata_cache, metadata_fuzzy_index)
+        if is_document_unchanged(documents.get(filename), source_sha256, fingerprint,
+                                 segment_output_dir, full_doc_output_dir, output_formats):
+            print_status(f"Bỏ qua '{filename}': không thay đổi kể từ lần xử lý trước.", "INFO")
+            continue
+        jobs.append((filename, docx_file_path, base_filename, source_sha256))
+
+    # Xóa khỏi manifest (và xóa đầu ra) các file DOCX không còn trong thư mục đầu vào
+    for filename in set(documents) - set(doc_files):
+        remove_stale_outputs(documents.pop(filename), {}, segment_output_dir, full_doc_output_dir)
+
+    def record_outputs(filename, docx_file_path, base_filename, source_sha256, outputs):
+        """Cập nhật manifest sau khi một file DOCX được xử lý xong."""
+        if outputs is None:
+            return # Lỗi: giữ nguyên mục cũ để lần sau xử lý lại
+        previous_entry = documents.get(filename)
+        remove_stale_outputs(previous_entry, outputs, segment_output_dir, full_doc_output_dir)
+        documents[filename] = {
+            "sha256": source_sha256,
+            "parser_version": PARSER_VERSION,
+            "metadata_sha256": get_metadata_fingerprint(docx_file_path, base_filename, metadata_cache,
+                                                        metadata_fuzzy_index),
+            "output_formats": output_formats,
+            **outputs,
+        }
+        save_manifest(manifest, manifest_filepath)
+
+    if not jobs:
+        save_manifest(manifest, manifest_filepath)
+        print_status("Không có file DOCX nào thay đổi.", "OK")
+        return
+
+    # Tra cứu trước (đồng thời, theo lô) metadata còn thiếu; các bước trích xuất sau đó chỉ đọc cache
+    if enrich_metadata_cache([get_meta_key(docx_file_path, base_filename) for _, docx_file_path, base_filename, _ in jobs],
+                             metadata_cache, metadata_cache_filepath, metadata_fuzzy_index=metadata_fuzzy_index):
+        metadata_fuzzy_index = MetadataFuzzyIndex(metadata_cache)
+
+    num_workers = max(1, min(num_workers, len(jobs)))
+
+    if num_workers == 1:
+        for filename, docx_file_path, base_filename, source_sha256 in tqdm(jobs, desc="Đang xử lý DOCX"):
+            outputs = extract_data_from_docx(docx_file_path, base_filename, segment_output_dir, full_doc_output_dir,
+                                             metadata_cache, metadata_cache_filepath, documents.get(filename),
+                                             metadata_fuzzy_index, segment_output_format, full_doc_output_format,
+                                             online_lookup=False)
+            record_outputs(filename, docx_file_path, base_filename, source_sha256, outputs)
+            print_status(f"Hoàn thành xử lý '{filename}'.", "INFO")
+    else:
+        print_status(f"Xử lý song song với {num_workers} tiến trình.", "INFO")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            for job in jobs:
+                filename, docx_file_path, base_filename, _ = job
+                future = executor.submit(_extract_worker, docx_file_path, base_filename, segment_output_dir,
+                                         full_doc_output_dir, metadata_cache, documents.get(filename),
+                                         metadata_fuzzy_index, output_formats)
+                futures[future] = job
+            for future in tqdm(futures, desc="Đang xử lý DOCX"):
+                filename, docx_file_path, base_filename, source_sha256 = futures[future]
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    print_status(f"Lỗi khi xử lý '{filename}' trong tiến trình con: {e}", "ERR")
+                    continue
+                record_outputs(filename, docx_file_path, base_filename, source_sha256, outputs)
+                print_status(f"Hoàn thành xử lý '{filename}'.", "INFO")
 
     print_status("Tất cả các file DOCX đã được trích xuất và làm giàu metadata thành các file JSON.", "OK")
 
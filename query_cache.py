@@ -0,0 +1,95 @@
+# query_cache.py
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_cache import text_key
+
+# Cache vector câu hỏi trong bộ nhớ của tiến trình phục vụ (xbk-rag_service.py), đặt trước cache dùng chung.
+# Lưu lượng chủ yếu là vài trăm câu hỏi lặp lại ("Năm sanh pháp là gì?"), nên phần lớn câu hỏi được trả vector
+# từ một OrderedDict (LRU, khóa là văn bản đã chuẩn hóa như embedding_cache.normalize_text) mà không cần encode
+# hay đọc đĩa. Khi trượt, cache hỏi tiếp backend dùng chung (nếu có) rồi mới gọi mô hình.
+# Backend dùng chung là bất kỳ đối tượng nào có get_many(keys) -> [vector | None] và put_many(keys, vectors);
+# mặc định là EmbeddingCache (file memmap + SQLite, dùng chung giữa các tiến trình worker trên cùng máy).
+# Một kho qua socket (Redis, memcached...) chỉ cần bọc theo hai phương thức này.
+#   QUERY_CACHE_SIZE=1024 (0 = tắt lớp trong bộ nhớ),  QUERY_CACHE_TTL=0 (giây, 0 = không hết hạn)
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "0"))
+
+
+class QueryEmbeddingCache:
+    """
+    LRU có giới hạn (capacity câu hỏi) với thời hạn tùy chọn (ttl giây) cho vector câu hỏi của một mô hình,
+    kèm bộ đếm trúng bộ nhớ / trúng backend / trượt. Dùng được từ nhiều luồng.
+    """
+
+    def __init__(self, capacity=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, backend=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._entries = OrderedDict() # khóa -> (vector, thời điểm lưu)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Vector của khóa trong bộ nhớ, hoặc None nếu chưa có hay đã hết hạn."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, stored_at = entry
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key, vector):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def encode(self, model, text):
+        """Như model.encode(text) (vector numpy float32) nhưng dùng lại vector trong bộ nhớ hoặc trong backend."""
+        key = text_key(text)
+        vector = self.get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        if self.backend is not None:
+            vector = self.backend.get_many([key])[0]
+        if vector is not None:
+            self.backend_hits += 1
+        else:
+            self.misses += 1
+            vector = np.asarray(model.encode([text], show_progress_bar=False), dtype=np.float32)[0]
+            if self.backend is not None:
+                self.backend.put_many([key], vector[None, :])
+        vector.setflags(write=False) # Vector được trả về cho nhiều yêu cầu, không ai được sửa tại chỗ
+        self.put(key, vector)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def format_stats(self):
+        total = self.hits + self.backend_hits + self.misses
+        rate = 100.0 * (self.hits + self.backend_hits) / total if total else 0.0
+        return (f"Cache câu hỏi: {self.hits} trúng bộ nhớ, {self.backend_hits} trúng cache dùng chung, "
+                f"{self.misses} trượt ({rate:.1f}% trúng), {self.expired} hết hạn, {len(self)}/{self.capacity} câu hỏi.")
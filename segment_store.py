@@ -0,0 +1,125 @@
+# segment_store.py
+import gzip
+import hashlib
+import json
+import os
+import unicodedata
+
+# Kho segment dạng shard JSONL: mỗi bộ kinh một file .jsonl (hoặc .jsonl.gz).
+# Dòng đầu là bản ghi "book" chứa metadata chung của bộ kinh (lưu một lần duy nhất);
+# mỗi dòng sau là một segment chỉ chứa các trường riêng của nó và tham chiếu tới bộ kinh qua khóa "book".
+#
+#   {"type":"book","book":"Kinh_Truong_A_Ham","metadata":{...}}
+#   {"type":"segment","book":"Kinh_Truong_A_Ham","id":"Kinh_Truong_A_Ham_pham_01_...","metadata":{"Tên Kinh Nhỏ":...,"Số Phẩm":...},"noi_dung":[...]}
+
+SHARD_SUFFIXES = (".jsonl", ".jsonl.gz")
+
+
+def _dumps(record):
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class SegmentShardWriter:
+    """
+    Ghi các segment của một bộ kinh vào một shard theo kiểu streaming.
+    Segment được ghi ngay ra file tạm; bản ghi "book" (cần 'Chia Đoạn' chỉ biết ở cuối tài liệu)
+    được ghi lên đầu shard khi close(). Shard .gz được nén với mtime=0 để nội dung ổn định giữa các lần chạy.
+    Dùng với `with`: nếu có lỗi trước khi close() xong, các file tạm bị xóa.
+    """
+    def __init__(self, shard_path, book_key, previous_digest=None):
+        self.shard_path = shard_path
+        self.book_key = book_key
+        self.previous_digest = previous_digest
+        self.segment_count = 0
+        self._body_path = shard_path + ".body.tmp"
+        self._body = open(self._body_path, "wb")
+
+    def add_segment(self, segment_id, segment_metadata, noi_dung):
+        self._body.write(_dumps({"type": "segment", "book": self.book_key, "id": segment_id,
+                                 "metadata": segment_metadata, "noi_dung": noi_dung}))
+        self.segment_count += 1
+
+    def close(self, book_metadata):
+        """
+        Hoàn tất shard. Trả về sha256 của nội dung (chưa nén), hoặc None nếu không có segment nào.
+        Nếu nội dung trùng với previous_digest thì shard cũ được giữ nguyên.
+        """
+        self._body.close()
+        if not self.segment_count:
+            os.remove(self._body_path)
+            return None
+
+        sha = hashlib.sha256()
+        final_tmp_path = self.shard_path + ".tmp"
+        if self.shard_path.endswith(".gz"):
+            out = gzip.GzipFile(final_tmp_path, "wb", mtime=0)
+        else:
+            out = open(final_tmp_path, "wb")
+        with out, open(self._body_path, "rb") as body:
+            header = _dumps({"type": "book", "book": self.book_key, "metadata": book_metadata})
+            out.write(header)
+            sha.update(header)
+            for block in iter(lambda: body.read(1 << 20), b""):
+                out.write(block)
+                sha.update(block)
+        os.remove(self._body_path)
+
+        digest = sha.hexdigest()
+        if digest == self.previous_digest and os.path.exists(self.shard_path):
+            os.remove(final_tmp_path)
+        else:
+            os.replace(final_tmp_path, self.shard_path)
+        return digest
+
+    def abort(self):
+        """Hủy shard đang ghi dở và xóa các file tạm (gọi nhiều lần hoặc sau close() cũng không sao)."""
+        self._body.close()
+        for path in (self._body_path, self.shard_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+
+def _open_shard(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def iter_shard(path, nfc=False):
+    """
+    Đọc lười từng segment của một shard. Mỗi segment trả về có dạng giống file JSON segment:
+    {"id": ..., "metadata": {metadata bộ kinh + metadata segment}, "noi_dung": [...]}.
+    nfc=True: chuẩn hóa Unicode NFC từng dòng trước khi phân tích.
+    """
+    books = {}
+    with _open_shard(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if nfc:
+                line = unicodedata.normalize("NFC", line)
+            record = json.loads(line)
+            if record.get("type") == "book":
+                books[record["book"]] = record.get("metadata", {})
+            elif record.get("type") == "segment":
+                metadata = dict(books.get(record.get("book"), {}))
+                metadata.update(record.get("metadata", {}))
+                yield {"id": record.get("id"), "metadata": metadata, "noi_dung": record.get("noi_dung", [])}
+
+
+def list_shards(directory):
+    """Danh sách (đã sắp xếp) tên các file shard trong thư mục."""
+    return sorted(f for f in os.listdir(directory) if f.endswith(SHARD_SUFFIXES))
+
+
+def iter_segment_store(directory, nfc=False):
+    """Đọc lười toàn bộ segment của mọi shard trong thư mục."""
+    for name in list_shards(directory):
+        yield from iter_shard(os.path.join(directory, name), nfc=nfc)
@@ -0,0 +1,111 @@
+# sync_manifest.py
+import os
+import sqlite3
+import threading
+
+# Sổ đồng bộ giữa kho chunk và ChromaDB: với mỗi collection, lưu ID chunk -> (chunk_hash, phiên bản mô hình embedding)
+# của vector đang nằm trong ChromaDB. Bước embed chỉ cần so sánh với sổ này (theo lô ID, có chỉ mục)
+# thay vì đọc toàn bộ metadata từ ChromaDB; ID có trong sổ mà không còn trong kho chunk là vector cần xóa.
+# Sổ nằm cạnh dữ liệu ChromaDB (mặc định <CHROMA_PERSIST_DIR>/sync_manifest.sqlite3) để bị xóa cùng với index.
+
+MANIFEST_FILENAME = "sync_manifest.sqlite3"
+LOOKUP_BATCH_SIZE = 500 # Số ID mỗi câu truy vấn IN (dưới giới hạn tham số của SQLite)
+
+
+class SyncManifest:
+    """
+    Sổ đồng bộ của một collection ChromaDB trên một file SQLite.
+    Mọi hàm dùng chung một kết nối có khóa, nên luồng đọc và luồng ghi của pipeline embed có thể gọi song song.
+    record() ghi một lô trong một giao dịch: sổ chỉ được cập nhật sau khi lô đã được ghi vào ChromaDB.
+    """
+
+    def __init__(self, path, collection_name):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.collection_name = collection_name
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    chunk_hash TEXT,
+                    model TEXT,
+                    PRIMARY KEY (collection, id)
+                ) WITHOUT ROWID""")
+            # ID đã thấy trong lần chạy hiện tại (bảng tạm, chỉ tồn tại trong kết nối này)
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY) WITHOUT ROWID")
+            self.conn.execute("DELETE FROM seen")
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries WHERE collection = ?",
+                                     (self.collection_name,)).fetchone()[0]
+
+    def lookup(self, ids):
+        """{id: (chunk_hash, model)} của các ID đã có trong sổ."""
+        found = {}
+        with self._lock:
+            for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                batch = ids[i:i + LOOKUP_BATCH_SIZE]
+                rows = self.conn.execute(
+                    f"SELECT id, chunk_hash, model FROM entries WHERE collection = ? AND id IN ({','.join('?' * len(batch))})",
+                    (self.collection_name, *batch))
+                found.update((chunk_id, (chunk_hash, model)) for chunk_id, chunk_hash, model in rows)
+        return found
+
+    def mark_seen(self, ids):
+        """Ghi nhận các ID còn trong kho chunk ở lần chạy này (để tìm vector mồ côi bằng iter_unseen)."""
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO seen VALUES (?)", [(chunk_id,) for chunk_id in ids])
+
+    def record(self, entries, model):
+        """entries: [(id, chunk_hash)] vừa được ghi vào ChromaDB bằng mô hình `model`."""
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                  [(self.collection_name, chunk_id, chunk_hash, model) for chunk_id, chunk_hash in entries])
+
+    def seed(self, ids):
+        """Thêm các ID đã có trong ChromaDB nhưng chưa có trong sổ (hash rỗng: sẽ được embed lại một lần)."""
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO entries (collection, id) VALUES (?, ?)",
+                                  [(self.collection_name, chunk_id) for chunk_id in ids])
+
+    def remove(self, ids):
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM entries WHERE collection = ? AND id = ?",
+                                  [(self.collection_name, chunk_id) for chunk_id in ids])
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM entries WHERE collection = ?", (self.collection_name,))
+
+    def count_unseen(self):
+        """Số ID có trong sổ nhưng không được mark_seen() ở lần chạy này."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE collection = ? AND id NOT IN (SELECT id FROM temp.seen)",
+                (self.collection_name,)).fetchone()[0]
+
+    def iter_unseen(self, batch_size=LOOKUP_BATCH_SIZE):
+        """Các lô ID có trong sổ nhưng không được mark_seen() ở lần chạy này (chunk nguồn đã bị xóa)."""
+        with self._lock:
+            ids = [row[0] for row in self.conn.execute(
+                "SELECT id FROM entries WHERE collection = ? AND id NOT IN (SELECT id FROM temp.seen) ORDER BY id",
+                (self.collection_name,))]
+        for i in range(0, len(ids), batch_size):
+            yield ids[i:i + batch_size]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,302 @@
+# tests/test_metadata_enricher.py
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from unittest import mock
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_docs_for_rag as pdr
+
+# Kiểm thử làm giàu metadata theo lô (MetadataEnricher / enrich_metadata_cache) với Gemini giả:
+# không gọi mạng, không tốn quota. Chạy: python -m pytest -q tests
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text] if text else []
+
+
+class FakeGeminiModel:
+    """Thay cho genai.GenerativeModel: trả lời theo `answer(tên kinh)` và đếm số lần được gọi."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        name = prompt.split('"')[1] # Tên kinh nằm trong cặp ngoặc kép đầu tiên của prompt
+        with self._lock:
+            self.calls.append(name)
+        result = self.answer(name)
+        if isinstance(result, Exception):
+            raise result
+        return FakeResponse(result)
+
+
+class NoLimit:
+    def try_acquire(self):
+        return 0.0
+
+
+def metadata_json(name):
+    return json.dumps({"Tên Kinh Đầy Đủ": name, "Bộ": "A Hàm"}, ensure_ascii=False)
+
+
+def write_docx(path, paragraphs):
+    """DOCX tối giản (chỉ word/document.xml) đủ cho docx_stream.iter_docx_paragraphs."""
+    body = "".join(f"<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>" for text in paragraphs)
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("word/document.xml",
+                         '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                         f"<w:body>{body}</w:body></w:document>")
+
+
+class QuietTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(pdr, "print_status")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_path = os.path.join(self.tmp.name, "metadata_dai_chanh.json")
+
+    def use_model(self, answer):
+        model = FakeGeminiModel(answer)
+        patcher = mock.patch.object(pdr, "LLM_MODEL", model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return model
+
+
+class SearchOnlineTest(QuietTestCase):
+    def test_valid_json_is_filled_to_template(self):
+        self.use_model(metadata_json)
+        with mock.patch("builtins.print"):
+            meta = pdr.search_dai_chanh_metadata_online("Kinh Trường A Hàm", use_rate_limiter=False)
+        self.assertEqual(meta["Tên Kinh Đầy Đủ"], "Kinh Trường A Hàm")
+        self.assertEqual(meta["Tên Tiếng Hán"], "Not_Available")
+        self.assertNotIn("Chia Đoạn", meta)
+
+    def test_error_paths_return_empty_dict(self):
+        for answer in ("không phải JSON", "", RuntimeError("quota")):
+            with self.subTest(answer=answer):
+                self.use_model(lambda name, answer=answer: answer)
+                with mock.patch("builtins.print"):
+                    self.assertEqual(pdr.search_dai_chanh_metadata_online("Kinh X", use_rate_limiter=False), {})
+
+
+class MetadataEnricherTest(QuietTestCase):
+    def test_same_normalized_name_is_fetched_once(self):
+        calls = []
+
+        async def fetch(name):
+            calls.append(name)
+            await asyncio.sleep(0.01)
+            return {"Bộ": name}
+
+        async def run():
+            enricher = pdr.MetadataEnricher(fetch, NoLimit(), max_concurrency=4)
+            return await asyncio.gather(enricher.lookup("Kinh Trường A Hàm"),
+                                        enricher.lookup("kinh truong a ham"),
+                                        enricher.lookup("KINH TRƯỜNG A HÀM"),
+                                        enricher.lookup("Kinh Trung A Hàm"))
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual({norm for norm, _ in results}, {"kinhtruongaham", "kinhtrungaham"})
+        self.assertIs(results[0][1], results[1][1])
+        self.assertIs(results[0][1], results[2][1])
+
+    def test_concurrency_is_bounded(self):
+        active = 0
+        peak = 0
+
+        async def fetch(name):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return {"Bộ": name}
+
+        async def run():
+            enricher = pdr.MetadataEnricher(fetch, NoLimit(), max_concurrency=2)
+            return await asyncio.gather(*(enricher.lookup(f"Kinh {i}") for i in range(7)))
+
+        results = asyncio.run(run())
+        self.assertEqual(len(results), 7)
+        self.assertEqual(peak, 2)
+
+    def test_waits_for_rate_limiter_token(self):
+        waits = iter([0.01, 0.01, 0.0])
+
+        class Limiter:
+            calls = 0
+
+            def try_acquire(self):
+                Limiter.calls += 1
+                return next(waits)
+
+        async def run():
+            enricher = pdr.MetadataEnricher(lambda name: {"Bộ": name}, Limiter())
+            return await enricher.lookup("Kinh X")
+
+        self.assertEqual(asyncio.run(run()), ("kinhx", {"Bộ": "Kinh X"}))
+        self.assertEqual(Limiter.calls, 3)
+
+    def test_failed_fetch_returns_empty_and_does_not_break_others(self):
+        def fetch(name): # Hàm đồng bộ: chạy trong executor
+            if name == "Kinh Lỗi":
+                raise RuntimeError("mạng lỗi")
+            return {"Bộ": name}
+
+        async def run():
+            enricher = pdr.MetadataEnricher(fetch, NoLimit())
+            return await asyncio.gather(enricher.lookup("Kinh Lỗi"), enricher.lookup("Kinh Tốt"))
+
+        self.assertEqual(asyncio.run(run()), [("kinhloi", {}), ("kinhtot", {"Bộ": "Kinh Tốt"})])
+
+
+class EnrichMetadataCacheTest(QuietTestCase):
+    def test_cached_names_are_not_fetched(self):
+        model = self.use_model(metadata_json)
+        cache = {"kinhtruongaham": {"Bộ": "Trường A Hàm"}}
+        found = pdr.enrich_metadata_cache(["Kinh Trường A Hàm"], cache, self.cache_path, requests_per_minute=0)
+        self.assertEqual(found, {})
+        self.assertEqual(model.calls, [])
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_misses_go_through_gemini_once_and_cache_is_saved_once(self):
+        model = self.use_model(metadata_json)
+        cache = {"kinhtruongaham": {"Bộ": "Trường A Hàm"}}
+        with mock.patch.object(pdr, "save_metadata_cache", wraps=pdr.save_metadata_cache) as save, \
+                mock.patch("builtins.print"):
+            found = pdr.enrich_metadata_cache(["Kinh Trường A Hàm", "Kinh Trung A Hàm", "kinh trung a ham",
+                                               "Kinh Tạp A Hàm"], cache, self.cache_path, requests_per_minute=0)
+        self.assertEqual(sorted(model.calls), ["Kinh Trung A Hàm", "Kinh Tạp A Hàm"])
+        self.assertEqual(set(found), {"kinhtrungaham", "kinhtapaham"})
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(pdr.load_metadata_cache(self.cache_path), cache)
+
+    def test_failures_are_not_cached_and_are_retried_next_run(self):
+        failing = {"Kinh Tạp A Hàm"}
+        model = self.use_model(lambda name: RuntimeError("503") if name in failing else metadata_json(name))
+        cache = {}
+        with mock.patch("builtins.print"):
+            found = pdr.enrich_metadata_cache(["Kinh Trung A Hàm", "Kinh Tạp A Hàm"], cache, self.cache_path,
+                                              requests_per_minute=0)
+        self.assertEqual(set(found), {"kinhtrungaham"})
+        self.assertNotIn("kinhtapaham", pdr.load_metadata_cache(self.cache_path))
+
+        failing.clear()
+        with mock.patch("builtins.print"):
+            found = pdr.enrich_metadata_cache(["Kinh Trung A Hàm", "Kinh Tạp A Hàm"], cache, self.cache_path,
+                                              requests_per_minute=0)
+        self.assertEqual(set(found), {"kinhtapaham"})
+        self.assertEqual(sorted(model.calls[:2]), ["Kinh Trung A Hàm", "Kinh Tạp A Hàm"])
+        self.assertEqual(model.calls[2:], ["Kinh Tạp A Hàm"]) # Bộ đã có trong cache không bị tra lại
+        self.assertEqual(set(pdr.load_metadata_cache(self.cache_path)), {"kinhtrungaham", "kinhtapaham"})
+
+    def test_nothing_found_leaves_cache_file_untouched(self):
+        self.use_model(lambda name: RuntimeError("503"))
+        found = pdr.enrich_metadata_cache(["Kinh X"], {}, self.cache_path, requests_per_minute=0)
+        self.assertEqual(found, {})
+        self.assertFalse(os.path.exists(self.cache_path))
+
+
+class SaveMetadataCacheTest(QuietTestCase):
+    def test_save_replaces_file_without_leaving_tmp(self):
+        pdr.save_metadata_cache({"kinhx": {"Bộ": "X"}}, self.cache_path)
+        self.assertEqual(pdr.load_metadata_cache(self.cache_path), {"kinhx": {"Bộ": "X"}})
+        self.assertEqual(os.listdir(self.tmp.name), [os.path.basename(self.cache_path)])
+
+    def test_failed_replace_keeps_previous_cache(self):
+        pdr.save_metadata_cache({"kinhx": {"Bộ": "X"}}, self.cache_path)
+        with mock.patch.object(pdr.os, "replace", side_effect=OSError("đĩa đầy")):
+            pdr.save_metadata_cache({"kinhy": {"Bộ": "Y"}}, self.cache_path)
+        self.assertEqual(pdr.load_metadata_cache(self.cache_path), {"kinhx": {"Bộ": "X"}})
+
+    def test_failed_serialization_keeps_previous_cache(self):
+        pdr.save_metadata_cache({"kinhx": {"Bộ": "X"}}, self.cache_path)
+        with self.assertRaises(TypeError):
+            pdr.save_metadata_cache({"kinhy": {"Bộ": object()}}, self.cache_path)
+        self.assertEqual(pdr.load_metadata_cache(self.cache_path), {"kinhx": {"Bộ": "X"}})
+
+
+class ProcessAllDocsTest(QuietTestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_dir = os.path.join(self.tmp.name, "input_docs")
+        os.makedirs(self.input_dir)
+        write_docx(os.path.join(self.input_dir, "Kinh Tap A Ham.docx"),
+                   ["Mục lục", "---o0o---", "KINH MỘT", "Tôi nghe như vầy."])
+        patcher = mock.patch.object(pdr, "LLM_RATE_LIMITER", pdr.TokenBucket(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_pipeline(self, **formats):
+        with mock.patch("builtins.print"):
+            pdr.process_all_docs_in_directory(self.input_dir, os.path.join(self.tmp.name, "segments"),
+                                              os.path.join(self.tmp.name, "full_doc"), self.cache_path,
+                                              num_workers=1,
+                                              manifest_filepath=os.path.join(self.tmp.name, "manifest.json"),
+                                              **formats)
+
+    def test_failed_book_is_asked_once_per_run_and_retried_next_run(self):
+        model = self.use_model(lambda name: RuntimeError("503"))
+        self.run_pipeline()
+        self.assertEqual(model.calls, ["Kinh Tap A Ham"]) # Bước trích xuất không hỏi lại bộ kinh vừa tra thất bại
+
+        model.answer = metadata_json
+        self.run_pipeline() # Chưa có metadata nên tài liệu không được coi là "không đổi"
+        self.assertEqual(model.calls, ["Kinh Tap A Ham", "Kinh Tap A Ham"])
+        segment_dir = os.path.join(self.tmp.name, "segments")
+        with open(os.path.join(segment_dir, os.listdir(segment_dir)[0]), encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["metadata"]["Tên Kinh Đầy Đủ"], "Kinh Tap A Ham")
+
+        self.run_pipeline()
+        self.assertEqual(len(model.calls), 2)
+
+    def test_changing_output_format_reextracts_and_removes_old_files(self):
+        self.use_model(metadata_json)
+        self.run_pipeline()
+        segment_dir, full_doc_dir = os.path.join(self.tmp.name, "segments"), os.path.join(self.tmp.name, "full_doc")
+        self.assertEqual(os.listdir(full_doc_dir), ["Kinh_Tap_A_Ham.json"])
+
+        self.run_pipeline(segment_output_format="jsonl.gz", full_doc_output_format="text")
+        self.assertEqual(os.listdir(segment_dir), ["Kinh_Tap_A_Ham.jsonl.gz"])
+        self.assertEqual(sorted(os.listdir(full_doc_dir)),
+                         ["Kinh_Tap_A_Ham.index.json", "Kinh_Tap_A_Ham.offsets", "Kinh_Tap_A_Ham.txt"])
+
+        with mock.patch.object(pdr, "extract_data_from_docx") as extract:
+            self.run_pipeline(segment_output_format="jsonl.gz", full_doc_output_format="text")
+        extract.assert_not_called()
+
+
+class ExtractDataFromDocxTest(QuietTestCase):
+    def test_unexpected_error_leaves_no_temporary_files(self):
+        docx_path = os.path.join(self.tmp.name, "Kinh X.docx")
+        write_docx(docx_path, ["---o0o---", "KINH MỘT", "Tôi nghe như vầy.", "---o0o---", "KINH HAI", "..."])
+        output_dir = os.path.join(self.tmp.name, "out")
+        os.makedirs(output_dir)
+        for formats in (("jsonl.gz", "text"), ("jsonl", "json")):
+            with self.subTest(formats=formats), \
+                    mock.patch.object(pdr, "build_kinh_segment", side_effect=RuntimeError("lỗi bất ngờ")), \
+                    self.assertRaises(RuntimeError):
+                pdr.extract_data_from_docx(docx_path, "Kinh_X", output_dir, output_dir, {"kinhx": {}}, None,
+                                           segment_output_format=formats[0], full_doc_output_format=formats[1],
+                                           online_lookup=False)
+            self.assertEqual(os.listdir(output_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
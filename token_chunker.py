@@ -0,0 +1,189 @@
+# token_chunker.py
+import os
+import re
+from collections import Counter
+
+# Chia chunk theo số token của chính tokenizer của mô hình embedding (mặc định intfloat/multilingual-e5-large, cửa sổ 512 token).
+# Các câu được đếm token theo lô, rồi được xếp vào chunk tới ngân sách CHUNK_MAX_TOKENS;
+# chunk sau lặp lại các câu cuối của chunk trước (tối đa CHUNK_OVERLAP_TOKENS token) để giữ mạch văn.
+
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "tokens") # "tokens" (theo tokenizer) hoặc "chars" (512 ký tự như cũ)
+TOKENIZER_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-large")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "480")) # Chừa chỗ cho token đặc biệt/tiền tố trong cửa sổ 512
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+TOKENIZER_BATCH_SIZE = int(os.getenv("TOKENIZER_BATCH_SIZE", "256")) # Số câu mỗi lần gọi tokenizer
+
+HISTOGRAM_BUCKET = 64 # Độ rộng mỗi cột của histogram độ dài chunk
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+
+def split_sentences(text):
+    """Tách câu tại dấu kết câu theo sau bởi khoảng trắng; không tách nếu từ tiếp theo viết thường."""
+    sentences = []
+    for piece in _SENTENCE_END.split(text.strip()):
+        first_letter = next((c for c in piece if c.isalpha()), "")
+        if sentences and first_letter.islower():
+            sentences[-1] += " " + piece
+        elif piece:
+            sentences.append(piece)
+    return sentences
+
+
+class LengthHistogram:
+    """Histogram độ dài chunk theo các cột rộng HISTOGRAM_BUCKET (đơn vị: token hoặc ký tự)."""
+    def __init__(self, unit):
+        self.unit = unit
+        self.buckets = Counter()
+
+    def add(self, length):
+        self.buckets[length // HISTOGRAM_BUCKET] += 1
+
+    def format(self, width=40):
+        total = sum(self.buckets.values())
+        if not total:
+            return f"Chưa có chunk nào (đơn vị: {self.unit})."
+        peak = max(self.buckets.values())
+        lines = [f"Histogram độ dài {total} chunk (đơn vị: {self.unit}):"]
+        for bucket in range(min(self.buckets), max(self.buckets) + 1):
+            count = self.buckets.get(bucket, 0)
+            low = bucket * HISTOGRAM_BUCKET
+            lines.append(f"  {low:>5}-{low + HISTOGRAM_BUCKET - 1:<5} {count:>7} {'#' * round(width * count / peak)}")
+        return "\n".join(lines)
+
+
+class CharChunker:
+    """
+    Chia chunk theo số ký tự bằng hàm chunk_fn(text) cũ; mỗi đoạn văn được chia riêng.
+    Hậu tố đường dẫn giữ nguyên dạng "/<số đoạn>#<số chunk>" để ID chunk không đổi so với trước.
+    """
+    def __init__(self, chunk_fn):
+        self.chunk_fn = chunk_fn
+        self.histogram = LengthHistogram("ký tự")
+
+    def chunk_units(self, units):
+        results = []
+        for paragraphs in units:
+            chunks = []
+            for paragraph_idx, paragraph in paragraphs:
+                prefix = f"/{paragraph_idx}" if paragraph_idx is not None else ""
+                for chunk_idx, chunk in enumerate(self.chunk_fn(paragraph)):
+                    self.histogram.add(len(chunk))
+                    chunks.append((chunk, f"{prefix}#{chunk_idx}"))
+            results.append(chunks)
+        return results
+
+
+class TokenChunker:
+    """
+    Xếp câu vào chunk theo ngân sách token. Mỗi đơn vị (danh sách đoạn văn liên tiếp có cùng metadata)
+    được chia thành các chunk tối đa max_tokens token, chồng lấn theo câu tối đa overlap_tokens token.
+    Câu dài hơn ngân sách được cắt tại biên token.
+    """
+    def __init__(self, tokenizer, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS,
+                 batch_size=TOKENIZER_BATCH_SIZE):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.batch_size = batch_size
+        self.histogram = LengthHistogram("token")
+
+    def count_tokens(self, texts):
+        """Số token (không tính token đặc biệt) của từng chuỗi, tokenizer được gọi theo lô."""
+        lengths = []
+        for i in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(texts[i:i + self.batch_size], add_special_tokens=False)
+            lengths.extend(len(ids) for ids in encoded["input_ids"])
+        return lengths
+
+    def _split_long_sentence(self, sentence):
+        """Cắt câu dài hơn max_tokens thành các mảnh [(văn bản, số token)] tại biên token."""
+        encoded = self.tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = encoded["offset_mapping"]
+        pieces = []
+        for start in range(0, len(offsets), self.max_tokens):
+            end = min(start + self.max_tokens, len(offsets))
+            text = sentence[offsets[start][0]:offsets[end - 1][1]].strip()
+            if text:
+                pieces.append((text, end - start))
+        return pieces
+
+    def _pack(self, sentences):
+        """sentences: [(số đoạn văn, câu, số token)] -> [(chunk, số token)]."""
+        chunks = []
+        current = []
+        current_tokens = 0
+
+        def emit():
+            parts = []
+            for i, (paragraph_key, sentence, _) in enumerate(current):
+                if i:
+                    parts.append("\n" if paragraph_key != current[i - 1][0] else " ")
+                parts.append(sentence)
+            chunks.append(("".join(parts), current_tokens))
+
+        for sentence in sentences:
+            length = sentence[2]
+            if current and current_tokens + length > self.max_tokens:
+                emit()
+                # Chồng lấn: giữ các câu cuối của chunk vừa ghi, miễn là vẫn còn chỗ cho câu mới
+                overlap = []
+                overlap_tokens = 0
+                for previous in reversed(current):
+                    if overlap_tokens + previous[2] > self.overlap_tokens or \
+                       overlap_tokens + previous[2] + length > self.max_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_tokens += previous[2]
+                current = overlap
+                current_tokens = overlap_tokens
+            current.append(sentence)
+            current_tokens += length
+        if current:
+            emit()
+        return chunks
+
+    def chunk_units(self, units):
+        """
+        units: [[(số đoạn văn hoặc None, đoạn văn), ...], ...].
+        Trả về, cho từng đơn vị, danh sách [(chunk, hậu tố đường dẫn "#<số chunk>")].
+        Toàn bộ câu của mọi đơn vị được đếm token trong cùng một lượt gọi theo lô.
+        """
+        flat = [] # (vị trí đơn vị, khóa đoạn văn, câu)
+        for unit_idx, paragraphs in enumerate(units):
+            for position, (_, paragraph) in enumerate(paragraphs):
+                flat.extend((unit_idx, position, sentence) for sentence in split_sentences(paragraph))
+        lengths = self.count_tokens([sentence for _, _, sentence in flat])
+
+        per_unit = [[] for _ in units]
+        for (unit_idx, paragraph_key, sentence), length in zip(flat, lengths):
+            if length > self.max_tokens:
+                per_unit[unit_idx].extend((paragraph_key, piece, piece_length)
+                                          for piece, piece_length in self._split_long_sentence(sentence))
+            else:
+                per_unit[unit_idx].append((paragraph_key, sentence, length))
+
+        results = []
+        for sentences in per_unit:
+            chunks = self._pack(sentences)
+            for _, length in chunks:
+                self.histogram.add(length)
+            results.append([(chunk, f"#{chunk_idx}") for chunk_idx, (chunk, _) in enumerate(chunks)])
+        return results
+
+
+def create_chunker(mode, char_chunk_fn, model_name=TOKENIZER_MODEL_NAME):
+    """
+    Tạo bộ chia chunk theo CHUNKING_MODE. Nếu không tải được tokenizer (thiếu transformers, không có mạng...)
+    thì quay về chia theo ký tự và báo cảnh báo.
+    """
+    if mode == "tokens":
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+            print(f"Chia chunk theo tokenizer của '{model_name}': tối đa {CHUNK_MAX_TOKENS} token, "
+                  f"chồng lấn {CHUNK_OVERLAP_TOKENS} token.")
+            return TokenChunker(tokenizer)
+        except Exception as e:
+            print(f"Cảnh báo: Không tải được tokenizer '{model_name}' ({e}). Chia chunk theo ký tự.")
+    return CharChunker(char_chunk_fn)
@@ -0,0 +1,159 @@
+# vector_compression.py
+import argparse
+import os
+
+import numpy as np
+
+# Nén vector embedding trước khi lưu vào ChromaDB: giảm số chiều bằng PCA (học trên chính kho chunk) hoặc cắt bớt chiều.
+# Tham số nén gắn với từng collection (file <CHROMA_PERSIST_DIR>/<collection>.compression.npz) và được áp dụng giống hệt
+# cho đoạn văn (xbk-embed_to_chroma.py) và câu hỏi (rag_query). ChromaDB luôn lưu float32, nên tiết kiệm bộ nhớ index
+# đến từ số chiều; lưu int8/float16 được dùng cho cache embedding (EMBEDDING_CACHE_DTYPE, xem embedding_cache.py).
+#   VECTOR_COMPRESSION="none" (mặc định) | "pca" | "truncate",  VECTOR_DIM=256
+# Đổi cấu hình chỉ có hiệu lực với collection mới (embed_to_chroma.py --rebuild).
+# Báo cáo recall@k so với index không nén:
+#   python vector_compression.py --evaluate [--dims 128 256 512] [--dtypes float32 float16 int8] [thư mục JSON]
+
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "none")
+VECTOR_DIM = int(os.getenv("VECTOR_DIM", "256"))
+COMPRESSION_FIT_SAMPLE = int(os.getenv("COMPRESSION_FIT_SAMPLE", "5000")) # Số chunk dùng để học PCA
+COMPRESSION_SUFFIX = ".compression.npz"
+METHODS = ("none", "pca", "truncate")
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def quantize(vectors, dtype):
+    """Mã hóa vector để lưu: trả về (mảng dtype, hệ số tỉ lệ từng vector hoặc None). int8 dùng tỉ lệ max|x|/127 theo từng vector."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(dtype), None
+
+
+def dequantize(stored, scales=None):
+    stored = np.asarray(stored)
+    if stored.dtype == np.int8:
+        return stored.astype(np.float32) * np.asarray(scales, dtype=np.float32)[..., None]
+    return stored.astype(np.float32)
+
+
+class VectorCompressor:
+    """
+    Phép nén số chiều đã học: "pca" chiếu (x - mean) lên `dim` thành phần chính, "truncate" giữ `dim` chiều đầu.
+    Kết quả được chuẩn hóa độ dài 1 để khoảng cách cosine của ChromaDB vẫn đúng nghĩa.
+    """
+
+    def __init__(self, method, dim, mean=None, components=None):
+        if method not in METHODS:
+            raise ValueError(f"VECTOR_COMPRESSION không hợp lệ: '{method}' (chỉ hỗ trợ {', '.join(METHODS)})")
+        self.method = method
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @property
+    def spec(self):
+        return "none" if self.method == "none" else f"{self.method}-{self.dim}"
+
+    def fit(self, vectors):
+        if self.method == "pca":
+            vectors = np.asarray(vectors, dtype=np.float64)
+            self.dim = min(self.dim, vectors.shape[1], len(vectors))
+            self.mean = vectors.mean(axis=0)
+            centered = vectors - self.mean
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            top = np.argsort(eigenvalues)[::-1][:self.dim]
+            self.mean = self.mean.astype(np.float32)
+            self.components = eigenvectors[:, top].T.astype(np.float32)
+        return self
+
+    def transform(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "pca":
+            return normalize_rows((vectors - self.mean) @ self.components.T)
+        if self.method == "truncate":
+            return normalize_rows(vectors[:, :self.dim])
+        return vectors
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, method=self.method, dim=self.dim,
+                     mean=self.mean if self.mean is not None else np.zeros(0, np.float32),
+                     components=self.components if self.components is not None else np.zeros((0, 0), np.float32))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            method = str(data["method"])
+            return cls(method, int(data["dim"]),
+                       data["mean"] if method == "pca" else None,
+                       data["components"] if method == "pca" else None)
+
+
+def compressor_path(persist_dir, collection_name):
+    return os.path.join(persist_dir or ".", collection_name + COMPRESSION_SUFFIX)
+
+
+def load_collection_compressor(persist_dir, collection_name):
+    """Phép nén của collection, hoặc None nếu collection lưu vector nguyên bản."""
+    path = compressor_path(persist_dir, collection_name)
+    return VectorCompressor.load(path) if os.path.exists(path) else None
+
+
+# --- Báo cáo recall@k so với index không nén ---
+def evaluate(texts, queries, dims, dtypes, k=10):
+    from embedding_backend import embedding_model_version, load_embedding_model, recall_at_k
+    from embedding_cache import open_embedding_cache
+
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-large")
+    model = load_embedding_model(model_name)
+    cache = open_embedding_cache(embedding_model_version(model_name))
+    encode = (lambda batch: cache.encode(model, batch, show_progress_bar=False)) if cache else \
+             (lambda batch: model.encode(batch, show_progress_bar=False))
+    docs = normalize_rows(encode(texts))
+    query_vectors = normalize_rows(encode(queries))
+    print(f"{len(texts)} chunk, {len(queries)} câu hỏi, {docs.shape[1]} chiều gốc. Recall@{k} so với index float32 không nén:")
+    print(f"  {'phép nén':<14} {'kiểu':<8} {'byte/vector':>11} {'recall@k':>9}")
+
+    configurations = [("none", docs.shape[1])] + [(method, dim) for method in ("pca", "truncate") for dim in dims]
+    for method, dim in configurations:
+        compressor = VectorCompressor(method, dim).fit(docs)
+        compressed_docs = compressor.transform(docs)
+        compressed_queries = compressor.transform(query_vectors)
+        for dtype in dtypes:
+            stored, scales = quantize(compressed_docs, dtype)
+            restored = normalize_rows(dequantize(stored, scales))
+            recall = recall_at_k(docs, query_vectors, restored, compressed_queries, k)
+            size = stored.shape[1] * stored.dtype.itemsize + (4 if scales is not None else 0)
+            print(f"  {compressor.spec:<14} {dtype:<8} {size:>11} {recall:>9.4f}")
+    if cache is not None:
+        cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đánh giá recall@k của các phép nén vector so với index không nén")
+    parser.add_argument("folder", nargs="?", default="data/Doc2JsonNormalized")
+    parser.add_argument("--evaluate", action="store_true")
+    parser.add_argument("--dims", type=int, nargs="+", default=[128, 256, 384, 512])
+    parser.add_argument("--dtypes", nargs="+", default=list(STORAGE_DTYPES), choices=STORAGE_DTYPES)
+    parser.add_argument("--limit", type=int, default=2000, help="Số chunk tối đa (0 = tất cả)")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+    if not args.evaluate:
+        parser.print_help()
+        return
+
+    from embedding_backend import load_sample_texts
+    texts = load_sample_texts(args.folder, args.limit)
+    queries = [text[:120] for text in texts[::max(1, len(texts) // 100)]]
+    evaluate(texts, queries, args.dims, args.dtypes, args.k)
+
+
+if __name__ == "__main__":
+    main()
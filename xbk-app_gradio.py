@@ -1,18 +1,13 @@
 # app_gradio.py
 import gradio as gr
-import sys
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 import uvicorn
-from rag_service import load_chroma_collection, rag_query
+from rag_service import rag_query, service_status, start_background_init
 
-# Load collection khi khởi động
-try:
-    _ = load_chroma_collection()
-    print("[Gradio App] ChromaDB collection đã được tải thành công.")
-except Exception as e:
-    print(f"[Gradio App] Lỗi nghiêm trọng khi tải ChromaDB: {e}")
-    print("[Gradio App] Ứng dụng sẽ không hoạt động nếu không có cơ sở dữ liệu. Vui lòng kiểm tra logs.")
-    sys.exit(1)
+# Tải mô hình và ChromaDB trong luồng nền để ứng dụng mở cổng ngay; trạng thái khởi tạo xem qua /readyz.
+# Câu hỏi gửi tới trong lúc khởi tạo sẽ chờ tối đa RAG_READY_TIMEOUT giây.
+start_background_init()
 
 NO_INFO_ANSWER = "Xin lỗi, tôi không tìm thấy thông tin đủ chi tiết trong các Kinh đã được cung cấp để trả lời câu hỏi này."
 RAG_ERROR_ANSWER_PREFIX = "Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn:"
@@ -78,6 +73,19 @@ iface = gr.Interface(
 
 # Tạo FastAPI app và mount Gradio app vào
 app = FastAPI()
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: tiến trình còn sống; chỉ báo lỗi khi khởi tạo thất bại (cần khởi động lại với cấu hình đúng)."""
+    status = service_status()
+    return JSONResponse(status, status_code=503 if status["status"] == "failed" else 200)
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: 200 khi mô hình và collection đã tải và làm nóng xong, 503 trong lúc khởi động hoặc khi thất bại."""
+    status = service_status()
+    return JSONResponse(status, status_code=200 if status["status"] == "ready" else 503)
+
 gradio_app = gr.routes.App.create_app(iface)
 gradio_app.blocks.config["dev_mode"] = False  # Tắt dev_mode để tránh reload loop
 app.mount("/", gradio_app)
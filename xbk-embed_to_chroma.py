@@ -1,10 +1,24 @@
 # embed_to_chroma.py
-from pymongo import MongoClient
-from sentence_transformers import SentenceTransformer
 import chromadb
+import argparse
 import os
+import hashlib
+import queue
+import threading
 from datetime import datetime
+from itertools import islice
+import numpy as np
 from dotenv import load_dotenv
+from chroma_generations import (activate_generation, active_collection_name, cleanup_generations,
+                                new_generation_name, verify_generation)
+from chunk_store import SCAN_BATCH_SIZE, open_chunk_store
+from embedding_backend import EMBEDDING_BACKEND, embedding_model_version, load_embedding_model
+from embedding_cache import open_embedding_cache
+from parallel_encoder import ENCODE_WORKERS, ParallelEncoder
+from lexical_index import open_lexical_index, remove_lexical_index
+from sync_manifest import MANIFEST_FILENAME, SyncManifest
+from vector_compression import (COMPRESSION_FIT_SAMPLE, VECTOR_COMPRESSION, VECTOR_DIM, VectorCompressor,
+                                compressor_path, load_collection_compressor)
 
 load_dotenv() # Tải biến môi trường
 
@@ -12,148 +26,340 @@ load_dotenv() # Tải biến môi trường
 MONGO_URI = os.getenv('MONGO_URI')
 DB_NAME = os.getenv('DB_NAME')
 COLLECTION_SOURCE = os.getenv('COLLECTION_SOURCE')
+# Kho chunk: CHUNK_STORE_BACKEND="mongo" (mặc định) hoặc "sqlite" (file CHUNK_STORE_PATH), xem chunk_store.py
 
 PERSIST_DIRECTORY = os.getenv('CHROMA_PERSIST_DIR')
-client_chroma = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
 
 COLLECTION_NAME_CHROMA = os.getenv('COLLECTION_NAME_CHROMA')
 EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME')
+# Phiên bản vector = mô hình + backend suy luận (EMBEDDING_BACKEND, xem embedding_backend.py); đổi backend thì embed lại
+EMBEDDING_MODEL_VERSION = embedding_model_version(EMBEDDING_MODEL_NAME)
+# Sổ đồng bộ ID chunk -> (chunk_hash, mô hình) của các vector trong ChromaDB, xem sync_manifest.py
+SYNC_MANIFEST_PATH = os.getenv('SYNC_MANIFEST_PATH', os.path.join(PERSIST_DIRECTORY or '.', MANIFEST_FILENAME))
+
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '100')) # Số đoạn văn mỗi lần encode/ghi ChromaDB
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4')) # Số lô tối đa chờ giữa các tầng đọc -> encode -> ghi
+# Tỉ lệ tối đa số vector của sổ đồng bộ được xóa vì mồ côi trong một lần chạy. Vượt quá thường là do kho chunk sai
+# (CHUNK_STORE_PATH, DB_NAME, COLLECTION_SOURCE trỏ nhầm chỗ) chứ không phải nguồn bị xóa thật; dùng --allow-mass-delete để bỏ qua.
+ORPHAN_DELETE_MAX_RATIO = float(os.getenv('ORPHAN_DELETE_MAX_RATIO', '0.5'))
 
 # --- Hàm hỗ trợ ---
-def get_documents_from_mongo(mongo_uri, db_name, collection_name):
-    client = MongoClient(mongo_uri)
-    db = client[db_name]
-    collection = db[collection_name]
-    documents = []
-    print(f"Đang lấy dữ liệu từ MongoDB ({db_name}.{collection_name})...")
-    for doc in collection.find({}, {'_id': 1, 'content': 1, 'metadata': 1, 'last_updated': 1}):
-        doc['_id'] = str(doc['_id']) # Chuyển ObjectId sang string để làm ID cho ChromaDB
-        documents.append(doc)
-    client.close()
-    return documents
-
-def parse_last_updated(value):
-    if isinstance(value, datetime):
-        return value
-    if isinstance(value, str):
-        try:
-            return datetime.fromisoformat(value.replace('Z', '+00:00')) # Xử lý định dạng ISO
-        except ValueError:
-            pass
-    return datetime.min # Trả về ngày nhỏ nhất nếu không thể parse
+def get_chunk_hash(doc):
+    """chunk_hash do bước tiền xử lý tính; dữ liệu cũ chưa có thì băm nội dung."""
+    return doc.get('chunk_hash') or hashlib.sha256(doc.get('content', '').encode('utf-8')).hexdigest()
 
-# --- Hàm chính để tạo và lưu Embeddings ---
-def create_embeddings_and_store_in_chroma():
-    print(f"Đang tải mô hình embedding: {EMBEDDING_MODEL_NAME}...")
+def build_chroma_metadatas(docs):
+    batch_metadatas = []
+    for d in docs:
+        filtered_meta = {k: v for k, v in d['metadata'].items() if isinstance(v, (str, int, float, bool))}
+        if 'last_updated' in d and isinstance(d['last_updated'], (str, datetime)):
+            filtered_meta['last_updated'] = str(d['last_updated']) # Đảm bảo là string
+        batch_metadatas.append(filtered_meta)
+    return batch_metadatas
+
+def iter_pending_batches(store, manifest, model_version, batch_size=EMBED_BATCH_SIZE):
+    """
+    Đọc kho chunk theo lô (con trỏ theo _id), đối chiếu từng lô với sổ đồng bộ và sinh các lô ("add" | "update", documents)
+    cần embed: chunk chưa có trong sổ -> "add"; chunk có chunk_hash hoặc mô hình khác với sổ -> "update".
+    Mọi ID đọc được đều được đánh dấu để sau đó tìm các vector mồ côi.
+    """
+    pending = {"add": [], "update": []}
+    docs = store.iter_chunks(batch_size=SCAN_BATCH_SIZE)
+    for page in iter(lambda: list(islice(docs, SCAN_BATCH_SIZE)), []):
+        page_ids = [doc['_id'] for doc in page]
+        manifest.mark_seen(page_ids)
+        known = manifest.lookup(page_ids)
+        for doc in page:
+            entry = known.get(doc['_id'])
+            if entry is None:
+                kind = "add"
+            elif entry != (get_chunk_hash(doc), model_version):
+                kind = "update"
+            else:
+                continue
+            pending[kind].append(doc)
+            if len(pending[kind]) >= batch_size:
+                yield kind, pending[kind]
+                pending[kind] = []
+    for kind, docs in pending.items():
+        if docs:
+            yield kind, docs
+
+def write_batch_to_chroma(collection_chroma, batch_docs, batch_embeddings):
+    """
+    Ghi một lô vào ChromaDB bằng upsert (kể cả đoạn văn mới: sổ đồng bộ có thể không khớp với ChromaDB,
+    ví dụ sau khi xóa sổ). Trả về số đoạn văn đã ghi (0 nếu lỗi).
+    """
+    batch_contents = [d.get('content', '') for d in batch_docs]
+    batch_ids = [d['_id'] for d in batch_docs]
     try:
-        model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-        print("Đã tải mô hình embedding thành công.")
+        collection_chroma.upsert(
+            embeddings=batch_embeddings,
+            documents=batch_contents,
+            metadatas=build_chroma_metadatas(batch_docs),
+            ids=batch_ids
+        )
+        return len(batch_docs)
     except Exception as e:
-        print(f"Lỗi khi tải mô hình embedding: {e}")
+        print(f"Lỗi khi ghi batch vào ChromaDB (upsert): {e}")
+        print(f"  Batch IDs gây lỗi: {batch_ids}")
+        # Bỏ qua lỗi để tiếp tục với các batch khác
+        return 0
+
+_PIPELINE_DONE = object()
+
+def encode_texts(encoder, texts, embedding_cache=None, compressor=None):
+    """Vector (list) của các văn bản, qua cache embedding nếu có, rồi nén theo phép nén của collection nếu có."""
+    if embedding_cache is not None:
+        embeddings = embedding_cache.encode(encoder, texts, show_progress_bar=False)
+    else:
+        embeddings = encoder.encode(texts, show_progress_bar=False)
+    if compressor is not None:
+        embeddings = compressor.transform(embeddings)
+    return embeddings.tolist()
+
+def run_embedding_pipeline(batches, model, collection_chroma, on_written=None, embedding_cache=None,
+                           compressor=None, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Pipeline 3 tầng nối bằng hàng đợi có giới hạn: luồng gọi đọc kho chunk -> luồng encode -> luồng ghi ChromaDB.
+    Việc đọc, encode và ghi chạy chồng lên nhau; bộ nhớ chỉ giữ vài lô bất kể kích thước kho.
+    on_written(batch_docs) được gọi (trên luồng ghi) sau mỗi lô ghi thành công.
+    embedding_cache (nếu có): chỉ encode các đoạn văn chưa có vector trong cache (xem embedding_cache.py).
+    compressor (nếu có): phép nén số chiều của collection, áp dụng sau khi encode (xem vector_compression.py).
+    Trả về {"add": số đoạn đã thêm, "update": số đoạn đã cập nhật}.
+    """
+    encode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    written = {"add": 0, "update": 0}
+    errors = []
+
+    def encoder():
+        try:
+            for kind, batch_docs in iter(encode_queue.get, _PIPELINE_DONE):
+                if errors:
+                    continue # Đã có lỗi: chỉ lấy hết hàng đợi để tầng đọc không bị chặn
+                try:
+                    batch_contents = [d.get('content', '') for d in batch_docs]
+                    batch_embeddings = encode_texts(model, batch_contents, embedding_cache, compressor)
+                    write_queue.put((kind, batch_docs, batch_embeddings))
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            write_queue.put(_PIPELINE_DONE)
+
+    def writer():
+        for kind, batch_docs, batch_embeddings in iter(write_queue.get, _PIPELINE_DONE):
+            if errors:
+                continue # Đã có lỗi: chỉ lấy hết hàng đợi để luồng encode không bị chặn
+            try:
+                count = write_batch_to_chroma(collection_chroma, batch_docs, batch_embeddings)
+                written[kind] += count
+                if count and on_written is not None:
+                    on_written(batch_docs)
+            except Exception as e:
+                errors.append(e)
+                continue
+            print(f"  Đã {'thêm' if kind == 'add' else 'cập nhật'} {count} embeddings "
+                  f"(tổng: thêm {written['add']}, cập nhật {written['update']})")
+
+    threads = [threading.Thread(target=encoder, name="embed-encoder", daemon=True),
+               threading.Thread(target=writer, name="chroma-writer", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            encode_queue.put(batch)
+    finally:
+        encode_queue.put(_PIPELINE_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return written
+
+def prepare_manifest(manifest, collection_chroma):
+    """
+    Đưa sổ đồng bộ về khớp với ChromaDB trước khi đối chiếu: collection rỗng (index bị xóa/tạo mới) -> xóa sổ;
+    sổ rỗng nhưng collection đã có dữ liệu (index tạo trước khi có sổ) -> nhập ID từ ChromaDB một lần, không đọc metadata.
+    """
+    chroma_count = collection_chroma.count()
+    if chroma_count == 0:
+        if manifest.count():
+            print("Collection ChromaDB rỗng: xóa sổ đồng bộ cũ.")
+            manifest.clear()
         return
+    if manifest.count() == 0:
+        print(f"Sổ đồng bộ chưa có dữ liệu: nhập {chroma_count} ID từ ChromaDB (các vector này sẽ được embed lại một lần)...")
+        for offset in range(0, chroma_count, SCAN_BATCH_SIZE):
+            manifest.seed(collection_chroma.get(include=[], limit=SCAN_BATCH_SIZE, offset=offset)['ids'])
 
-    mongo_docs = get_documents_from_mongo(MONGO_URI, DB_NAME, COLLECTION_SOURCE)
-    print(f"Đã lấy {len(mongo_docs)} đoạn văn từ MongoDB.")
+def delete_orphan_vectors(collection_chroma, manifest, lexical_index=None, allow_mass_delete=False):
+    """
+    Xóa khỏi ChromaDB (và khỏi sổ, chỉ mục từ) các vector có chunk nguồn không còn trong kho chunk.
+    Không xóa gì nếu số vector mồ côi vượt ORPHAN_DELETE_MAX_RATIO số vector trong sổ, trừ khi allow_mass_delete.
+    Trả về số vector đã xóa.
+    """
+    orphans, known = manifest.count_unseen(), manifest.count()
+    if orphans and orphans > ORPHAN_DELETE_MAX_RATIO * known and not allow_mass_delete:
+        print(f"Cảnh báo: {orphans}/{known} vector không còn chunk nguồn trong kho chunk, vượt ngưỡng "
+              f"ORPHAN_DELETE_MAX_RATIO={ORPHAN_DELETE_MAX_RATIO}. Không xóa vector nào; kiểm tra cấu hình kho chunk "
+              f"hoặc chạy lại với --allow-mass-delete nếu các nguồn này thật sự đã bị xóa.")
+        return 0
+    deleted = 0
+    for batch_ids in manifest.iter_unseen():
+        collection_chroma.delete(ids=batch_ids)
+        manifest.remove(batch_ids)
+        if lexical_index is not None:
+            lexical_index.remove(batch_ids)
+        deleted += len(batch_ids)
+    return deleted
 
-    if not mongo_docs:
-        print("Không có document nào để xử lý trong MongoDB.")
+def sync_lexical_index(lexical_index, collection_chroma, store):
+    """
+    Chỉ mục từ được cập nhật theo từng lô ghi vào ChromaDB; nếu số chunk của nó vẫn lệch với collection
+    (chỉ mục mới tạo cho một collection đã có dữ liệu, hoặc file bị xóa) thì dựng lại từ kho chunk (không cần encode).
+    """
+    if lexical_index.count() == collection_chroma.count():
         return
+    print(f"Đang dựng lại chỉ mục từ (BM25) từ kho chunk ({lexical_index.count()} / {collection_chroma.count()} chunk)...")
+    lexical_index.clear()
+    chunks = store.iter_chunks()
+    while True:
+        batch = list(islice(chunks, SCAN_BATCH_SIZE))
+        if not batch:
+            break
+        lexical_index.add(batch)
+
+def prepare_compressor(collection_chroma, collection_name, store, encode_raw):
+    """
+    Phép nén vector của collection. Collection đã có phép nén thì dùng lại nó (vector cũ và mới phải cùng không gian);
+    collection rỗng và VECTOR_COMPRESSION khác "none" thì học phép nén trên tối đa COMPRESSION_FIT_SAMPLE chunk
+    lấy đều trong kho (vector nằm lại trong cache nên không phải encode lại khi embed).
+    """
+    configured = VectorCompressor(VECTOR_COMPRESSION, VECTOR_DIM)
+    compressor = load_collection_compressor(PERSIST_DIRECTORY, collection_name)
+    if compressor is not None:
+        if compressor.spec != configured.spec:
+            print(f"Lưu ý: Collection '{collection_name}' dùng phép nén {compressor.spec}; "
+                  f"VECTOR_COMPRESSION={configured.spec} chỉ áp dụng khi chạy --rebuild.")
+        return compressor
+    if configured.method == "none":
+        return None
+    if collection_chroma.count() > 0:
+        print(f"Lưu ý: Collection '{collection_name}' đang lưu vector không nén; "
+              f"chạy --rebuild để dựng lại với phép nén {configured.spec}.")
+        return None
 
-    collection_chroma = client_chroma.get_or_create_collection(name=COLLECTION_NAME_CHROMA)
-    print(f"Đã kết nối hoặc tạo ChromaDB collection: '{COLLECTION_NAME_CHROMA}'.")
+    stride = max(1, store.count() // COMPRESSION_FIT_SAMPLE)
+    sample = [doc['content'] for i, doc in enumerate(store.iter_chunks()) if i % stride == 0][:COMPRESSION_FIT_SAMPLE]
+    if not sample:
+        return None
+    print(f"Đang học phép nén {configured.spec} trên {len(sample)} chunk mẫu...")
+    compressor = configured.fit(encode_raw(sample))
+    compressor.save(compressor_path(PERSIST_DIRECTORY, collection_name))
+    return compressor
 
-    print("Đang lấy thông tin các document hiện có trong ChromaDB...")
-    existing_chroma_data = {} # {id_mongo: last_updated_datetime}
+def finish_rebuild(client_chroma, collection_chroma, expected_count, encode_query):
+    """
+    Kiểm tra thế hệ vừa dựng (số vector, truy vấn mẫu); nếu đạt thì đổi con trỏ sang nó và xóa các thế hệ cũ
+    (cùng sổ đồng bộ của chúng). Nếu không đạt, con trỏ giữ nguyên và thế hệ mới được để lại để kiểm tra.
+    """
+    passed, message = verify_generation(collection_chroma, expected_count, encode_query)
+    if not passed:
+        print(f"Lỗi: Thế hệ '{collection_chroma.name}' không đạt kiểm tra ({message}). Giữ nguyên collection đang phục vụ.")
+        return False
+    print(f"Thế hệ '{collection_chroma.name}' đạt kiểm tra: {message}.")
+    activate_generation(PERSIST_DIRECTORY, COLLECTION_NAME_CHROMA, collection_chroma.name, expected_count)
+    print(f"Đã chuyển con trỏ sang '{collection_chroma.name}'.")
+    for name in cleanup_generations(client_chroma, PERSIST_DIRECTORY, COLLECTION_NAME_CHROMA):
+        with SyncManifest(SYNC_MANIFEST_PATH, name) as old_manifest:
+            old_manifest.clear()
+        if os.path.exists(compressor_path(PERSIST_DIRECTORY, name)):
+            os.remove(compressor_path(PERSIST_DIRECTORY, name))
+        remove_lexical_index(PERSIST_DIRECTORY, name)
+        print(f"Đã xóa thế hệ cũ '{name}'.")
+    return True
+
+# --- Hàm chính để tạo và lưu Embeddings ---
+def create_embeddings_and_store_in_chroma(rebuild=False, allow_mass_delete=False):
+    """
+    Đồng bộ kho chunk vào collection đang phục vụ (cập nhật tại chỗ), hoặc với rebuild=True dựng lại toàn bộ
+    vào một thế hệ collection mới rồi mới đổi con trỏ sang nó (xem chroma_generations.py).
+    allow_mass_delete: cho phép xóa vector mồ côi vượt ngưỡng ORPHAN_DELETE_MAX_RATIO.
+    """
+    with open_chunk_store(mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_SOURCE) as store:
+        source_name, source_count = store.name, store.count()
+    if not source_count:
+        # Kho chunk rỗng thường là cấu hình sai; không đụng tới collection đang phục vụ
+        print(f"Không có đoạn văn nào để xử lý trong kho chunk ({source_name}).")
+        return
+
+    print(f"Đang tải mô hình embedding: {EMBEDDING_MODEL_NAME} (backend {EMBEDDING_BACKEND})...")
     try:
-        all_chroma_results = collection_chroma.get(ids=None, include=['metadatas'])
-        for i, _id in enumerate(all_chroma_results.get('ids', [])):
-            metadata = all_chroma_results['metadatas'][i]
-            if metadata and 'last_updated' in metadata:
-                existing_chroma_data[_id] = parse_last_updated(metadata['last_updated'])
-            else:
-                existing_chroma_data[_id] = datetime.min # Coi như rất cũ nếu không có timestamp
-        print(f"Tìm thấy {len(existing_chroma_data)} document hiện có trong ChromaDB.")
+        model = load_embedding_model(EMBEDDING_MODEL_NAME)
+        print("Đã tải mô hình embedding thành công.")
     except Exception as e:
-        print(f"Cảnh báo: Không thể lấy ID/metadata từ ChromaDB. Lỗi: {e}. Có thể collection rỗng.")
-        existing_chroma_data = {}
-
-    docs_to_add = []
-    docs_to_update = []
-
-    print("Đang phân loại các đoạn văn cần thêm/cập nhật...")
-    for doc in mongo_docs:
-        doc_id = doc['_id']
-        mongo_last_updated = parse_last_updated(doc.get('last_updated', datetime.min))
-        
-        if doc_id not in existing_chroma_data:
-            docs_to_add.append(doc)
-        elif mongo_last_updated > existing_chroma_data[doc_id]:
-            docs_to_update.append(doc)
-    
-    print(f"Tìm thấy {len(docs_to_add)} đoạn văn mới cần thêm.")
-    print(f"Tìm thấy {len(docs_to_update)} đoạn văn cần cập nhật.")
-
-    if docs_to_add:
-        print("Đang tạo embeddings và thêm các đoạn văn mới vào ChromaDB...")
-        batch_size = 100 
-        for i in range(0, len(docs_to_add), batch_size):
-            batch_docs = docs_to_add[i:i+batch_size]
-            batch_contents = [d.get('content', '') for d in batch_docs]
-            batch_embeddings = model.encode(batch_contents, show_progress_bar=False).tolist()
-            batch_ids = [d['_id'] for d in batch_docs]
-            batch_metadatas = []
-            for d in batch_docs:
-                filtered_meta = {k: v for k, v in d['metadata'].items() if isinstance(v, (str, int, float, bool))}
-                if 'last_updated' in d and isinstance(d['last_updated'], (str, datetime)):
-                    filtered_meta['last_updated'] = str(d['last_updated']) # Đảm bảo là string
-                batch_metadatas.append(filtered_meta)
+        print(f"Lỗi khi tải mô hình embedding: {e}")
+        return
 
-            try:
-                collection_chroma.add(
-                    embeddings=batch_embeddings,
-                    documents=batch_contents,
-                    metadatas=batch_metadatas,
-                    ids=batch_ids
-                )
-                print(f"  Đã thêm {len(batch_contents)} embeddings mới (Batch {i//batch_size + 1}/{len(docs_to_add)//batch_size + 1})")
-            except Exception as e:
-                print(f"Lỗi khi thêm batch vào ChromaDB (add): {e}")
-                print(f"  Batch IDs gây lỗi: {batch_ids}")
-                # Có thể log chi tiết hơn hoặc bỏ qua lỗi để tiếp tục với các batch khác
-                
-    if docs_to_update:
-        print("Đang tạo embeddings và cập nhật các đoạn văn trong ChromaDB...")
-        batch_size = 100
-        for i in range(0, len(docs_to_update), batch_size):
-            batch_docs = docs_to_update[i:i+batch_size]
-            batch_contents = [d.get('content', '') for d in batch_docs]
-            batch_embeddings = model.encode(batch_contents, show_progress_bar=False).tolist()
-            batch_ids = [d['_id'] for d in batch_docs]
-            batch_metadatas = []
-            for d in batch_docs:
-                filtered_meta = {k: v for k, v in d['metadata'].items() if isinstance(v, (str, int, float, bool))}
-                if 'last_updated' in d and isinstance(d['last_updated'], (str, datetime)):
-                    filtered_meta['last_updated'] = str(d['last_updated']) # Đảm bảo là string
-                batch_metadatas.append(filtered_meta)
+    # Client ChromaDB được tạo trong hàm (không ở cấp module) vì các tiến trình encode "spawn" nạp lại script này
+    client_chroma = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    if rebuild:
+        collection_name = new_generation_name(COLLECTION_NAME_CHROMA)
+        collection_chroma = client_chroma.create_collection(name=collection_name)
+        print(f"Dựng lại toàn bộ vào thế hệ mới: '{collection_name}'.")
+    else:
+        collection_name = active_collection_name(PERSIST_DIRECTORY, COLLECTION_NAME_CHROMA)
+        collection_chroma = client_chroma.get_or_create_collection(name=collection_name)
+        print(f"Đã kết nối hoặc tạo ChromaDB collection: '{collection_name}'.")
 
-            try:
-                collection_chroma.upsert(
-                    embeddings=batch_embeddings,
-                    documents=batch_contents,
-                    metadatas=batch_metadatas,
-                    ids=batch_ids
-                )
-                print(f"  Đã cập nhật {len(batch_contents)} embeddings (Batch {i//batch_size + 1}/{len(docs_to_update)//batch_size + 1})")
-            except Exception as e:
-                print(f"Lỗi khi cập nhật batch vào ChromaDB (upsert): {e}")
-                print(f"  Batch IDs gây lỗi: {batch_ids}")
-                # Có thể log chi tiết hơn hoặc bỏ qua lỗi để tiếp tục với các batch khác
+    embedding_cache = open_embedding_cache(EMBEDDING_MODEL_VERSION)
+    if ENCODE_WORKERS > 1:
+        print(f"Encode song song trên {ENCODE_WORKERS} tiến trình CPU.")
+    # Encode theo nhóm độ dài token, song song trên ENCODE_WORKERS tiến trình CPU (xem parallel_encoder.py)
+    with ParallelEncoder(model, EMBEDDING_MODEL_NAME, ENCODE_WORKERS) as encoder, \
+         SyncManifest(SYNC_MANIFEST_PATH, collection_name) as manifest, \
+         open_lexical_index(PERSIST_DIRECTORY, collection_name, create=True) as lexical_index, \
+         open_chunk_store(mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_SOURCE) as store:
+        prepare_manifest(manifest, collection_chroma)
+        print(f"Sổ đồng bộ {SYNC_MANIFEST_PATH}: {manifest.count()} vector đã embed.")
+        compressor = prepare_compressor(collection_chroma, collection_name, store,
+                                        lambda texts: np.asarray(encode_texts(encoder, texts, embedding_cache)))
+        if compressor is not None:
+            print(f"Vector được nén {compressor.spec} trước khi lưu vào ChromaDB.")
+
+        def record_batch(batch_docs):
+            manifest.record([(d['_id'], get_chunk_hash(d)) for d in batch_docs], EMBEDDING_MODEL_VERSION)
+            lexical_index.add(batch_docs)
+
+        print(f"Đang đọc kho chunk ({store.name}: {store.count()} đoạn văn) và embed các đoạn văn mới/cập nhật...")
+        written = run_embedding_pipeline(iter_pending_batches(store, manifest, EMBEDDING_MODEL_VERSION),
+                                         encoder, collection_chroma, on_written=record_batch,
+                                         embedding_cache=embedding_cache, compressor=compressor)
+        deleted = delete_orphan_vectors(collection_chroma, manifest, lexical_index, allow_mass_delete)
+        sync_lexical_index(lexical_index, collection_chroma, store)
+        print(f"Chỉ mục từ (BM25): {lexical_index.count()} chunk.")
+        if rebuild:
+            finish_rebuild(client_chroma, collection_chroma, store.count(),
+                           lambda texts: encode_texts(encoder, texts, embedding_cache, compressor))
+    if embedding_cache is not None:
+        print(embedding_cache.format_stats())
+        embedding_cache.close()
 
-    if not docs_to_add and not docs_to_update:
+    print(f"Đã thêm {written['add']} đoạn văn mới, cập nhật {written['update']} đoạn văn, xóa {deleted} vector không còn nguồn.")
+    if not written['add'] and not written['update'] and not deleted:
         print("Không có đoạn văn mới hoặc cập nhật nào để xử lý.")
 
     print("\n--- Hoàn tất quá trình đồng bộ embeddings vào ChromaDB ---")
-    print(f"Tổng số document trong ChromaDB collection '{COLLECTION_NAME_CHROMA}': {collection_chroma.count()}")
+    print(f"Tổng số document trong ChromaDB collection '{collection_name}': {collection_chroma.count()}")
 
 if __name__ == "__main__":
-    create_embeddings_and_store_in_chroma()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tạo embeddings từ kho chunk và lưu vào ChromaDB")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Dựng lại toàn bộ vào một collection mới, kiểm tra rồi mới đổi con trỏ (blue/green)")
+    parser.add_argument("--allow-mass-delete", action="store_true",
+                        help="Cho phép xóa vector mồ côi vượt ngưỡng ORPHAN_DELETE_MAX_RATIO")
+    args = parser.parse_args()
+    create_embeddings_and_store_in_chroma(rebuild=args.rebuild, allow_mass_delete=args.allow_mass_delete)
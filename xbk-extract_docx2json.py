@@ -1,10 +1,12 @@
-import docx
 import json
 import os
 import re
 import unicodedata
 import sys
 from tqdm import tqdm
+from docx_stream import iter_docx_paragraphs
+from metadata_fuzzy_index import MetadataFuzzyIndex
+from heading_grammar import DOC2JSON_HEADING_GRAMMAR
 
 # Ánh xạ tên file sang tên metadata chuẩn (có thể mở rộng nếu cần)
 # Mục đích: Đảm bảo tên file được ánh xạ chính xác tới "Tên Kinh Đầy Đủ" trong metadata_index
@@ -47,10 +49,11 @@ def normalize(s):
     s = re.sub(r'[\s_\-]', '', s) # Loại bỏ khoảng trắng, gạch dưới, gạch ngang
     return s
 
-def get_onix_metadata(ten_kinh_day_du, metadata_index):
+def get_onix_metadata(ten_kinh_day_du, metadata_index, metadata_fuzzy_index=None):
     """
     Tìm kiếm và trả về metadata ONIX cho một tên kinh đầy đủ.
-    Sử dụng chỉ mục metadata đã được chuẩn hóa để tìm kiếm.
+    Sử dụng chỉ mục metadata đã được chuẩn hóa để tìm kiếm; nếu không khớp chính xác
+    thì thử chỉ mục gần đúng (metadata_fuzzy_index) và chỉ nhận kết quả đủ tin cậy.
     """
     norm_name = normalize(ten_kinh_day_du)
     # Các khóa metadata cần trích xuất. Thêm/bớt tùy theo cấu trúc metadata_index.json của bạn.
@@ -65,6 +68,13 @@ def get_onix_metadata(ten_kinh_day_du, metadata_index):
     if norm_name in metadata_index:
         return {k: metadata_index[norm_name].get(k, "Not_Available") for k in meta_keys}
 
+    # Tìm kiếm gần đúng (không phân biệt dấu, chịu được hậu tố thừa trong tên file)
+    if metadata_fuzzy_index is not None:
+        matched_key = metadata_fuzzy_index.best_match(ten_kinh_day_du)
+        if matched_key is not None:
+            print_status(f"Khớp gần đúng '{ten_kinh_day_du}' với metadata '{matched_key}'.", "INFO")
+            return {k: metadata_index[matched_key].get(k, "Not_Available") for k in meta_keys}
+
     print_status(f"==> Không tìm thấy metadata cho '{ten_kinh_day_du}' (normalize: '{norm_name}')!", "WARN")
     # Trả về dictionary với "Not_Available" cho tất cả các khóa nếu không tìm thấy
     return {k: "Not_Available" for k in meta_keys}
@@ -84,12 +94,13 @@ def print_status(msg, status="INFO"):
     else:
         print(f"[{status}] {msg}")
 
-def extract_data_from_docx(docx_file_path, output_dir, ten_kinh_day_du, ten_kinh_filename, metadata_index):
+def extract_data_from_docx(docx_file_path, output_dir, ten_kinh_day_du, ten_kinh_filename, metadata_index,
+                           metadata_fuzzy_index=None):
     """
     Trích xuất dữ liệu từ file DOCX, phân chia theo phẩm/kinh và lưu dưới dạng JSON.
     """
     try:
-        doc = docx.Document(docx_file_path)
+        paragraphs = iter_docx_paragraphs(docx_file_path) # Đọc streaming, không dựng toàn bộ Document
         print_status(f"Đang xử lý file DOCX: {docx_file_path}", "INFO")
     except Exception as e:
         print_status(f"Không thể mở hoặc đọc file DOCX '{docx_file_path}': {e}", "ERR")
@@ -102,7 +113,7 @@ def extract_data_from_docx(docx_file_path, output_dir, ten_kinh_day_du, ten_kinh
     current_kinh_content = []
     
     # Lấy metadata ONIX một lần cho toàn bộ kinh
-    onix_meta = get_onix_metadata(ten_kinh_day_du, metadata_index)
+    onix_meta = get_onix_metadata(ten_kinh_day_du, metadata_index, metadata_fuzzy_index)
     
     found_pham_structure = False
     found_kinh_structure = False
@@ -147,57 +158,51 @@ def extract_data_from_docx(docx_file_path, output_dir, ten_kinh_day_du, ten_kinh
             print_status(f"Không thể ghi file '{output_path}': {e}", "ERR")
 
     # Bắt đầu duyệt từng đoạn văn trong tài liệu
-    for paragraph in doc.paragraphs:
-        text = paragraph.text.strip()
+    for paragraph_text in paragraphs:
+        text = paragraph_text.strip()
         if not text:
             continue
 
-        # Kiểm tra tiêu đề PHẨM
-        # Có thể là "PHẨM X", "X. PHẨM Y", "PHẦN Z"
-        match_pham = re.match(r"^(?:\d{1,2}\.\s*)?PHẨM\s+(.+)$", text, re.IGNORECASE)
-        match_phan = re.match(r"^PHẦN\s+(\d+)$", text, re.IGNORECASE)
-        
-        # Kiểm tra tiêu đề KINH
-        # Có thể là "X. KINH Y", "KINH Z"
-        match_kinh = re.match(r"^(\d{1,3})\.\s*KINH\s+(.+)$", text, re.IGNORECASE)
+        # Nhận diện tiêu đề trong một lần match: PHẨM ("PHẨM X", "X. PHẨM Y"), PHẦN ("PHẦN Z"),
+        # KINH ("X. KINH Y") và dấu phân đoạn, theo thứ tự ưu tiên đó
+        heading = DOC2JSON_HEADING_GRAMMAR.classify(text)
+        heading_kind = heading.kind if heading else None
         
         # Ưu tiên PHẨM/PHẦN, sau đó đến KINH
-        if match_pham or match_phan:
+        if heading_kind in ("pham", "phan"):
             # Lưu kinh hiện tại trước khi chuyển sang phẩm/phần mới
             if current_kinh_content and kinh_title != "Không xác định":
                 save_kinh_segment(current_kinh_content, pham_title, pham_idx, kinh_title, kinh_idx, chia_doan)
             
             # Cập nhật thông tin phẩm/phần mới
             pham_idx += 1
-            if match_pham:
-                pham_title = match_pham.group(0).strip()
+            pham_title = text
+            if heading_kind == "pham":
                 print_status(f"Nhận diện PHẨM: {pham_title}", "INFO")
-                found_pham_structure = True
-            elif match_phan:
-                pham_title = match_phan.group(0).strip()
+            else:
                 print_status(f"Nhận diện PHẦN: {pham_title}", "INFO")
-                found_pham_structure = True # Coi PHẦN như một dạng cấu trúc phẩm
+            found_pham_structure = True # Coi PHẦN như một dạng cấu trúc phẩm
 
             kinh_title = "Không xác định" # Reset kinh_title khi gặp phẩm/phần mới
             kinh_idx = 0
             current_kinh_content = []
             continue # Tiếp tục vòng lặp, không xử lý đoạn này là nội dung
 
-        elif match_kinh:
+        elif heading_kind == "kinh":
             # Lưu kinh hiện tại trước khi chuyển sang kinh mới
             if current_kinh_content and kinh_title != "Không xác định":
                 save_kinh_segment(current_kinh_content, pham_title, pham_idx, kinh_title, kinh_idx, chia_doan)
             
             # Cập nhật thông tin kinh mới
             kinh_idx += 1
-            kinh_title = match_kinh.group(0).strip()
+            kinh_title = text
             print_status(f"Nhận diện KINH: {kinh_title}", "INFO")
             found_kinh_structure = True
             current_kinh_content = []
             continue # Tiếp tục vòng lặp, không xử lý đoạn này là nội dung
 
         # Nếu là dấu phân đoạn, bỏ qua
-        if text.strip().replace(" ", "").replace("\t", "") in ["---o0o---", "o0o"]:
+        if heading_kind == "delimiter":
             continue
         
         # Chỉ thêm nội dung nếu đã tìm thấy ít nhất một tiêu đề KINH
@@ -248,6 +253,7 @@ if __name__ == "__main__":
 
     # Tải và tiền xử lý chỉ mục metadata
     metadata_index = load_metadata_index(metadata_index_path)
+    metadata_fuzzy_index = MetadataFuzzyIndex(metadata_index)
 
     # Lấy danh sách các file .docx trong thư mục đầu vào
     files_to_process = [f for f in os.listdir(input_dir) if f.lower().endswith(".docx")]
@@ -271,7 +277,8 @@ if __name__ == "__main__":
         ten_kinh_filename = base_filename.replace(" ", "_").replace("-", "_")
 
         print_status(f"Bắt đầu xử lý file: {filename}", "INFO")
-        extract_data_from_docx(docx_file_path, output_dir, meta_key, ten_kinh_filename, metadata_index)
+        extract_data_from_docx(docx_file_path, output_dir, meta_key, ten_kinh_filename, metadata_index,
+                               metadata_fuzzy_index)
         print_status(f"Đã hoàn thành xử lý file: {filename}\n", "OK")
 
     print_status("Tất cả các file DOCX đã được trích xuất và chia thành các file JSON.", "OK")
\ No newline at end of file
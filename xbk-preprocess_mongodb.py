@@ -2,39 +2,36 @@
 import os
 import json
 import datetime
-from pymongo import MongoClient
+import hashlib
 import unicodedata
 import re
+import queue
+import threading
+from collections import ChainMap, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from segment_store import list_shards, iter_shard
+from chunk_store import open_chunk_store
+from token_chunker import CHUNKING_MODE, LengthHistogram, create_chunker
 
 # --- Cấu hình ---
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/') # Lấy từ env hoặc dùng default
 DB_NAME = os.getenv('DB_NAME', 'kinhsachdb')
 COLLECTION_SOURCE = os.getenv('COLLECTION_SOURCE', 'kinhsach_doan')
+# Kho chunk: CHUNK_STORE_BACKEND="mongo" (mặc định) hoặc "sqlite" (file CHUNK_STORE_PATH), xem chunk_store.py
 
-JSON_FOLDER = "data/Doc2Json"  # Thư mục chứa các file JSON gốc
-NORMALIZED_JSON_FOLDER = "data/Doc2JsonNormalized" # Thư mục lưu JSON đã chuẩn hóa
+JSON_FOLDER = os.getenv('JSON_FOLDER', "data/Doc2Json")  # Thư mục chứa các file JSON gốc (chuẩn hóa NFC ngay khi đọc)
 
-MAX_TEXT_LENGTH = 512 # Độ dài tối đa của mỗi chunk văn bản
+MAX_TEXT_LENGTH = 512 # Độ dài tối đa của mỗi chunk văn bản khi CHUNKING_MODE=chars (xem token_chunker.py)
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '1000')) # Số thao tác mỗi lần ghi lô vào kho chunk
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', os.cpu_count() or 1)) # Số tiến trình đọc/chunk song song (1 = tuần tự)
+WRITER_QUEUE_SIZE = int(os.getenv('WRITER_QUEUE_SIZE', '64')) # Số file đã chunk tối đa chờ ghi vào kho chunk
 
-# --- Hàm kiểm tra và chuẩn hóa mã hóa ---
-def check_and_normalize_encoding(input_folder, output_folder):
-    os.makedirs(output_folder, exist_ok=True)
-    file_names = [f for f in os.listdir(input_folder) if f.endswith(".json")]
-    print(f"Bắt đầu chuẩn hóa encoding cho {len(file_names)} files JSON.")
-    for file_name in file_names:
-        input_path = os.path.join(input_folder, file_name)
-        output_path = os.path.join(output_folder, file_name)
-        try:
-            with open(input_path, 'r', encoding='utf-8') as infile:
-                content = infile.read()
-                normalized_content = unicodedata.normalize('NFC', content)
-            with open(output_path, 'w', encoding='utf-8') as outfile:
-                outfile.write(normalized_content)
-        except UnicodeDecodeError:
-            print(f"Cảnh báo: File '{file_name}' không phải là UTF-8 chuẩn. Vui lòng kiểm tra.")
-        except Exception as e:
-            print(f"Lỗi khi xử lý file '{file_name}': {e}")
-    print("Hoàn tất chuẩn hóa encoding.")
+# --- Hàm đọc JSON và chuẩn hóa mã hóa trong bộ nhớ ---
+def load_normalized_json(file_path):
+    """Đọc file JSON UTF-8, chuẩn hóa Unicode NFC trong bộ nhớ rồi phân tích."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.loads(unicodedata.normalize('NFC', f.read()))
 
 # --- Hàm chunk văn bản ---
 def chunk_text(text, max_length=MAX_TEXT_LENGTH):
@@ -52,104 +49,360 @@ def chunk_text(text, max_length=MAX_TEXT_LENGTH):
         chunks.append(current_chunk.strip())
     return chunks
 
+# --- Bộ chia chunk dùng chung (CHUNKING_MODE: "tokens" hoặc "chars") ---
+_default_chunker = None
+
+def get_default_chunker():
+    global _default_chunker
+    if _default_chunker is None:
+        _default_chunker = create_chunker(CHUNKING_MODE, chunk_text)
+    return _default_chunker
+
 # --- Hàm trích xuất nội dung và metadata ---
-def extract_content_and_metadata(data, file_name):
-    contents = []
-    metadatas = []
-    
-    allowed_types = ["van_xuoi", "paragraph", "tieu_de_pham", "tieu_de_chuong", "tieu_de_bai_kinh", "tụng"]
-
-    def extract_from_item(item, current_metadata, unique_texts, doan_so_counter):
-        if isinstance(item, dict):
-            new_metadata = current_metadata.copy()
-            for key, value in item.items():
-                if isinstance(value, (str, int, float, bool, type(None))):
-                    new_metadata[key] = value
-
-            text_to_extract = item.get("text") or item.get("tieu_de")
-
-            if text_to_extract and item.get("type") in allowed_types and text_to_extract.strip():
-                text_to_extract = text_to_extract.strip()
-                if text_to_extract not in unique_texts:
-                    chunks = chunk_text(text_to_extract)
-                    for chunk in chunks:
-                        contents.append(chunk)
-                        meta_for_chunk = new_metadata.copy()
-                        meta_for_chunk['doan_so'] = next(doan_so_counter) # Gán số đoạn tăng dần
-                        metadatas.append(meta_for_chunk)
-                    unique_texts.add(text_to_extract)
-            
-            if isinstance(item.get("content"), list):
-                for sub_item in item["content"]:
-                    extract_from_item(sub_item, new_metadata, unique_texts, doan_so_counter)
-            elif isinstance(item.get("Noi_Dung"), list):
-                for sub_item in item["Noi_Dung"]:
-                    extract_from_item(sub_item, new_metadata, unique_texts, doan_so_counter)
-
-    extracted_texts_set = set()
-    from itertools import count
-    doan_so_counter = count(1) # Bộ đếm số đoạn văn
-    
-    initial_metadata = {"source_file": file_name}
+ALLOWED_TYPES = ("van_xuoi", "paragraph", "tieu_de_pham", "tieu_de_chuong", "tieu_de_bai_kinh", "tụng")
+UNIT_BATCH_SIZE = 256 # Số đơn vị văn bản gửi cho chunker mỗi lượt
+
+def _scalar_fields(mapping):
+    return {key: value for key, value in mapping.items() if isinstance(value, (str, int, float, bool, type(None)))}
+
+def _text_digest(text):
+    """Hash 16 byte của đoạn văn, dùng để loại trùng thay vì giữ cả chuỗi."""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def _materialize(frame):
+    """Dựng dict metadata từ khung ChainMap (lớp gần nhất ghi đè), giữ thứ tự khóa như khi copy() rồi update()."""
+    metadata = {}
+    for layer in reversed(frame.maps):
+        metadata.update(layer)
+    return metadata
+
+def iter_content_units(data, file_name):
+    """
+    Duyệt cây JSON bằng ngăn xếp tường minh (không đệ quy), sinh lười các đơn vị văn bản
+    (danh sách (số đoạn văn, đoạn văn), khung metadata, đường dẫn) theo đúng thứ tự duyệt tiền thứ tự.
+    Khung metadata là ChainMap các lớp chỉ chứa trường riêng của từng cấp, không sao chép metadata của cấp cha.
+    """
+    unique_digests = set()
+    root = ChainMap({"source_file": file_name})
 
     if isinstance(data, dict):
         if "Noi_Dung" in data and isinstance(data["Noi_Dung"], list):
-            for item in data["Noi_Dung"]:
-                extract_from_item(item, initial_metadata, extracted_texts_set, doan_so_counter)
+            top_items = [(item, f"Noi_Dung/{i}") for i, item in enumerate(data["Noi_Dung"])]
         else:
-            extract_from_item(data, initial_metadata, extracted_texts_set, doan_so_counter)
+            top_items = [(data, "")]
     elif isinstance(data, list):
-        for item in data:
-            extract_from_item(item, initial_metadata, extracted_texts_set, doan_so_counter)
+        top_items = [(item, str(i)) for i, item in enumerate(data)]
     else:
         print(f"Cảnh báo: Dữ liệu trong '{file_name}' không phải là dictionary hoặc list ở cấp cao nhất.")
+        return
 
-    return contents, metadatas
+    stack = [(item, root, path) for item, path in reversed(top_items)]
+    while stack:
+        item, parent_frame, path = stack.pop()
+        if not isinstance(item, dict):
+            continue
+        frame = parent_frame.new_child(_scalar_fields(item))
 
-# --- Hàm chính để xử lý JSON và lưu vào MongoDB ---
-def process_json_to_mongodb():
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    kinhsach_doan_collection = db[COLLECTION_SOURCE]
+        text_to_extract = item.get("text") or item.get("tieu_de")
+        text_key = "text" if item.get("text") else "tieu_de"
+        if text_to_extract and item.get("type") in ALLOWED_TYPES and text_to_extract.strip():
+            text_to_extract = text_to_extract.strip()
+            digest = _text_digest(text_to_extract)
+            if digest not in unique_digests:
+                unique_digests.add(digest)
+                yield [(None, text_to_extract)], frame, f"{path}/{text_key}"
 
-    # Xóa collection cũ để đảm bảo dữ liệu mới nhất
-    kinhsach_doan_collection.drop()
-    print(f"Collection '{COLLECTION_SOURCE}' trong MongoDB đã được xóa.")
+        # Segment do process_docs_for_rag.py sinh ra: {"metadata": {...}, "noi_dung": ["đoạn văn", ...]}
+        if isinstance(item.get("metadata"), dict) and isinstance(item.get("noi_dung"), list):
+            frame = frame.new_child(_scalar_fields(item["metadata"]))
+            paragraphs = []
+            for paragraph_idx, paragraph in enumerate(item["noi_dung"]):
+                if not isinstance(paragraph, str) or not paragraph.strip():
+                    continue
+                paragraph = paragraph.strip()
+                digest = _text_digest(paragraph)
+                if digest in unique_digests:
+                    continue
+                unique_digests.add(digest)
+                paragraphs.append((paragraph_idx, paragraph))
+            if paragraphs:
+                yield paragraphs, frame, f"{path}/noi_dung"
 
-    # Bước 1: Chuẩn hóa encoding các file JSON
-    check_and_normalize_encoding(JSON_FOLDER, NORMALIZED_JSON_FOLDER)
+        if isinstance(item.get("content"), list):
+            children, child_key = item["content"], "content"
+        elif isinstance(item.get("Noi_Dung"), list):
+            children, child_key = item["Noi_Dung"], "Noi_Dung"
+        else:
+            continue
+        for i in range(len(children) - 1, -1, -1):
+            stack.append((children[i], frame, f"{path}/{child_key}/{i}"))
 
-    file_names = [f for f in os.listdir(NORMALIZED_JSON_FOLDER) if f.endswith(".json")]
-    
-    total_docs_added = 0
-    for file_name in file_names:
-        file_path = os.path.join(NORMALIZED_JSON_FOLDER, file_name)
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            contents, metadatas = extract_content_and_metadata(data, file_name)
-            
-            docs_to_insert = []
-            for i in range(len(contents)):
-                doc_to_insert = {
-                    'content': contents[i],
-                    'metadata': metadatas[i],
-                    'last_updated': datetime.datetime.now() # Thêm timestamp
-                }
-                docs_to_insert.append(doc_to_insert)
-            
-            if docs_to_insert:
-                kinhsach_doan_collection.insert_many(docs_to_insert)
-                total_docs_added += len(docs_to_insert)
-                print(f"Đã thêm {len(docs_to_insert)} đoạn văn từ '{file_name}' vào MongoDB.")
+def iter_content_chunks(data, file_name, chunker=None):
+    """
+    Sinh lười (chunk, metadata, đường dẫn chunk trong tài liệu) của một tài liệu JSON.
+    Đường dẫn (ví dụ "Noi_Dung/3/content/0/text#1") dùng để tạo ID ổn định cho chunk.
+    Các đơn vị văn bản được chia chunk theo lô UNIT_BATCH_SIZE; metadata chỉ được dựng thành dict khi sinh chunk.
+    """
+    chunker = chunker or get_default_chunker()
+    units = iter_content_units(data, file_name)
+    doan_so = 0 # Bộ đếm số đoạn văn
+    while True:
+        batch = list(islice(units, UNIT_BATCH_SIZE))
+        if not batch:
+            return
+        chunked_units = chunker.chunk_units([paragraphs for paragraphs, _, _ in batch])
+        for (_, frame, unit_path), chunks in zip(batch, chunked_units):
+            unit_metadata = _materialize(frame) if chunks else None
+            for chunk, path_suffix in chunks:
+                doan_so += 1
+                meta_for_chunk = unit_metadata.copy() if len(chunks) > 1 else unit_metadata
+                meta_for_chunk['doan_so'] = doan_so # Gán số đoạn tăng dần
+                yield chunk, meta_for_chunk, unit_path + path_suffix
+
+def extract_content_and_metadata(data, file_name, chunker=None):
+    """Trả về (contents, metadatas, paths) của toàn bộ tài liệu (dạng danh sách của iter_content_chunks)."""
+    contents, metadatas, paths = [], [], []
+    for content, metadata, path in iter_content_chunks(data, file_name, chunker):
+        contents.append(content)
+        metadatas.append(metadata)
+        paths.append(path)
+    return contents, metadatas, paths
+
+# --- ID và hash của chunk ---
+def make_chunk_id(source_file, path, content):
+    """ID ổn định của chunk: không đổi giữa các lần chạy nếu file, vị trí và nội dung chunk không đổi."""
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return hashlib.sha1(f"{source_file}|{path}|{content_hash}".encode('utf-8')).hexdigest()
 
+def make_chunk_hash(content, metadata):
+    """Hash của nội dung và metadata chunk; last_updated chỉ đổi khi hash này đổi."""
+    payload = json.dumps({"content": content, "metadata": metadata}, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# --- Generator các tài liệu chunk cần lưu vào kho ---
+def list_source_tasks(input_folder):
+    """Danh sách nguồn cần xử lý [(loại, đường dẫn)]: các file JSON rồi tới các shard JSONL, theo thứ tự tên."""
+    tasks = [("json", os.path.join(input_folder, f)) for f in sorted(os.listdir(input_folder)) if f.endswith(".json")]
+    # Các shard JSONL (SEGMENT_OUTPUT_FORMAT=jsonl/jsonl.gz) được đọc lười và chuẩn hóa NFC từng dòng
+    tasks += [("shard", os.path.join(input_folder, f)) for f in list_shards(input_folder)]
+    return tasks
+
+def iter_source_file(kind, path):
+    """
+    Sinh lần lượt (tên file, dữ liệu JSON) của một file JSON, hoặc của từng segment trong một shard JSONL.
+    File không đọc được vẫn được sinh ra với dữ liệu None, để các chunk cũ của nó không bị coi là đã bị xóa.
+    """
+    if kind == "json":
+        file_name = os.path.basename(path)
+        try:
+            data = load_normalized_json(path)
+        except UnicodeDecodeError:
+            print(f"Cảnh báo: File '{file_name}' không phải là UTF-8 chuẩn. Vui lòng kiểm tra.")
+            data = None
         except Exception as e:
             print(f"Lỗi khi đọc hoặc xử lý file '{file_name}': {e}")
+            data = None
+        yield file_name, data
+        return
+
+    seen_ids = {}
+    try:
+        for segment in iter_shard(path, nfc=True):
+            # Shard giữ cả các segment trùng tên; đánh số thêm để mỗi segment có source_file riêng
+            seen_ids[segment['id']] = seen_ids.get(segment['id'], 0) + 1
+            suffix = f"_{seen_ids[segment['id']]}" if seen_ids[segment['id']] > 1 else ""
+            yield f"{segment['id']}{suffix}.json", {"metadata": segment["metadata"], "noi_dung": segment["noi_dung"]}
+    except Exception as e:
+        print(f"Lỗi khi đọc hoặc xử lý shard '{os.path.basename(path)}': {e}")
+
+def iter_source_documents(input_folder):
+    """Sinh lần lượt (tên file, dữ liệu JSON) của toàn bộ kho JSON."""
+    for kind, path in list_source_tasks(input_folder):
+        yield from iter_source_file(kind, path)
+
+def build_chunk_documents(file_name, data, chunker=None):
+    """
+    Danh sách document (chunk) của một file, theo đúng thứ tự doan_so; None nếu file không đọc/xử lý được.
+    Mỗi document có _id ổn định (make_chunk_id) và chunk_hash; last_updated được gán khi ghi.
+    """
+    if data is None:
+        return None
+    try:
+        return [{
+            '_id': make_chunk_id(file_name, path, content),
+            'content': content,
+            'metadata': metadata,
+            'chunk_hash': make_chunk_hash(content, metadata),
+        } for content, metadata, path in iter_content_chunks(data, file_name, chunker)]
+    except Exception as e:
+        print(f"Lỗi khi đọc hoặc xử lý file '{file_name}': {e}")
+        return None
+
+def iter_file_chunk_documents(input_folder, chunker=None):
+    """Sinh lần lượt (tên file, danh sách document của file hoặc None) cho toàn bộ kho JSON."""
+    for file_name, data in iter_source_documents(input_folder):
+        yield file_name, build_chunk_documents(file_name, data, chunker)
+
+def _chunk_source_worker(kind, path):
+    """
+    Chạy trong tiến trình con: đọc, chuẩn hóa và chunk một nguồn (file JSON hoặc shard).
+    Trả về ([(tên file, documents)], đơn vị histogram, các cột histogram của riêng lượt này).
+    """
+    chunker = get_default_chunker()
+    before = chunker.histogram.buckets.copy()
+    results = [(file_name, build_chunk_documents(file_name, data, chunker)) for file_name, data in iter_source_file(kind, path)]
+    return results, chunker.histogram.unit, chunker.histogram.buckets - before
+
+def iter_file_chunk_documents_parallel(input_folder, histogram, num_workers=NUM_WORKERS):
+    """
+    Như iter_file_chunk_documents nhưng đọc/chunk trong ProcessPoolExecutor. Kết quả được trả về đúng thứ tự nguồn;
+    tối đa 2 * num_workers nguồn được xử lý trước để bộ nhớ không tăng theo kích thước kho.
+    Histogram độ dài chunk của các tiến trình con được cộng dồn vào `histogram`.
+    """
+    tasks = iter(list_source_tasks(input_folder))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for kind, path in islice(tasks, 2 * num_workers):
+            pending.append(executor.submit(_chunk_source_worker, kind, path))
+        while pending:
+            results, unit, buckets = pending.popleft().result()
+            for kind, path in islice(tasks, 1):
+                pending.append(executor.submit(_chunk_source_worker, kind, path))
+            histogram.unit = unit
+            histogram.buckets.update(buckets)
+            yield from results
+
+def diff_file_chunks(store, file_name, docs):
+    """
+    So sánh các chunk mới của một file với các chunk đang có trong kho.
+    Trả về (chunk mới cần thêm, chunk đổi nội dung/metadata cần thay thế, _id các chunk không còn trong file, số chunk không đổi).
+    Chunk không đổi giữ nguyên last_updated nên không bị embed lại.
+    """
+    existing = store.get_source_hashes(file_name)
+    now = datetime.datetime.now()
+    inserts, replaces = [], []
+    unchanged = 0
+    for doc in docs:
+        if doc['_id'] not in existing:
+            inserts.append(dict(doc, last_updated=now))
+        elif existing.pop(doc['_id']) != doc['chunk_hash']:
+            replaces.append(dict(doc, last_updated=now))
+        else:
+            unchanged += 1
+    return inserts, replaces, list(existing), unchanged
+
+# --- Ghi các chunk vào kho ---
+def write_file_chunks(store, file_chunks, batch_size=BULK_BATCH_SIZE):
+    """
+    Đồng bộ tăng dần các (tên file, documents) vào kho chunk: chỉ ghi các chunk thêm/đổi/bị xóa của từng file,
+    gom thành các lô khoảng batch_size thao tác. Chunk của các file không còn trong nguồn bị xóa ở cuối.
+    Trả về ([đã thêm, đã cập nhật, đã xóa], số chunk không đổi).
+    """
+    totals = [0, 0, 0] # đã thêm, đã cập nhật, đã xóa
+    total_unchanged = 0
+    seen_files = []
+    pending = ([], [], []) # thêm, thay thế, xóa
+
+    def flush():
+        for i, count in enumerate(store.write_batch(*pending)):
+            totals[i] += count
+        for operations in pending:
+            operations.clear()
+
+    try:
+        for file_name, docs in file_chunks:
+            seen_files.append(file_name)
+            if docs is None:
+                continue # Giữ nguyên các chunk cũ của file lỗi
+            *changes, unchanged = diff_file_chunks(store, file_name, docs)
+            total_unchanged += unchanged
+            changed = sum(len(operations) for operations in changes)
+            if changed:
+                print(f"'{file_name}': {changed} thay đổi, {unchanged} đoạn văn không đổi.")
+            for operations, new_operations in zip(pending, changes):
+                operations.extend(new_operations)
+            if sum(len(operations) for operations in pending) >= batch_size:
+                flush()
+    finally:
+        flush() # Thay đổi của các file đã xử lý xong vẫn được ghi khi nguồn bị ngắt giữa chừng
+    # Các file không còn trong thư mục nguồn: xóa toàn bộ chunk của chúng. Chỉ chạy khi đã duyệt hết danh sách nguồn
+    # (file_chunks ném lỗi thì không tới đây), nếu không chunk của các file chưa kịp đọc sẽ bị xóa nhầm.
+    totals[2] += store.delete_sources_except(seen_files)
+    return totals, total_unchanged
+
+_WRITER_DONE = object()
+_WRITER_ABORTED = object() # Bên gửi dừng vì lỗi: danh sách file chưa đầy đủ
+
+class _ProducerAborted(Exception):
+    pass
+
+def write_file_chunks_in_background(store, file_chunks, batch_size=BULK_BATCH_SIZE, queue_size=WRITER_QUEUE_SIZE):
+    """
+    Ghi vào kho chunk trong một luồng ghi riêng, nhận (tên file, documents) qua hàng đợi có giới hạn,
+    để việc chunk (ở luồng gọi/tiến trình con) và việc ghi kho chạy chồng lên nhau.
+    """
+    pending = queue.Queue(maxsize=queue_size)
+    outcome = {}
+
+    def received():
+        while True:
+            item = pending.get()
+            if item is _WRITER_DONE:
+                return
+            if item is _WRITER_ABORTED:
+                raise _ProducerAborted()
+            yield item
+
+    def writer():
+        try:
+            outcome['result'] = write_file_chunks(store, received(), batch_size)
+        except _ProducerAborted:
+            pass # Lỗi của bên gửi được ném lại ở luồng gọi; không xóa chunk của các file chưa nhận được
+        except Exception as e:
+            outcome['error'] = e
+            while pending.get() not in (_WRITER_DONE, _WRITER_ABORTED): # Tiếp tục lấy khỏi hàng đợi để bên gửi không bị chặn
+                pass
+
+    thread = threading.Thread(target=writer, name="mongo-writer", daemon=True)
+    thread.start()
+    completed = False
+    try:
+        for item in file_chunks:
+            if 'error' in outcome:
+                break
+            pending.put(item)
+        completed = True
+    finally:
+        pending.put(_WRITER_DONE if completed else _WRITER_ABORTED)
+        thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+# --- Hàm chính để xử lý JSON và lưu vào kho chunk (MongoDB hoặc SQLite) ---
+def process_json_to_mongodb(batch_size=BULK_BATCH_SIZE, num_workers=NUM_WORKERS):
+    store = open_chunk_store(mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_SOURCE)
+    # Đồng bộ tăng dần: không xóa dữ liệu cũ, chỉ ghi các chunk thêm/đổi/bị xóa của từng file
+
+    # Đọc, chuẩn hóa NFC, chunk và ghi theo kiểu streaming: bộ nhớ chỉ giữ một số file và một lô thao tác
+    if num_workers > 1:
+        print(f"Chunk song song với {num_workers} tiến trình, một luồng ghi kho chunk.")
+        histogram = LengthHistogram("token" if CHUNKING_MODE == "tokens" else "ký tự")
+        file_chunks = iter_file_chunk_documents_parallel(JSON_FOLDER, histogram, num_workers)
+    else:
+        chunker = get_default_chunker()
+        histogram = LengthHistogram(chunker.histogram.unit)
+        before = chunker.histogram.buckets.copy()
+        file_chunks = iter_file_chunk_documents(JSON_FOLDER, chunker)
+    totals, total_unchanged = write_file_chunks_in_background(store, file_chunks, batch_size)
+    if num_workers <= 1:
+        histogram.buckets = chunker.histogram.buckets - before
     
-    print(f"\n--- Hoàn tất xử lý JSON và lưu vào MongoDB ---")
-    print(f"Tổng số đoạn văn đã thêm vào collection '{COLLECTION_SOURCE}': {total_docs_added}")
-    client.close()
+    print(f"\n--- Hoàn tất xử lý JSON và lưu vào kho chunk ---")
+    print(f"{store.name}: thêm {totals[0]}, cập nhật {totals[1]}, xóa {totals[2]}, "
+          f"không đổi {total_unchanged} đoạn văn.")
+    print(histogram.format())
+    store.close()
 
 if __name__ == "__main__":
     process_json_to_mongodb()
\ No newline at end of file
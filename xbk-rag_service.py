@@ -3,11 +3,18 @@
 import os
 import json
 import requests
-import chromadb
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 import logging # <--- THÊM DÒNG NÀY
-import sys
+import atexit
+import threading
+import time
+from chroma_generations import active_collection_name, pointer_path
+from vector_compression import load_collection_compressor
+from embedding_backend import EMBEDDING_BACKEND, embedding_model_version, load_embedding_model
+from embedding_cache import open_embedding_cache
+from query_cache import QueryEmbeddingCache
+from answer_cache import AnswerCache
+from lexical_index import LEXICAL_TOP_K, RRF_K_LEXICAL, RRF_K_VECTOR, open_lexical_index, reciprocal_rank_fusion
 load_dotenv() # Tải biến môi trường
 
 # Cấu hình logging cơ bản (THÊM PHẦN NÀY)
@@ -22,41 +29,180 @@ CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR")
 COLLECTION_NAME_CHROMA = os.getenv("COLLECTION_NAME_CHROMA")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME")
 
+# Mở rộng ngữ cảnh từ kho văn bản toàn bộ tài liệu (process_docs_for_rag.py với FULL_DOC_OUTPUT_FORMAT=text).
+# Để trống FULL_TEXT_DIR hoặc CONTEXT_PARAGRAPHS=0 để tắt.
+FULL_TEXT_DIR = os.getenv("FULL_TEXT_DIR")
+CONTEXT_PARAGRAPHS = int(os.getenv("CONTEXT_PARAGRAPHS", "0")) # Số đoạn văn lấy thêm trước/sau mỗi chunk
+
 # Định nghĩa các thông báo lỗi đặc biệt (để khớp với app_gradio.py)
 NO_INFO_ANSWER = "Xin lỗi, tôi không tìm thấy thông tin đủ chi tiết trong các Kinh đã được cung cấp để trả lời câu hỏi này."
 RAG_ERROR_ANSWER_PREFIX = "Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn:"
+AI_RESPONSE_ERROR_ANSWER = "Xin lỗi, có lỗi khi nhận câu trả lời từ dịch vụ AI."
+
+RAG_READY_TIMEOUT = float(os.getenv("RAG_READY_TIMEOUT", "30")) # Số giây một câu hỏi chờ dịch vụ khởi tạo xong
+
+# --- Các thành phần RAG toàn cục ---
+# Được khởi tạo trong luồng nền (start_background_init) để ứng dụng web mở cổng ngay khi import module này;
+# trạng thái khởi tạo (service_status) được app_gradio.py trả về qua /healthz và /readyz.
+model = None
+chroma_client = None
+chroma_collection = None
+embedding_cache = None
+query_cache = None
+# Câu trả lời của Chatling.ai cho các câu hỏi gần trùng với cùng ngữ cảnh, xem answer_cache.py
+answer_cache = AnswerCache()
+full_text_library = None
+# Collection đang phục vụ theo con trỏ thế hệ (embed_to_chroma.py --rebuild), xem chroma_generations.py
+active_collection = {"name": None, "pointer_mtime": None, "compressor": None, "lexical_index": None}
+
+_service_state = {"status": "starting", "error": None, "started_at": None, "ready_at": None}
+_init_done = threading.Event() # Được đặt khi khởi tạo kết thúc, thành công hay thất bại
+_init_lock = threading.Lock()
+_init_thread = None
+_collection_lock = threading.Lock()
+
+def _pointer_mtime():
+    try:
+        return os.stat(pointer_path(CHROMA_PERSIST_DIR)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def initialize_rag_service():
+    """
+    Tải mô hình embedding, mở ChromaDB, cache embedding và kho văn bản, rồi chạy một truy vấn giả để làm nóng
+    mô hình và index. Ném ValueError/RuntimeError nếu cấu hình sai hoặc không mở được mô hình/collection.
+    """
+    global model, chroma_client, chroma_collection, embedding_cache, query_cache, full_text_library
+    import chromadb # Import chậm (vài trăm ms), chỉ cần trong luồng khởi tạo
+
+    # Kiểm tra các biến môi trường cần thiết
+    if not all([CHATLING_API_KEY, CHATLING_BOT_ID, CHATLING_AI_MODEL_ID,
+                 CHROMA_PERSIST_DIR, COLLECTION_NAME_CHROMA, EMBEDDING_MODEL_NAME]):
+        raise ValueError("Vui lòng thiết lập đầy đủ các biến môi trường trong file .env")
+
+    try:
+        logging.info(f"[RAG Service] Đang tải mô hình embedding: {EMBEDDING_MODEL_NAME} (backend {EMBEDDING_BACKEND})...")
+        model = load_embedding_model(EMBEDDING_MODEL_NAME)
+        logging.info("[RAG Service] Mô hình embedding đã tải.")
+    except Exception as e:
+        raise RuntimeError(f"Không thể khởi tạo mô hình embedding: {e}. Vui lòng kiểm tra tên mô hình và kết nối internet.") from e
+
+    try:
+        logging.info(f"[RAG Service] Đang kết nối tới ChromaDB tại: {CHROMA_PERSIST_DIR}...")
+        chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+        active_collection["pointer_mtime"] = _pointer_mtime()
+        active_collection["name"] = active_collection_name(CHROMA_PERSIST_DIR, COLLECTION_NAME_CHROMA)
+        chroma_collection = chroma_client.get_collection(name=active_collection["name"])
+        # Phép nén vector của collection (nếu có) phải được áp dụng giống hệt cho câu hỏi, xem vector_compression.py
+        active_collection["compressor"] = load_collection_compressor(CHROMA_PERSIST_DIR, active_collection["name"])
+        # Chỉ mục từ BM25 cho tìm kiếm lai (nếu embed_to_chroma.py đã dựng), xem lexical_index.py
+        active_collection["lexical_index"] = open_lexical_index(CHROMA_PERSIST_DIR, active_collection["name"])
+        count = chroma_collection.count()
+        logging.info(f"[RAG Service] Đã kết nối tới ChromaDB collection '{active_collection['name']}'. Tổng số documents: {count}")
+        if count == 0:
+            logging.warning("[RAG Service] Cảnh báo: ChromaDB collection rỗng. Vui lòng chạy embed_to_chroma.py để nạp dữ liệu.")
+    except Exception as e:
+        logging.error("[RAG Service] Đảm bảo bạn đã chạy embed_to_chroma.py để tạo dữ liệu.")
+        raise RuntimeError(f"Không thể kết nối tới ChromaDB: {e}. Vui lòng kiểm tra đường dẫn và đảm bảo đã chạy embed_to_chroma.py.") from e
+
+    # Cache embedding câu hỏi (dùng chung file cache với embed_to_chroma.py), xem embedding_cache.py
+    try:
+        embedding_cache = open_embedding_cache(embedding_model_version(EMBEDDING_MODEL_NAME))
+    except (OSError, ValueError) as e:
+        logging.warning(f"[RAG Service] Không mở được cache embedding, encode trực tiếp: {e}")
+    # Câu hỏi lặp lại lấy vector từ LRU trong bộ nhớ, sau đó mới tới cache dùng chung, xem query_cache.py
+    query_cache = QueryEmbeddingCache(backend=embedding_cache)
+    cache = query_cache
+    atexit.register(lambda: logging.info(f"[RAG Service] {cache.format_stats()} {answer_cache.format_stats()}"))
+
+    if FULL_TEXT_DIR and CONTEXT_PARAGRAPHS > 0:
+        try:
+            from fulltext_store import FullTextLibrary
+            full_text_library = FullTextLibrary(FULL_TEXT_DIR)
+            if len(full_text_library):
+                logging.info(f"[RAG Service] Mở rộng ngữ cảnh ±{CONTEXT_PARAGRAPHS} đoạn văn từ {len(full_text_library)} "
+                             f"kho văn bản: {FULL_TEXT_DIR}")
+            else:
+                # Thư mục chỉ có file JSON toàn bộ DOCX: mọi chunk sẽ giữ nguyên, nên báo rõ thay vì lặng lẽ bỏ qua
+                logging.warning(f"[RAG Service] '{FULL_TEXT_DIR}' không có kho văn bản nào (*.index.json), bỏ qua mở rộng "
+                                "ngữ cảnh. Chạy process_docs_for_rag.py với FULL_DOC_OUTPUT_FORMAT=text để tạo.")
+                full_text_library = None
+        except OSError as e:
+            logging.warning(f"[RAG Service] Không mở được kho văn bản '{FULL_TEXT_DIR}', bỏ qua mở rộng ngữ cảnh: {e}")
 
-# Kiểm tra các biến môi trường cần thiết
-if not all([CHATLING_API_KEY, CHATLING_BOT_ID, CHATLING_AI_MODEL_ID,
-             CHROMA_PERSIST_DIR, COLLECTION_NAME_CHROMA, EMBEDDING_MODEL_NAME]):
-    logging.error("Vui lòng thiết lập đầy đủ các biến môi trường trong file .env") # Thay raise ValueError bằng logging.error và thoát
-    sys.exit(1) # Thoát nếu thiếu biến môi trường
-
-# --- Khởi tạo các thành phần RAG toàn cục ---
-try:
-    logging.info(f"[RAG Service] Đang tải mô hình embedding: {EMBEDDING_MODEL_NAME}...") # <--- THAY ĐỔI
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-    logging.info("[RAG Service] Mô hình embedding đã tải.") # <--- THAY ĐỔI
-except Exception as e:
-    logging.error(f"[RAG Service] Lỗi khi tải mô hình embedding: {e}", exc_info=True) # <--- THAY ĐỔI
-    sys.exit(f"Không thể khởi tạo mô hình embedding: {e}. Vui lòng kiểm tra tên mô hình và kết nối internet.") # <--- THAY ĐỔI
-
-
-try:
-    logging.info(f"[RAG Service] Đang kết nối tới ChromaDB tại: {CHROMA_PERSIST_DIR}...") # <--- THAY ĐỔI
-    chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-    chroma_collection = chroma_client.get_collection(name=COLLECTION_NAME_CHROMA)
-    logging.info(f"[RAG Service] Đã kết nối tới ChromaDB collection '{COLLECTION_NAME_CHROMA}'. Tổng số documents: {chroma_collection.count()}") # <--- THAY ĐỔI
-    if chroma_collection.count() == 0:
-        logging.warning("[RAG Service] Cảnh báo: ChromaDB collection rỗng. Vui lòng chạy embed_to_chroma.py để nạp dữ liệu.") # <--- THAY ĐỔI
-except Exception as e:
-    logging.error(f"[RAG Service] Lỗi khi kết nối hoặc tải ChromaDB collection: {e}", exc_info=True) # <--- THAY ĐỔI
-    logging.error("[RAG Service] Đảm bảo bạn đã chạy embed_to_chroma.py để tạo dữ liệu.") # <--- THAY ĐỔI
-    sys.exit(f"Không thể kết nối tới ChromaDB: {e}. Vui lòng kiểm tra đường dẫn và đảm bảo đã chạy embed_to_chroma.py.") # <--- THAY ĐỔI
+    # Làm nóng: lượt encode đầu tiên (cấp phát, biên dịch đồ thị) và lượt truy vấn đầu tiên (nạp index HNSW)
+    # chậm hơn hẳn các lượt sau, nên chạy trước khi báo sẵn sàng. Không đi qua cache để không ghi câu hỏi giả vào cache.
+    query_embedding = model.encode(["làm nóng"], show_progress_bar=False)
+    if active_collection["compressor"] is not None:
+        query_embedding = active_collection["compressor"].transform(query_embedding)
+    if chroma_collection.count() > 0:
+        chroma_collection.query(query_embeddings=query_embedding.tolist(), n_results=1, include=["documents"])
+
+
+def _run_initialization():
+    try:
+        initialize_rag_service()
+    except Exception as e:
+        logging.error(f"[RAG Service] Khởi tạo thất bại: {e}", exc_info=True)
+        _service_state.update(status="failed", error=str(e))
+    else:
+        _service_state.update(status="ready", ready_at=time.time())
+        logging.info(f"[RAG Service] Sẵn sàng sau {_service_state['ready_at'] - _service_state['started_at']:.1f} giây.")
+    _init_done.set()
+
+
+def start_background_init():
+    """Bắt đầu khởi tạo dịch vụ trong một luồng nền (chỉ lần gọi đầu tiên có tác dụng) và trả về ngay."""
+    global _init_thread
+    with _init_lock:
+        if _init_thread is None:
+            _service_state["started_at"] = time.time()
+            _init_thread = threading.Thread(target=_run_initialization, name="rag-service-init", daemon=True)
+            _init_thread.start()
+
+
+def wait_until_ready(timeout=None):
+    """Chờ khởi tạo xong (bắt đầu khởi tạo nếu chưa); trả về True nếu dịch vụ đã sẵn sàng."""
+    start_background_init()
+    return _init_done.wait(timeout) and _service_state["status"] == "ready"
+
+
+def service_status():
+    """Trạng thái khởi tạo cho /healthz và /readyz: status là "starting", "ready" hoặc "failed"."""
+    state = dict(_service_state)
+    if state["status"] == "ready":
+        state["collection"] = active_collection["name"]
+    return state
 
 
 # --- Hàm để tải collection ChromaDB (cho Gradio app) ---
 def load_chroma_collection():
+    """
+    Collection đang phục vụ. Khi file con trỏ thế hệ thay đổi (embed_to_chroma.py --rebuild vừa đổi sang thế hệ mới),
+    collection mới được mở ngay ở lần gọi sau, không cần khởi động lại; nếu không mở được thì giữ collection cũ.
+    """
+    global chroma_collection
+    if not wait_until_ready(RAG_READY_TIMEOUT):
+        raise RuntimeError(f"Dịch vụ RAG chưa sẵn sàng (trạng thái: {_service_state['status']}).")
+    mtime = _pointer_mtime()
+    if mtime == active_collection["pointer_mtime"]:
+        return chroma_collection
+    with _collection_lock:
+        if mtime != active_collection["pointer_mtime"]:
+            name = active_collection_name(CHROMA_PERSIST_DIR, COLLECTION_NAME_CHROMA)
+            try:
+                if name != active_collection["name"]:
+                    compressor = load_collection_compressor(CHROMA_PERSIST_DIR, name)
+                    lexical_index = open_lexical_index(CHROMA_PERSIST_DIR, name)
+                    chroma_collection = chroma_client.get_collection(name=name)
+                    active_collection["compressor"] = compressor
+                    active_collection["lexical_index"] = lexical_index
+                    logging.info(f"[RAG Service] Đã chuyển sang ChromaDB collection '{name}' ({chroma_collection.count()} documents).")
+                    active_collection["name"] = name
+                active_collection["pointer_mtime"] = mtime
+            except Exception as e:
+                logging.error(f"[RAG Service] Không mở được collection '{name}', tiếp tục dùng '{active_collection['name']}': {e}")
     return chroma_collection
 
 # --- Hàm gọi Chatling.ai API (ĐÃ CẬP NHẬT) ---
@@ -116,28 +262,82 @@ def get_chatling_response(question: str, context_docs: list, ai_model_id: str) -
         return RAG_ERROR_ANSWER_PREFIX + str(e)
     except json.JSONDecodeError as e:
         logging.error(f"[Chatling API] Lỗi giải mã JSON từ Chatling.ai: {e}", exc_info=True) # <--- THAY ĐỔI
-        return "Xin lỗi, có lỗi khi nhận câu trả lời từ dịch vụ AI."
+        return AI_RESPONSE_ERROR_ANSWER
     except Exception as e: # Bắt các lỗi chung khác
         logging.error(f"[Chatling API] Lỗi không xác định trong get_chatling_response: {e}", exc_info=True)
         return RAG_ERROR_ANSWER_PREFIX + "Lỗi không xác định khi gọi AI."
 
 
+# --- Hàm mở rộng ngữ cảnh của chunk ---
+def expand_context_docs(documents: list, metadatas: list) -> list:
+    """Thay mỗi chunk bằng các đoạn văn xung quanh nó trong kho văn bản (giữ nguyên chunk nếu không tìm thấy hoặc khớp nhiều chỗ)."""
+    if full_text_library is None:
+        return documents
+    expanded = []
+    for document, metadata in zip(documents, metadatas or [{}] * len(documents)):
+        metadata = metadata or {}
+        reader = full_text_library.for_source_file(metadata.get("source_file", ""))
+        context = reader.context_for_chunk(document, CONTEXT_PARAGRAPHS, CONTEXT_PARAGRAPHS, metadata) if reader else None
+        expanded.append("\n".join(context) if context else document)
+    return expanded
+
+
+# --- Hàm trộn kết quả tìm kiếm vector và tìm kiếm từ khóa ---
+def fuse_lexical_results(collection, vector_results, lexical_hits, num_results):
+    """
+    Trộn kết quả ChromaDB (theo thứ hạng vector) với kết quả BM25 [(ID, điểm)] bằng reciprocal rank fusion
+    (hằng số RRF_K_VECTOR, RRF_K_LEXICAL) và giữ num_results chunk đầu. Trả về dict cùng dạng kết quả của
+    collection.query; chunk chỉ có trong kết quả từ khóa được đọc từ ChromaDB và có khoảng cách None.
+    """
+    rows = {chunk_id: (document, metadata, distance) for chunk_id, document, metadata, distance
+            in zip(vector_results["ids"][0], vector_results["documents"][0],
+                   vector_results["metadatas"][0], vector_results["distances"][0])}
+    fused = reciprocal_rank_fusion([(vector_results["ids"][0], RRF_K_VECTOR),
+                                    ([chunk_id for chunk_id, _ in lexical_hits], RRF_K_LEXICAL)])[:num_results]
+    missing = [chunk_id for chunk_id, _ in fused if chunk_id not in rows]
+    if missing:
+        extra = collection.get(ids=missing, include=["documents", "metadatas"])
+        rows.update((chunk_id, (document, metadata, None)) for chunk_id, document, metadata
+                    in zip(extra["ids"], extra["documents"], extra["metadatas"]))
+    ids = [chunk_id for chunk_id, _ in fused if chunk_id in rows] # Bỏ ID vừa bị xóa khỏi collection
+    return {"ids": [ids],
+            "documents": [[rows[chunk_id][0] for chunk_id in ids]],
+            "metadatas": [[rows[chunk_id][1] for chunk_id in ids]],
+            "distances": [[rows[chunk_id][2] for chunk_id in ids]]}
+
+
 # --- Hàm RAG chính ---
 def rag_query(user_query: str, num_results: int = 5) -> tuple:
     logging.info(f"[RAG Query] Bắt đầu xử lý truy vấn RAG cho: '{user_query}'") # <--- THÊM LOG
+    if not wait_until_ready(RAG_READY_TIMEOUT):
+        logging.warning(f"[RAG Query] Dịch vụ chưa sẵn sàng (trạng thái: {_service_state['status']}).")
+        if _service_state["status"] == "failed":
+            return {}, RAG_ERROR_ANSWER_PREFIX + " không khởi tạo được dịch vụ tra cứu."
+        return {}, RAG_ERROR_ANSWER_PREFIX + " hệ thống đang khởi động, vui lòng thử lại sau giây lát."
     try:
         # 1. Tạo embedding cho câu hỏi
         logging.info("[RAG Query] Tạo embedding cho câu hỏi...") # <--- THAY ĐỔI
-        query_embedding = model.encode(user_query).tolist()
+        raw_query_embedding = query_embedding = query_cache.encode(model, user_query)
+        collection = load_chroma_collection()
+        compressor = active_collection["compressor"]
+        lexical_index = active_collection["lexical_index"] if LEXICAL_TOP_K > 0 else None
+        if compressor is not None:
+            query_embedding = compressor.transform([query_embedding])[0]
+        query_embedding = query_embedding.tolist()
         logging.info("[RAG Query] Đã tạo embedding cho câu hỏi.") # <--- THÊM LOG
 
         # 2. Tìm kiếm các đoạn văn liên quan trong ChromaDB
         logging.info(f"[RAG Query] Đang tìm kiếm {num_results} đoạn văn liên quan trong ChromaDB cho: '{user_query}'") # <--- THAY ĐỔI
-        results_from_chroma = chroma_collection.query(
+        results_from_chroma = collection.query(
             query_embeddings=[query_embedding],
-            n_results=num_results,
+            n_results=max(num_results, LEXICAL_TOP_K) if lexical_index is not None else num_results,
             include=["documents", "metadatas", "distances"]
         )
+        if lexical_index is not None:
+            # Tìm kiếm lai: trộn với kết quả BM25 (tên kinh, thuật ngữ, gõ có dấu hoặc không dấu)
+            lexical_hits = lexical_index.search(user_query, LEXICAL_TOP_K)
+            logging.info(f"[RAG Query] Tìm kiếm từ khóa: {len(lexical_hits)} đoạn văn, trộn với kết quả vector (RRF).")
+            results_from_chroma = fuse_lexical_results(collection, results_from_chroma, lexical_hits, num_results)
         context_docs = results_from_chroma["documents"][0] if results_from_chroma and results_from_chroma["documents"] and results_from_chroma["documents"][0] else []
         logging.info(f"[RAG Query] Đã tìm thấy {len(context_docs)} đoạn văn từ ChromaDB.") # <--- THÊM LOG
 
@@ -146,10 +346,23 @@ def rag_query(user_query: str, num_results: int = 5) -> tuple:
             # Trả về kết quả rỗng và thông báo "không tìm thấy thông tin"
             return {}, NO_INFO_ANSWER
 
-        # 3. Gửi câu hỏi và context tới Chatling.ai
+        # 3. Dùng lại câu trả lời của một câu hỏi gần trùng với cùng các đoạn văn ngữ cảnh, nếu có
+        chunk_ids = results_from_chroma["ids"][0]
+        answer = answer_cache.get(raw_query_embedding, chunk_ids)
+        if answer is not None:
+            logging.info(f"[RAG Query] Dùng lại câu trả lời đã lưu cho câu hỏi gần trùng (một phần): {answer[:50]}...")
+            return results_from_chroma, answer
+
+        if full_text_library is not None:
+            context_docs = expand_context_docs(context_docs, (results_from_chroma.get("metadatas") or [[]])[0])
+
+        # 4. Gửi câu hỏi và context tới Chatling.ai
         logging.info("[RAG Query] Gửi câu hỏi và ngữ cảnh tới Chatling.ai...") # <--- THÊM LOG
         answer = get_chatling_response(user_query, context_docs, CHATLING_AI_MODEL_ID)
         logging.info(f"[RAG Query] Nhận được câu trả lời từ Chatling.ai (một phần): {answer[:50]}...") # <--- THÊM LOG
+        # Không lưu câu trả lời lỗi hay "không tìm thấy thông tin": lần hỏi sau phải được gọi lại LLM
+        if answer and answer not in (NO_INFO_ANSWER, AI_RESPONSE_ERROR_ANSWER) and not answer.startswith(RAG_ERROR_ANSWER_PREFIX):
+            answer_cache.put(raw_query_embedding, chunk_ids, answer)
 
         return results_from_chroma, answer
     except Exception as e: